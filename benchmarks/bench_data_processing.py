@@ -0,0 +1,211 @@
+'''Benchmark data_processing on seeded synthetic data.
+
+Times each get_table_* function, get_tables (on the task pool and one task at a time), build_tables_dict and the page end to end against a local stand-in
+for the datastore api (the layout alone, with the first tab, and with every section) for each requested number
+of subjects, recording wall time and peak traced memory.
+Results are written as json for comparison between runs.
+
+Usage:
+    python benchmarks/bench_data_processing.py --sizes 1000 10000 100000 --output benchmarks/results/latest.json
+'''
+import argparse
+import gc
+import hashlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+STANDIN_PORT = int(os.environ.get('BENCHMARK_DATASTORE_PORT', 8765))
+
+# The app reads the datastore location on import, so point it at the stand-in first
+os.environ['DATASTORE_URL'] = 'http://127.0.0.1:{0}'.format(STANDIN_PORT)
+# Time requests that do their own work, without a background refresher serving a ready report
+os.environ['REPORT_REFRESH_INTERVAL'] = '0'
+
+from synthetic_data import SRC_PATH, generate_subjects_json, get_api_payload_json
+
+import flask
+import numpy as np
+import pandas as pd
+from werkzeug.serving import make_server
+
+from config_settings import ASSETS_PATH
+from data_processing import *
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# ----------------------------------------------------------------------------
+# STAND-IN DATASTORE
+# ----------------------------------------------------------------------------
+
+class StandInDatastore:
+    '''Serves a fixed payload at /api/subjects from a background thread, recording the query parameters and
+    response status of each request. Requests with any of unsupported_params are rejected as bad requests. With
+    validators on, responses carry an ETag (the payload's sha256) and Last-Modified header and conditional
+    requests for an unchanged payload are answered with 304 Not Modified. Port 0 picks a free port.'''
+    def __init__(self, port=STANDIN_PORT):
+        self.payload = b'{}'
+        self.requests = []
+        self.statuses = []
+        self.unsupported_params = ()
+        self.validators = False
+        self.last_modified = datetime.now().replace(microsecond=0)
+        server = flask.Flask('standin_datastore')
+        server.add_url_rule('/api/subjects', 'subjects', self.get_subjects)
+        self.server = make_server('127.0.0.1', port, server, threaded=True)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get_subjects(self):
+        self.requests.append(flask.request.args.to_dict())
+        if any(param in flask.request.args for param in self.unsupported_params):
+            response = flask.Response('{"error": "Unsupported parameter"}', status=400, mimetype='application/json')
+        else:
+            response = flask.Response(self.payload, mimetype='application/json')
+            if self.validators:
+                response.set_etag(hashlib.sha256(self.payload).hexdigest())
+                response.last_modified = self.last_modified
+                response.make_conditional(flask.request)
+        self.statuses.append(response.status_code)
+        return response
+
+    def shutdown(self):
+        self.server.shutdown()
+
+# ----------------------------------------------------------------------------
+# MEASUREMENT
+# ----------------------------------------------------------------------------
+
+def measure(func, repeat=1, memory=True):
+    '''Run func, returning the best wall time over repeat runs and the peak traced memory of one more run.
+    Memory is traced separately because tracemalloc slows the timed code down.'''
+    seconds = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    peak_mb = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return min(seconds), peak_mb
+
+def get_table_stages(inputs):
+    '''The table functions in the order get_tables calls them, with their arguments'''
+    today, start_report, end_report = inputs['today'], inputs['start_report'], inputs['end_report']
+    subjects, consented, adverse_events = inputs['subjects'], inputs['consented'], inputs['adverse_events']
+    display_terms_dict, display_terms_dict_multi = inputs['display_terms_dict'], inputs['display_terms_dict_multi']
+    centers_df = inputs['centers_df']
+
+    deviations = get_deviation_records(consented, adverse_events)
+    ae = get_adverse_event_records(consented, adverse_events)
+
+    return [
+        ('get_table_1_screening', lambda: get_table_1_screening(subjects, consented, ['screening_site', 'surgery_type'])),
+        ('get_table_2a_screening', lambda: get_table_2a_screening(subjects, display_terms_dict_multi['reason_not_interested'])),
+        ('get_table_2b_screening', lambda: get_table_2b_screening(subjects, start_report, end_report)),
+        ('get_table_3_screening', lambda: get_table_3_screening(consented, ['screening_site', 'surgery_type'], today, 30)),
+        ('get_table_4', lambda: get_table_4(consented, today)),
+        ('get_tables_5_6', lambda: get_tables_5_6(consented)),
+        ('get_deviation_records', lambda: get_deviation_records(consented, adverse_events)),
+        ('get_deviations_by_center', lambda: get_deviations_by_center(centers_df, consented, deviations, display_terms_dict_multi)),
+        ('get_table7b_timelimited', lambda: get_table7b_timelimited(deviations.copy())),
+        ('get_adverse_event_records', lambda: get_adverse_event_records(consented, adverse_events)),
+        ('get_adverse_events_by_center', lambda: get_adverse_events_by_center(centers_df, consented, ae, display_terms_dict_multi)),
+        ('get_table_8b', lambda: get_table_8b(ae, today, None)),
+        ('get_demographic_data', lambda: get_demographic_data(consented)),
+    ]
+
+def run_size(n_subjects, seed, repeat, memory, standin):
+    import app
+    results = []
+
+    def record(stage, func):
+        seconds, peak_mb = measure(func, repeat, memory)
+        results.append({'n_subjects': n_subjects, 'stage': stage, 'seconds': round(seconds, 6),
+                        'peak_mb': None if peak_mb is None else round(peak_mb, 3)})
+        print('{0:>9} {1:<32} {2:9.3f}s {3}'.format(n_subjects, stage, seconds, '' if peak_mb is None else '{0:9.1f} MB'.format(peak_mb)))
+
+    # Build inputs the way serve_layout does
+    subjects_json, screening_sites = generate_subjects_json(n_subjects, seed)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    del subjects_json
+    today, start_report, end_report, report_date_msg, report_range_msg = get_time_parameters(datetime.now())
+    screening_centers_df, centers_df = get_centers(subjects, consented, display_terms)
+    inputs = {'today': today, 'start_report': start_report, 'end_report': end_report,
+              'subjects': subjects, 'consented': consented, 'adverse_events': adverse_events,
+              'display_terms_dict': display_terms_dict, 'display_terms_dict_multi': display_terms_dict_multi,
+              'centers_df': centers_df}
+    get_tables_args = (today, start_report, end_report, report_date_msg, report_range_msg, display_terms,
+                       display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df)
+
+    for stage, func in get_table_stages(inputs):
+        record(stage, func)
+    record('get_tables', lambda: get_tables(*get_tables_args))
+    record('get_tables_sequential', lambda: get_tables(*get_tables_args, workers=1))
+    # build_tables_dict flattens column names in place, so give each run its own copy of the tables
+    tables = get_tables(*get_tables_args)
+    record('build_tables_dict', lambda: app.build_tables_dict(*[table.copy() for table in tables]))
+
+    # End to end through the datastore stand-in, with and without a report cache hit
+    standin.payload = get_api_payload_json(subjects, consented, adverse_events)
+    results.append({'n_subjects': n_subjects, 'stage': 'payload_bytes', 'value': len(standin.payload)})
+
+    def serve_report(clear_cache, sections):
+        if clear_cache:
+            app.tables_cache.clear()
+        with app.app.server.test_request_context('/'):
+            layout = app.serve_layout()
+            page_meta_dict = layout.children[0].data
+            for section in sections:
+                app.get_section_content(section, page_meta_dict)
+
+    app.datastore_client._validators.clear()
+    record('serve_layout', lambda: serve_report(True, []))
+    record('first_tab', lambda: serve_report(True, ['section1']))
+    record('full_report', lambda: serve_report(True, SECTION_TABLES))
+    record('full_report_cached', lambda: serve_report(False, SECTION_TABLES))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='numbers of subjects to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best is recorded')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced memory run of each stage')
+    parser.add_argument('--output', default=os.path.join(BENCHMARKS_PATH, 'results', datetime.now().strftime('%Y%m%d_%H%M%S') + '.json'))
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    os.chdir(SRC_PATH)
+    standin = StandInDatastore()
+    results = []
+    try:
+        for n_subjects in args.sizes:
+            results.extend(run_size(n_subjects, args.seed, args.repeat, not args.no_memory, standin))
+    finally:
+        standin.shutdown()
+
+    report = {'created': datetime.now().isoformat(), 'seed': args.seed, 'repeat': args.repeat,
+              'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+              'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {0}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
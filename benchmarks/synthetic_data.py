@@ -0,0 +1,168 @@
+'''Seeded synthetic A2CPS data for benchmarking data_processing.
+
+Generates subjects data in the per-MCC json format read by get_subjects_json (record_id -> fields, with nested
+adverse_effects instances), assigning record ids from the screening_sites.csv ranges. Ranges are widened
+proportionally when more subjects are requested than the real ranges can hold.'''
+import math
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+from config_settings import ASSETS_PATH
+
+# ----------------------------------------------------------------------------
+# SCHEMA
+# ----------------------------------------------------------------------------
+
+DATA_ACCESS_GROUPS = {1: ['rush_university_me', 'northshore', 'uchicago'],
+                      2: ['university_of_mich', 'wayne_state', 'spectrum_health']}
+
+ELIGIBILITY_COLS = ['sp_inclcomply', 'sp_inclage1884', 'sp_inclsurg', 'sp_exclnoreadspkenglish',
+                    'sp_exclarthkneerep', 'sp_exclinfdxjoint', 'sp_exclbilkneerep', 'sp_exclothmajorsurg',
+                    'sp_exclprevbilthorpro']
+
+VISIT_COLS = ['start_v2_6wk', 'start_v3_3mo', 'start_6mo', 'start_12mo']
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M'
+
+# ----------------------------------------------------------------------------
+# GENERATORS
+# ----------------------------------------------------------------------------
+
+def get_synthetic_screening_sites(n_subjects, screening_sites=None):
+    '''Return the screening sites with record id ranges wide enough to hold n_subjects spread evenly across sites'''
+    if screening_sites is None:
+        screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
+    screening_sites = screening_sites.copy()
+    per_site = math.ceil(n_subjects / len(screening_sites))
+    capacity = (screening_sites['record_id_end'] - screening_sites['record_id_start'] + 1).min()
+    if per_site > capacity:
+        block = 10 ** math.ceil(math.log10(per_site))
+        screening_sites['record_id_start'] = (np.arange(len(screening_sites)) + 1) * block
+        screening_sites['record_id_end'] = screening_sites['record_id_start'] + block - 1
+    return screening_sites
+
+def format_dates(dates, missing, date_format=DATE_FORMAT):
+    return np.where(missing, None, dates.strftime(date_format).to_numpy(dtype=object))
+
+def generate_subjects_json(n_subjects, seed=0, end_date=None, screening_sites=None):
+    '''Generate subjects data for n_subjects in the {mcc: {record_id: {field: value}}} format of the
+    subjects-[mcc]-latest.json files. Screening dates run over the two years before end_date.
+    Returns the subjects json and the screening sites used to assign record ids.'''
+    rng = np.random.default_rng(seed)
+    end_date = end_date or datetime.combine(datetime.now().date(), datetime.min.time())
+    start_date = end_date - timedelta(days=730)
+    screening_sites = get_synthetic_screening_sites(n_subjects, screening_sites)
+
+    # Spread subjects evenly across sites
+    site_index = np.arange(n_subjects) % len(screening_sites)
+    site_offset = np.arange(n_subjects) // len(screening_sites)
+    record_ids = screening_sites['record_id_start'].to_numpy()[site_index] + site_offset
+    mccs = screening_sites['mcc'].to_numpy()[site_index]
+
+    # Screening
+    contact = pd.to_datetime(start_date) + pd.to_timedelta(rng.integers(0, 730, n_subjects), unit='D')
+    interest = rng.choice(['0', '1', '2', 'N/A', None], size=n_subjects, p=[.3, .2, .4, .05, .05])
+    declined = interest == '0'
+    consented = (interest == '2') & (rng.random(n_subjects) < .7)
+    n_consented = int(consented.sum())
+    first_reason = rng.integers(0, 6, n_subjects)
+    second_reason = (first_reason + rng.integers(1, 6, n_subjects)) % 6
+    reasons = np.where(rng.random(n_subjects) < .5, first_reason.astype(str),
+                       np.char.add(np.char.add(first_reason.astype(str), '|'), second_reason.astype(str)))
+    group_index = rng.integers(0, 3, n_subjects)
+
+    # Consented subjects
+    main_record_ids = np.full(n_subjects, None, dtype=object)
+    main_record_ids[consented] = (np.arange(n_consented) + 1000).astype(str)
+    obtain = contact + pd.to_timedelta(rng.integers(1, 30, n_subjects), unit='D')
+    surgery = obtain + pd.to_timedelta(rng.integers(5, 60, n_subjects), unit='D')
+    has_surgery = consented & ((surgery < pd.Timestamp(end_date)) | (rng.random(n_subjects) < .5))
+    terminated = consented & (rng.random(n_subjects) < .1)
+    termination = obtain + pd.to_timedelta(rng.integers(1, 200, n_subjects), unit='D')
+
+    subjects = {
+        'main_record_id': main_record_ids,
+        'redcap_data_access_group': np.where(mccs == 1, np.array(DATA_ACCESS_GROUPS[1])[group_index], np.array(DATA_ACCESS_GROUPS[2])[group_index]),
+        'sp_data_site': np.where(mccs == 2, rng.choice(['1', '2', '3', None], size=n_subjects), None),
+        'participation_interest': interest,
+        'reason_not_interested': np.where(declined, reasons.astype(object), None),
+        'ptinterest_comment': np.where(declined & (rng.random(n_subjects) < .5), 'Declined comment', None),
+        'date_of_contact': format_dates(contact, np.zeros(n_subjects, dtype=bool)),
+        'date_and_time': format_dates(contact, np.zeros(n_subjects, dtype=bool), DATETIME_FORMAT),
+        'obtain_date': format_dates(obtain, ~consented),
+        'sp_surg_date': format_dates(surgery, ~has_surgery),
+        'sp_v1_preop_date': format_dates(obtain + pd.Timedelta(days=3), ~consented),
+        'sp_v2_6wk_date': format_dates(surgery + pd.Timedelta(days=42), ~has_surgery),
+        'sp_v3_3mo_date': format_dates(surgery + pd.Timedelta(days=90), ~has_surgery),
+        'ewdateterm': format_dates(termination, ~terminated),
+        'ewprimaryreason': np.where(terminated, rng.integers(1, 5, n_subjects).astype(str), None),
+        'ewcomments': np.where(terminated, 'Early termination comment', None),
+        'start_v1_preop': np.where(consented, (rng.random(n_subjects) < .9).astype(int).astype(str), None),
+        'age': np.where(consented & (rng.random(n_subjects) < .8), rng.integers(18, 85, n_subjects).astype(str), None),
+        'dem_race': np.where(consented, rng.choice(['1', '2', '5', '1|5', None], size=n_subjects), None),
+        'ethnic': np.where(consented & (rng.random(n_subjects) < .8), rng.integers(1, 5, n_subjects).astype(str), None),
+        'sex': np.where(consented & (rng.random(n_subjects) < .8), rng.integers(1, 5, n_subjects).astype(str), None),
+        'screening_age': rng.integers(18, 85, n_subjects).astype(str),
+        'screening_race': rng.integers(0, 7, n_subjects).astype(str),
+        'screening_ethnicity': rng.integers(0, 3, n_subjects).astype(str),
+        'screening_gender': rng.integers(1, 5, n_subjects).astype(str),
+        'sp_mricompatscr': rng.choice(['4', '4', '4', '1'], size=n_subjects),
+    }
+    for col in VISIT_COLS:
+        subjects[col] = np.where(consented, (rng.random(n_subjects) < .5).astype(int).astype(str), None)
+    for col in ELIGIBILITY_COLS:
+        subjects[col] = (rng.random(n_subjects) < (.9 if 'incl' in col else .1)).astype(int).astype(str)
+
+    # Adverse events and protocol deviations for consented subjects
+    n_events = np.where(consented, rng.integers(0, 4, n_subjects), 0)
+    adverse_effects = [generate_adverse_effects(rng, n, o) if n else None for n, o in zip(n_events, obtain)]
+
+    fields = list(subjects.keys())
+    columns = [list(subjects[f]) for f in fields]
+    subjects_json = {int(m): {} for m in np.unique(mccs)}
+    for i, row in enumerate(zip(*columns)):
+        record = dict(zip(fields, row))
+        record['adverse_effects'] = adverse_effects[i]
+        subjects_json[int(mccs[i])][str(record_ids[i])] = record
+
+    return subjects_json, screening_sites
+
+def generate_adverse_effects(rng, n_events, obtain_date):
+    '''Generate the nested adverse_effects instances for one subject, about half of them protocol deviations'''
+    events = {}
+    for instance in range(1, n_events + 1):
+        event_date = obtain_date + timedelta(days=int(rng.integers(0, 400)))
+        if rng.random() < .5:
+            event = {'erep_local_dtime': event_date.strftime(DATETIME_FORMAT),
+                     'erep_protdev_type': str(rng.integers(1, 8)),
+                     'erep_protdev_desc': 'Deviation description', 'erep_protdev_caplan': 'Corrective action',
+                     'erep_ae_yn': '0', 'erep_ae_relation': None, 'erep_ae_severity': None, 'erep_ae_serious': None,
+                     'erep_onset_date': None, 'erep_ae_desc': None, 'erep_action_taken': None, 'erep_outcome': None}
+        else:
+            event = {'erep_local_dtime': None, 'erep_protdev_type': None,
+                     'erep_protdev_desc': None, 'erep_protdev_caplan': None,
+                     'erep_ae_yn': '1', 'erep_ae_relation': str(rng.integers(1, 4)),
+                     'erep_ae_severity': str(rng.integers(1, 4)), 'erep_ae_serious': str(rng.integers(0, 2)),
+                     'erep_onset_date': event_date.strftime(DATE_FORMAT), 'erep_ae_desc': 'Adverse event description',
+                     'erep_action_taken': 'Action taken', 'erep_outcome': 'Outcome'}
+        events[str(instance)] = event
+    return events
+
+# ----------------------------------------------------------------------------
+# DATASTORE PAYLOAD
+# ----------------------------------------------------------------------------
+
+def get_api_payload_json(subjects, consented, adverse_events):
+    '''Serialize cleaned frames the way the datastore /api/subjects endpoint returns them'''
+    frames = [('subjects_cleaned', subjects), ('adverse_events', adverse_events), ('consented', consented)]
+    data = ', '.join('"{0}": {1}'.format(name, df.to_json(orient='records', date_format='iso')) for name, df in frames)
+    return ('{"data": {' + data + '}}').encode()
@@ -5,23 +5,32 @@ import traceback
 
 # Dash Framework
 import dash_bootstrap_components as dbc
-from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL
+from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL, no_update
 from dash.exceptions import PreventUpdate
 import dash_daq as daq
 
 from dash_extensions import Download
-from dash_extensions.snippets import send_file
+import xlsxwriter
 
 # import local modules
 from config_settings import *
 from datastore_loading import *
 from data_processing import *
+from report_cache import *
+from report_refresher import *
+from single_flight import *
+from payload_archive import *
+from report_metrics import *
+from html_export import *
 from styling import *
 
 # for export
 import logging
 import io
+import base64
+import concurrent.futures
 import flask
+from datetime import date
 
 # Plotly graphing
 import plotly.graph_objects as go
@@ -48,6 +57,17 @@ app.logger = logging.getLogger("weekly_ui")
 app.logger.handlers = gunicorn_logger.handlers
 app.logger.setLevel(logging.INFO)
 
+# Parsed report data and the tables and content of each section built from it, keyed by (data version, report date),
+# so page loads and tab callbacks reuse work while the data is unchanged
+tables_cache = ReportCache(REPORT_CACHE_TTL, REPORT_CACHE_MAX_ENTRIES)
+# Tables by the signature of their inputs, so a new data version only recomputes tables whose inputs changed
+table_memo = ReportCache(REPORT_CACHE_TTL, REPORT_CACHE_MAX_ENTRIES * len(TABLE_TASKS))
+# Report data and section tables built by one worker and loaded by the others, so concurrent page loads after
+# a data change build the report once per host rather than once per worker
+report_flight = SingleFlight(REPORT_SHARED_DIR, REPORT_CACHE_TTL, REPORT_BUILD_WAIT)
+# Frames of every payload version received, reloaded instead of parsed on cold starts and available offline
+payload_archive = PayloadArchive(PAYLOAD_ARCHIVE_DIR, PAYLOAD_ARCHIVE_MAX_VERSIONS)
+
 
 # ----------------------------------------------------------------------------
 # POINTERS TO DATA FILES AND APIS
@@ -66,13 +86,16 @@ mcc_list=[1,2]
 # FUNCTIONS FOR DASH UI COMPONENTS
 # ----------------------------------------------------------------------------
 def build_datatable_from_table_dict(table_dict, key, table_id, fill_width = False):
+    ''' Build the DataTable for one table of the tables dict. The table data is sent in a store in compact
+    column oriented form, and expanded to records for the DataTable in the browser by expand_table_data.'''
     try:
         table_columns = table_dict[key]['columns_list']
         table_data = table_dict[key]['data']
+        table_store = dcc.Store(id = {'type': 'report_table_data', 'index': table_id}, data=table_data)
         new_datatable =  dt.DataTable(
-                id = table_id,
+                id = {'type': 'report_table', 'index': table_id},
                 columns=table_columns,
-                data=table_data,
+                data=[],
                 css=[{'selector': '.row', 'rule': 'margin: 0; flex-wrap: nowrap'},
                      {'selector':'.export','rule':export_style }
                     # {'selector':'.export','rule':'position:absolute;right:25px;bottom:-35px;font-family:Arial, Helvetica, sans-serif,border-radius: .25re'}
@@ -98,38 +121,29 @@ def build_datatable_from_table_dict(table_dict, key, table_id, fill_width = Fals
                 # export_format="csv",
                 merge_duplicate_headers=True,
             )
-        return new_datatable
+        return [table_store, new_datatable]
     except Exception as e:
         traceback.print_exc()
         return None
 
 def generate_enrollment_figure(df, x_col, bar_col, line_col, title):
-    fig = go.Figure()
-
-    fig.add_trace(
-        go.Bar(
-            x = df[x_col],
-            y= df[bar_col],
-            name= bar_col
-        ))
-
-    fig.add_trace(
-        go.Scatter(
-            x = df[x_col],
-            y= df[line_col],
-            name = line_col
-        ))
-
-    fig.update_layout(
-        legend=dict(
-            yanchor="bottom",
-            y=0.02,
-            xanchor="right",
-            x=.98
-        ),
-        yaxis_title=title,
-        margin=dict(l=20, r=20, t=0, b=20),
-                     )
+    ''' Bar chart of bar_col with a line of line_col. The figure is built as a plain dict rather than a go.Figure,
+    which skips plotly's validation, and is kept with the cached section content.'''
+    def column_values(col):
+        return df[col].astype(object).where(df[col].notna(), None).tolist()
+
+    x = column_values(x_col)
+    fig = {
+        'data': [
+            {'type': 'bar', 'x': x, 'y': column_values(bar_col), 'name': bar_col},
+            {'type': 'scatter', 'x': x, 'y': column_values(line_col), 'name': line_col},
+        ],
+        'layout': {
+            'legend': {'yanchor': 'bottom', 'y': 0.02, 'xanchor': 'right', 'x': .98},
+            'yaxis': {'title': {'text': title}},
+            'margin': {'l': 20, 'r': 20, 't': 0, 'b': 20},
+        },
+    }
     return fig
 
 def generate_site_info(enrollment, site, id_index, table_display = 'none'):
@@ -157,8 +171,8 @@ def generate_site_div(site, df, id_index, table_display = 'none'):
     # df = get_site_enrollment(enrollment, site)
 
     # Figures
-    fig_monthly = generate_enrollment_figure(df, 'study_month', 'Actual: Monthly', 'Expected: Monthly', "Monthly Enrollment")
-    fig_cumulative = generate_enrollment_figure(df, 'study_month', 'Actual: Cumulative', 'Expected: Cumulative', "Cumulative Enrollment")
+    fig_monthly = generate_enrollment_figure(df, 'Month: Study', 'Actual: Monthly', 'Expected: Monthly', "Monthly Enrollment")
+    fig_cumulative = generate_enrollment_figure(df, 'Month: Study', 'Actual: Cumulative', 'Expected: Cumulative', "Cumulative Enrollment")
 
     # Datatable
     df_mi = convert_to_multindex(df, delimiter = ': ')
@@ -204,31 +218,19 @@ def generate_site_div(site, df, id_index, table_display = 'none'):
 # ----------------------------------------------------------------------------
 
 
-def build_tables_dict(table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age):
-    tables_names = ("table1a", "table1b", "table2a", "table2b", "table3a", "table3b","table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age")
-    excel_sheet_names = ("Screened_site","Screened_MCC", "Decline_Reasons", "Decline_Comments", "Consent_site","Consent_mcc", "Study_Status", "Rescinded_Consent", "Early_Termination", "Protocol_Deviations", "Protocol_Deviations_Description",
+tables_names = ("table1a", "table1b", "table2a", "table2b", "table3a", "table3b","table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age")
+excel_sheet_names = ("Screened_site","Screened_MCC", "Decline_Reasons", "Decline_Comments", "Consent_site","Consent_mcc", "Study_Status", "Rescinded_Consent", "Early_Termination", "Protocol_Deviations", "Protocol_Deviations_Description",
     "Adverse_Events", "Adverse_Events_Description", "Gender", "Race", "Ethnicity", "Age")
+excel_sheet_names_dict = dict(zip(tables_names, excel_sheet_names))
 
-    tables = (table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age)
-
+def build_tables_dict(*tables, tables_names=tables_names):
+    '''Build the datatable settings for each table. tables_names gives the name of each table passed,
+    by default all the tables of the report in order.'''
     tables_dict = {}
 
-    for i in range(0,len(tables_names)):
-        table_name = tables_names[i]
-        excel_sheet_name = excel_sheet_names[i]
-        data_source = tables[i]
-        columns_list, datatable_data = datatable_settings_multiindex(data_source)
-
-        # if(data_source.columns.nlevels == 2):
-        #     columns_list = []
-        #     for i in data_source.columns:
-        #         col_id = i[0] + ':' + i[1]
-        #         columns_list.append({"name": [i[0],i[1]], "id": col_id})
-        #     data_source.columns = data_source.columns.droplevel()
-        # else:
-        #     columns_list = [{"name": i, "id": i} for i in data_source.columns]
-
-
+    for table_name, data_source in zip(tables_names, tables):
+        excel_sheet_name = excel_sheet_names_dict[table_name]
+        columns_list, datatable_data = datatable_settings_multiindex(data_source, orient = 'columns')
 
         tables_dict[table_name] = {'excel_sheet_name': excel_sheet_name,
                                     'columns_list': columns_list,
@@ -239,8 +241,7 @@ def build_tables_dict(table1a, table1b, table2a, table2b, table3a, table3b, tabl
 
     return tables_dict
 
-def build_content(tables_dict, page_meta_dict):
-
+def build_section1(tables_dict, page_meta_dict):
     report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section1 = html.Div([
@@ -311,6 +312,10 @@ def build_content(tables_dict, page_meta_dict):
             ]),
         ),
     ])
+    return section1
+
+def build_section2(tables_dict, page_meta_dict):
+    report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section2 = html.Div([
         dbc.Card([
@@ -334,6 +339,10 @@ def build_content(tables_dict, page_meta_dict):
             html.Div(build_datatable_from_table_dict(tables_dict, 'table6', 'table_6')),
         ],body=True),
     ])
+    return section2
+
+def build_section3(tables_dict, page_meta_dict):
+    report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section3 = html.Div([
         dbc.Card([
@@ -370,6 +379,10 @@ def build_content(tables_dict, page_meta_dict):
             html.Div(build_datatable_from_table_dict(tables_dict, 'table8b', 'table_8b')),
         ],body=True),
     ])
+    return section3
+
+def build_section4(tables_dict, page_meta_dict):
+    report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section4 = html.Div([
         dbc.Card([
@@ -385,8 +398,28 @@ def build_content(tables_dict, page_meta_dict):
             html.Div(build_datatable_from_table_dict(tables_dict, 'age', 'table_9d')),
         ],body=True),
     ])
+    return section4
 
-    return section1, section2, section3, section4
+def build_section5(site_enrollment, page_meta_dict):
+    report_date_msg = page_meta_dict['report_date_msg']
+
+    section5 = html.Div([
+        dbc.Card([
+            html.H5('Enrollment by Site'),
+            html.Div([report_date_msg, '. Actual and expected enrollment by study month of each screening site']),
+        ],body=True),
+        html.Div([generate_site_div(site, df, index) for index, (site, df) in enumerate(site_enrollment.items())]),
+    ])
+    return section5
+
+section_builders = {'section1': build_section1, 'section2': build_section2, 'section3': build_section3, 'section4': build_section4}
+# Sections of the page: the table sections plus enrollment, which is built from the enrollment data instead of tables
+page_sections = list(section_builders) + ['section5']
+section_titles = {'section1': 'Screening', 'section2': 'Study Status', 'section3': 'Deviations & Adverse Events',
+                  'section4': 'Demographics', 'section5': 'Enrollment'}
+
+def build_content(tables_dict, page_meta_dict):
+    return tuple(build_section(tables_dict, page_meta_dict) for build_section in section_builders.values())
 
 # def get_sections_dict_for_store(section1, section2, section3, section4):
 #     sections_dict = {}
@@ -434,103 +467,490 @@ def build_page_layout(toggle_view_value, sections_dict):
     section2 = sections_dict['section2']
     section3 = sections_dict['section3']
     section4 = sections_dict['section4']
+    section5 = sections_dict['section5']
 
     if toggle_view_value:
-        page_layout = [html.H3('Screening'), section1, html.H3('Study Status'), section2, html.H3('Deviations & Adverse Events'), section3, html.H3('Demographics'), section4]
+        page_layout = [component for section in page_sections for component in (html.H3(section_titles[section]), sections_dict[section])]
     else:
+        # Tab sections start empty and are filled by load_tab_section when each tab is first opened
         page_layout = html.Div([
-                    dcc.Tabs(id='tabs_tables', children=[
-                        dcc.Tab(label='Screening', children=[
+                    dcc.Store(id='store_loaded_sections', data = []),
+                    dcc.Tabs(id='tabs_tables', value='section1', children=[
+                        dcc.Tab(label='Screening', value='section1', children=[
                             html.Div([section1], id='section_1'),
                         ]),
-                        dcc.Tab(label='Study Status', children=[
+                        dcc.Tab(label='Study Status', value='section2', children=[
                             html.Div([section2], id='section_2'),
                         ]),
-                        dcc.Tab(label='Deviations & Adverse Events', children=[
+                        dcc.Tab(label='Deviations & Adverse Events', value='section3', children=[
                             html.Div([section3], id='section_3'),
                         ]),
-                        dcc.Tab(label='Demographics', children=[
+                        dcc.Tab(label='Demographics', value='section4', children=[
                             html.Div([section4], id='section_4'),
                         ]),
+                        dcc.Tab(label='Enrollment', value='section5', children=[
+                            html.Div([section5], id='section_5'),
+                        ]),
                     ]),
                     ])
     return page_layout
 
-def serve_layout():
-    page_meta_dict, tables_dict, sections_dict, enrollment_dict = {'report_date_msg':''}, {}, {}, {}
-    report_date = datetime.now()
+# ----------------------------------------------------------------------------
+# REPORT DATA
+# ----------------------------------------------------------------------------
+# Columns of each payload frame read by the report: requested from the datastore where it supports selecting
+# fields, and the only columns built when the payload is parsed
+report_columns = get_report_columns()
+PAYLOAD_COLUMNS = {'subjects_cleaned': report_columns['subjects'], 'adverse_events': report_columns['adverse_events']}
+PAYLOAD_FIELDS = sorted(set(report_columns['subjects']) | set(report_columns['adverse_events']))
+
+def get_page_meta(report_date):
+    ''' Messages shown on the page for a report generated at report_date'''
+    page_meta_dict = {}
+    today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_date)
+
+    if DATA_SOURCE == 'api':
+        page_meta_dict['report_date_msg'] = report_date_msg
+    elif DATA_SOURCE == 'local':
+        page_meta_dict['report_date_msg'] = 'Report generated from archived data dated ' + local_data_date
+    else:
+        page_meta_dict['report_date_msg'] = 'Data date unclear'
+    page_meta_dict['report_range_msg'] = report_range_msg
+    return page_meta_dict
+
+def check_api_status(api_status):
+    ''' Log datastore errors, raising PortalAuthException if the user needs to authenticate'''
+    if 'error' in api_status:
+        app.logger.info('Error response from datastore: {0}'.format(api_status))
+        if 'error_code' in api_status:
+            error_code = api_status['error_code']
+            if error_code in ('MISSING_SESSION_ID', 'INVALID_TAPIS_TOKEN'):
+                raise PortalAuthException
+
+def get_report_data(report_date, data_version=None):
+    ''' Get the report data for report_date: the parsed datastore frames and time parameters, plus the tables
+    and content of each section as they are built. The data is always requested from the datastore with the
+    user's session first, so that only users the datastore authorizes get report data; unchanged data is only
+    revalidated. If the data_version the page was loaded with is still cached it is then served, so the tabs
+    of a page show the same data, otherwise the version the datastore returned.
+    When the background refresher is running and has a report ready for the day, new data versions are left
+    to the refresher and the ready report is served meanwhile, but only once the user's own request has
+    returned data: a user the datastore does not authorize never gets the refresher's report.
+    Returns the data version and report data, or None, None if no data is available.'''
+    page_data_version = data_version
+    report_refresher.start()
+    latest = latest_report.get('current')
+    if latest is not None and latest[2] != report_date.date():
+        latest = None
+
+    # Get data from API
+    api_address = DATASTORE_URL + 'subjects'
+    app.logger.info('Requesting data from api {0}'.format(api_address))
+    with report_metrics.timer('stage_seconds', stage='datastore_fetch'):
+        api_status, payload, data_version = get_api_payload(api_address, fields=PAYLOAD_FIELDS)
+    check_api_status(api_status)
+
+    if not data_version or 'data' not in api_status:
+        # If data is not available, try with bypassing cache and see if that works.
+        app.logger.info('Requesting data from api {0} to bypass cache.'.format(api_address))
+        with report_metrics.timer('stage_seconds', stage='datastore_fetch'):
+            api_status, payload, data_version = get_api_payload(api_address, True, fields=PAYLOAD_FIELDS)
+
+    if not data_version or 'data' not in api_status:
+        return None, None
+
+    # The datastore has authorized the user, so the handle of their page can select the cached version to serve
+    if page_data_version:
+        report_data = tables_cache.get((page_data_version, report_date.date()))
+        if report_data is not None:
+            return page_data_version, report_data
+
+    # Reuse the report data for this version of the data if available
+    cache_key = (data_version, report_date.date())
+    report_data = tables_cache.get(cache_key)
+    if report_data is not None:
+        app.logger.info('Using cached report data for data version {0}'.format(data_version))
+        return data_version, report_data
+
+    if latest is not None:
+        app.logger.info('New data version {0}, serving data version {1} while the refresher builds it'.format(data_version, latest[0]))
+        report_refresher.wake()
+        return latest[0], latest[1]
+
+    if payload is None and not payload_archive.find(data_version):
+        # The data is unchanged since it was last requested, but its report for this date is not cached
+        with report_metrics.timer('stage_seconds', stage='datastore_fetch'):
+            api_status, payload, data_version = get_api_payload(api_address, fields=PAYLOAD_FIELDS, revalidate=False)
+        if not payload or 'data' not in api_status:
+            return None, None
+        cache_key = (data_version, report_date.date())
+
+    report_data = get_shared_report_data(payload, report_date, data_version)
+    if data_version:
+        tables_cache.set(cache_key, report_data)
+    return data_version, report_data
+
+def get_shared_report_data(payload, report_date, data_version):
+    ''' Build the report data for a data version, or load it if another worker has built it'''
+    if not data_version:
+        return build_report_data(payload, report_date)
+    shared_key = 'report_{0}_{1}'.format(data_version, report_date.date())
+    report_data = report_flight.do(shared_key, lambda: build_report_data(payload, report_date, data_version))
+    report_data['shared_key'] = shared_key
+    return report_data
+
+def get_payload_frames(payload, data_version=None):
+    ''' The frames of a datastore payload, with their dates converted. A data version in the payload archive is
+    loaded from it instead of parsed (payload may then be None), and new versions are added to the archive.'''
+    if data_version:
+        with report_metrics.timer('stage_seconds', stage='archive_load'):
+            payload_frames = payload_archive.load(data_version, PAYLOAD_COLUMNS)
+        if payload_frames is not None:
+            app.logger.info('Loaded data version {0} from the payload archive'.format(data_version))
+            return payload_frames
+    if payload is None:
+        raise Exception('Data version {0} is not in the payload archive'.format(data_version))
+
+    with report_metrics.timer('stage_seconds', stage='json_parse'):
+        payload_frames = parse_payload_frames(payload, frame_columns=PAYLOAD_COLUMNS)
+    report_metrics.set('payload_bytes', len(payload))
+
+    # Convert datetime columns once, then take consented as the subset of subjects rather than parsing a copy
+    with report_metrics.timer('stage_seconds', stage='datetime_conversion'):
+        payload_frames['subjects_cleaned'] = convert_datetime_columns(payload_frames['subjects_cleaned'], 'subjects')
+        payload_frames['adverse_events'] = convert_datetime_columns(payload_frames['adverse_events'], 'adverse_events')
+
+    if data_version:
+        with report_metrics.timer('stage_seconds', stage='archive_save'):
+            payload_archive.save(data_version, payload_frames)
+    return payload_frames
+
+def build_report_data(payload, report_date, data_version=None):
+    ''' Parse the datastore payload into the report data for report_date. Section tables and content are
+    added to the report data as they are built.'''
+    today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_date)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+
+    payload_frames = get_payload_frames(payload, data_version)
+    subjects = payload_frames['subjects_cleaned']
+    adverse_events = payload_frames['adverse_events']
+    consented = get_consented_subjects(subjects).reset_index(drop=True)
+
+    for frame_name, frame in [('subjects_cleaned', subjects), ('adverse_events', adverse_events), ('consented', consented)]:
+        report_metrics.set('rows', len(frame), frame=frame_name)
+
+    screening_centers_df, centers_df = get_centers(subjects, consented, display_terms)
+
+    # Report data is kept in every worker's cache, so hold the frames in compact dtypes
+    with report_metrics.timer('stage_seconds', stage='normalize_dtypes'):
+        subjects = normalize_dtypes(subjects, 'subjects')
+        consented = normalize_dtypes(consented, 'consented')
+        adverse_events = normalize_dtypes(adverse_events, 'adverse_events')
+
+    report_data = {
+        'table_inputs': get_table_inputs(today, start_report, end_report, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df),
+        'frames': {},
+        'tables': {},
+        'content': {},
+        'excel': None,
+    }
+    return report_data
+
+def get_report_sections_tables(report_data, sections):
+    ''' Compute the tables of any of the sections not yet built, together so that they share one task graph.
+    Tables of shared report data are built once across workers.'''
+    missing = [section for section in sections if section not in report_data['tables']]
+    if not missing:
+        return
+
+    def build():
+        sections_tables = get_sections_tables(missing, report_data['table_inputs'], table_memo)
+        built = {}
+        for section, section_tables in sections_tables.items():
+            with report_metrics.timer('stage_seconds', stage='build_tables_dict'):
+                tables_dict = build_tables_dict(*section_tables, tables_names=SECTION_TABLES[section])
+            built[section] = (dict(zip(SECTION_TABLES[section], section_tables)), tables_dict)
+        return built
+
+    shared_key = report_data.get('shared_key')
+    if shared_key:
+        built = report_flight.do('{0}_tables_{1}'.format(shared_key, '_'.join(missing)), build)
+    else:
+        built = build()
+    for section, (frames, tables_dict) in built.items():
+        report_data['frames'][section] = frames
+        report_data['tables'][section] = tables_dict
+
+def get_report_section_tables(report_data, section):
+    ''' Get the tables dict for one section, computing the section's tables on first use'''
+    get_report_sections_tables(report_data, [section])
+    return report_data['tables'][section]
+
+def get_report_tables(report_data):
+    ''' Get the tables dict for all sections of the report'''
+    get_report_sections_tables(report_data, SECTION_TABLES)
+    tables_dict = {}
+    for section in SECTION_TABLES:
+        tables_dict.update(report_data['tables'][section])
+    return tables_dict
 
-    try:
-        # TO DO: CONVERT THIS TO ALWAYS PULL DATA FROM DATASTORE
-    # get data for page
-    # print('time parameters')
-        today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_date)
-
-        if DATA_SOURCE == 'api':
-            page_meta_dict['report_date_msg'] = report_date_msg
-        elif DATA_SOURCE == 'local':
-            page_meta_dict['report_date_msg'] = 'Report generated from archived data dated ' + local_data_date
-        else:
-            page_meta_dict['report_date_msg'] = 'Data date unclear'
-        page_meta_dict['report_range_msg'] = report_range_msg
-        # print('get data inputs')
-
-        # TO DO: CONVERT TO PULL THESES FROM GITHUB
-        # display_terms, display_terms_dict, display_terms_dict_multi, clean_weekly, consented, screening_data, clean_adverse, centers_df, r_status = get_data_for_page(ASSETS_PATH, display_terms_file, file_url_root, report, report_suffix, mcc_list)
-        display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
-        screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
-
-        # Get data from API
-        api_address = DATASTORE_URL + 'subjects'
-        app.logger.info('Requesting data from api {0}'.format(api_address))
-        api_json = get_api_data(api_address)
-
-        # subjects_json = get_subjects_json(report, report_suffix, file_url_root, source=DATA_SOURCE)
-        if 'error' in api_json:
-            app.logger.info('Error response from datastore: {0}'.format(api_json))
-            if 'error_code' in api_json:
-                error_code = api_json['error_code']
-                if error_code in ('MISSING_SESSION_ID', 'INVALID_TAPIS_TOKEN'):
-                    raise PortalAuthException
+# ----------------------------------------------------------------------------
+# EXCEL EXPORT
+# ----------------------------------------------------------------------------
+def get_excel_column_name(col):
+    ''' Excel header for a flattened datatable column: multiindex levels are joined with ': ' and
+    a leading '_' from an empty top level is removed. Multiindex columns not yet flattened are flattened first.'''
+    if isinstance(col, tuple):
+        col = '_'.join(col)
+    if col[0] == '_':
+        return col[1:]
+    return col.replace('_',': ')
+
+def build_excel_workbook(report_data):
+    ''' Write every table of the report to an xlsx workbook, one sheet per table, and return the file content'''
+    get_report_tables(report_data)
+    return write_excel_workbook({table_name: df for section in SECTION_TABLES for table_name, df in report_data['frames'][section].items()})
+
+def write_excel_workbook(frames):
+    ''' Write the table frames of a report, a dict of table name to dataframe, to an xlsx workbook with one sheet
+    per table and return the file content. Rows are streamed to the workbook in constant memory mode rather than
+    built up as a DataFrame per sheet.'''
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+
+    # Match the header and date formats of DataFrame.to_excel
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    date_format = workbook.add_format({'num_format': 'YYYY-MM-DD'})
+    datetime_format = workbook.add_format({'num_format': 'YYYY-MM-DD HH:MM:SS'})
+
+    for section, section_tables in SECTION_TABLES.items():
+        for table_name in section_tables:
+            df = frames[table_name]
+            worksheet = workbook.add_worksheet(excel_sheet_names_dict[table_name])
+            if len(df) == 0:
+                worksheet.write_row(0, 0, ['No data for this table'], header_format)
+                continue
+
+            worksheet.write_row(0, 0, [get_excel_column_name(col) for col in df.columns], header_format)
+            rows = df.astype(object).where(df.notna(), None).values.tolist()
+            for row_number, row in enumerate(rows, start=1):
+                for col_number, value in enumerate(row):
+                    if isinstance(value, datetime):
+                        worksheet.write_datetime(row_number, col_number, value, datetime_format)
+                    elif isinstance(value, date):
+                        worksheet.write_datetime(row_number, col_number, value, date_format)
+                    elif value is not None:
+                        worksheet.write(row_number, col_number, value)
+
+    workbook.close()
+    return output.getvalue()
+
+def get_excel_filename(report_date):
+    return report_date.strftime('%Y_%m_%d') + '_a2cps_weekly_report_data.xlsx'
 
-        # If data is not available, try with bypassing cache and see if that works.
-        if not api_json or 'data' not in api_json:
-            app.logger.info('Requesting data from api {0} to bypass cache.'.format(api_address))
-            api_json = get_api_data(api_address, True)
+# ----------------------------------------------------------------------------
+# HTML EXPORT
+# ----------------------------------------------------------------------------
+def build_report_html(sections_content, page_meta_dict):
+    ''' Static html of the report, with the content of every section on one page as in the single page view'''
+    body = [html.H2('A2CPS Weekly Report'), html.H5(page_meta_dict['report_date_msg'])]
+    for section in page_sections:
+        body += [html.H3(section_titles[section]), sections_content[section]]
+    return render_html_page('A2CPS Weekly Report', body, external_stylesheets_list)
 
-        if api_json:
-            subjects = pd.DataFrame.from_dict(api_json['data']['subjects_cleaned'])
-            adverse_events = pd.DataFrame.from_dict(api_json['data']['adverse_events'])
-            consented = pd.DataFrame.from_dict(api_json['data']['consented'])
+def get_html_filename(report_date):
+    return report_date.strftime('%Y_%m_%d') + '_a2cps_weekly_report.html'
 
-            # Convert datetime columns
-            datetime_cols_list = ['date_of_contact','date_and_time','obtain_date','ewdateterm','sp_surg_date','sp_v1_preop_date','sp_v2_6wk_date','sp_v3_3mo_date']
-            subjects[datetime_cols_list] = subjects[datetime_cols_list].apply(pd.to_datetime, errors='coerce')
-            consented[datetime_cols_list] = consented[datetime_cols_list].apply(pd.to_datetime, errors='coerce')
+# ----------------------------------------------------------------------------
+# REPORT EDITIONS
+# ----------------------------------------------------------------------------
+def get_edition_page_meta(end_report, report_days_range=7):
+    ''' Messages shown on the edition of the report for end_report, as if it was generated on that date'''
+    report_date_msg = 'This report generated on: ' + str(end_report.date())
+    report_range_msg = report_date_msg + ' covering the previous ' + str(report_days_range) + ' days.'
+    return {'report_date_msg': report_date_msg, 'report_range_msg': report_range_msg}
+
+def get_edition_sections_content(frames, consented, end_report):
+    ''' The content of every section of the edition for end_report, built from its table frames'''
+    page_meta_dict = get_edition_page_meta(end_report)
+    sections_content = {}
+    for section, build_section in section_builders.items():
+        # Datatable settings flatten multiindex columns in place, and editions share the frames of undated tables
+        section_frames = [frames[table_name].copy(deep=False) for table_name in SECTION_TABLES[section]]
+        sections_content[section] = build_section(build_tables_dict(*section_frames, tables_names=SECTION_TABLES[section]), page_meta_dict)
+    sections_content['section5'] = build_section5(get_site_enrollment_tables(consented, end_report), page_meta_dict)
+    return sections_content
+
+def write_report_edition(end_report, frames, consented, output_dir, formats=('xlsx',)):
+    ''' Write the edition of the report for end_report, from its table frames, to output_dir as an excel workbook
+    ('xlsx') and/or a static html page ('html'). Returns the paths written.'''
+    paths = []
+    if 'xlsx' in formats:
+        path = os.path.join(output_dir, get_excel_filename(end_report))
+        with report_metrics.timer('stage_seconds', stage='excel_export'):
+            workbook = write_excel_workbook(frames)
+        with open(path, 'wb') as f:
+            f.write(workbook)
+        paths.append(path)
+    if 'html' in formats:
+        path = os.path.join(output_dir, get_html_filename(end_report))
+        with report_metrics.timer('stage_seconds', stage='html_export'):
+            report_html = build_report_html(get_edition_sections_content(frames, consented, end_report), get_edition_page_meta(end_report))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(report_html)
+        paths.append(path)
+    return paths
+
+# Frames of the editions by report date and the consented frame, set once in each process of the editions pool
+pool_editions = None
+
+def init_editions_process(end_reports, editions, consented):
+    ''' Keep the frames shared by all editions in the pool process, so tasks only pass their report date'''
+    global pool_editions
+    pool_editions = (dict(zip(end_reports, editions)), consented)
+
+def write_pool_report_edition(end_report, output_dir, formats=('xlsx',)):
+    ''' Write the edition for end_report in a process of the editions pool, from the frames it was started with'''
+    editions_frames, consented = pool_editions
+    return write_report_edition(end_report, editions_frames[end_report], consented, output_dir, formats)
+
+def build_report_editions(payload, end_reports, output_dir, data_version=None, formats=('xlsx',), processes=1):
+    ''' Write the report for each of end_reports, as generated on that date from the data of the payload, to
+    output_dir in each of formats. The payload is parsed once (or loaded from the payload archive if data_version
+    is archived) and the tables of all editions computed together. The files of each edition are written by a
+    pool of processes, or one after another with processes=1. Returns the paths written.'''
+    report_data = build_report_data(payload, max(end_reports), data_version)
+    with report_metrics.timer('stage_seconds', stage='report_editions'):
+        editions = get_report_editions(end_reports, report_data['table_inputs'])
+    consented = report_data['table_inputs']['consented']
+
+    os.makedirs(output_dir, exist_ok=True)
+    if processes > 1 and len(end_reports) > 1:
+        # The frames go to each process once, when it starts, rather than with every edition
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_editions_process,
+                                                    initargs=(end_reports, editions, consented)) as executor:
+            futures = [executor.submit(write_pool_report_edition, end_report, output_dir, formats)
+                       for end_report in end_reports]
+            editions_paths = [future.result() for future in futures]
+    else:
+        editions_paths = [write_report_edition(end_report, frames, consented, output_dir, formats)
+                          for end_report, frames in zip(end_reports, editions)]
+    return [path for paths in editions_paths for path in paths]
+
+def get_report_site_enrollment(report_data):
+    ''' Get the actual and expected enrollment of each site, computing it on first use'''
+    site_enrollment = report_data.get('site_enrollment')
+    if site_enrollment is None:
+        table_inputs = report_data['table_inputs']
+        with report_metrics.timer('stage_seconds', stage='site_enrollment'):
+            site_enrollment = get_site_enrollment_tables(table_inputs['consented'], table_inputs['today'])
+        report_data['site_enrollment'] = site_enrollment
+    return site_enrollment
+
+def get_report_section_content(report_data, section, report_date):
+    ''' Get the content of one section, building the section's tables (or enrollment data) and content on first use'''
+    content = report_data['content'].get(section)
+    if content is None:
+        if section == 'section5':
+            site_enrollment = get_report_site_enrollment(report_data)
+            with report_metrics.timer('stage_seconds', stage='build_content'):
+                content = build_section5(site_enrollment, get_page_meta(report_date))
+        else:
+            tables_dict = get_report_section_tables(report_data, section)
+            with report_metrics.timer('stage_seconds', stage='build_content'):
+                content = section_builders[section](tables_dict, get_page_meta(report_date))
+        report_data['content'][section] = content
+    return content
+
+def get_section_content(section, report_handle):
+    ''' Build (or get from cache) the content of one section for the page described by report_handle, the
+    report date and data version the page was loaded with'''
+    try:
+        report_date = datetime.fromisoformat(report_handle['report_date'])
+        data_version, report_data = get_report_data(report_date, report_handle.get('data_version'))
+        if report_data is None:
+            return html.Div("The data for this report is not available at this time.  Please try again later.")
+        if data_version != report_handle.get('data_version'):
+            app.logger.info('Data changed since page load, building {0} from data version {1}'.format(section, data_version))
+
+        with report_metrics.timer('stage_seconds', stage='section_content'):
+            return get_report_section_content(report_data, section, report_date)
+    except PortalAuthException:
+        app.logger.warn('Auth error from datastore, asking user to authenticate')
+        return html.Div([html.H4('Please login and authenticate on the portal to access the report.')])
+    except Exception as e:
+        traceback.print_exc()
+        return html.Div(['There has been a problem accessing the data for this Report.'])
 
-            # print('subjects_json')
-            screening_centers_df, centers_df = get_centers(subjects, consented, display_terms)
+# ----------------------------------------------------------------------------
+# BACKGROUND REFRESH
+# ----------------------------------------------------------------------------
+# The latest report built by the refresher, as (data version, report data, report date), replaced in one assignment
+latest_report = {}
+
+def get_refresh_cookies():
+    ''' The service cookies of REPORT_REFRESH_COOKIES as a dict, or None if none are configured'''
+    if REPORT_REFRESH_COOKIES:
+        return dict(cookie.strip().split('=', 1) for cookie in REPORT_REFRESH_COOKIES.split(';') if '=' in cookie)
+    return None
+
+def refresh_report():
+    ''' Poll the datastore and, when the data has changed, build every section of the report for it before
+    swapping it in as the latest report. Returns True if a new report was built.'''
+    cookies = get_refresh_cookies()
+    if not cookies:
+        return False
+
+    api_address = DATASTORE_URL + 'subjects'
+    with report_metrics.timer('stage_seconds', stage='datastore_fetch'):
+        api_status, payload, data_version = datastore_client.get(api_address, cookies=cookies, fields=PAYLOAD_FIELDS)
+    check_api_status(api_status)
+    if 'data' not in api_status:
+        with report_metrics.timer('stage_seconds', stage='datastore_fetch'):
+            api_status, payload, data_version = datastore_client.get(api_address, ignore_cache=True, cookies=cookies, fields=PAYLOAD_FIELDS)
+    if 'data' not in api_status:
+        raise Exception('No data from api {0}: {1}'.format(api_address, api_status))
 
-            # print('GET TABLE DATA')
-            table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age = get_tables(today, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df)
+    report_date = datetime.now()
+    cache_key = (data_version, report_date.date())
+    latest = latest_report.get('current')
+    if latest is not None and latest[0] == data_version and latest[2] == report_date.date():
+        return False
+
+    report_data = tables_cache.get(cache_key)
+    if report_data is None:
+        if payload is None and not payload_archive.find(data_version):
+            # The data is unchanged since it was last requested, but its report for this date is not cached
+            with report_metrics.timer('stage_seconds', stage='datastore_fetch'):
+                api_status, payload, data_version = datastore_client.get(api_address, cookies=cookies, fields=PAYLOAD_FIELDS, revalidate=False)
+            cache_key = (data_version, report_date.date())
+        report_data = get_shared_report_data(payload, report_date, data_version)
+    get_report_tables(report_data)
+    for section in page_sections:
+        get_report_section_content(report_data, section, report_date)
+    tables_cache.set(cache_key, report_data)
+    latest_report['current'] = (data_version, report_data, report_date.date())
+    report_metrics.flush()
+    app.logger.info('Refreshed report to data version {0}'.format(data_version))
+    return True
+
+# The refresher only runs with service credentials, never with the session of a user
+report_refresher = ReportRefresher(refresh_report, REPORT_REFRESH_INTERVAL if REPORT_REFRESH_COOKIES else 0)
 
-            # print('building tables')
-            tables_dict = build_tables_dict(table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age)
+def serve_layout():
+    page_meta_dict, report_handle = {'report_date_msg':''}, {}
+    report_date = datetime.now()
 
-            # print('building content')
-            section1, section2, section3, section4 = build_content(tables_dict, page_meta_dict)
+    try:
+        page_meta_dict = get_page_meta(report_date)
 
-        else:
-            # print('NO subjects_json')
-            no_data_msg = "The data for this report is not available at this time.  Please try again later."
-            section1, section2, section3, section4 = html.Div(no_data_msg), html.Div(no_data_msg), html.Div(no_data_msg), html.Div(no_data_msg)
+        # Load the data so that errors are reported on the page; the tables of each section are built
+        # when its tab is first opened
+        with report_metrics.timer('stage_seconds', stage='load_report'):
+            data_version, report_data = get_report_data(report_date)
 
-            # print('get sections')
-        sections_dict = {}
-        sections_dict['section1'] = section1
-        sections_dict['section2'] = section2
-        sections_dict['section3'] = section3
-        sections_dict['section4'] = section4
+        # The page only holds a handle to the report data, which callbacks resolve from the server's cache
+        report_handle = {'report_date': report_date.isoformat(), 'data_version': data_version}
 
         page_layout = html.Div(id='page_layout')
     except PortalAuthException:
@@ -541,10 +961,7 @@ def serve_layout():
         return html.Div(['There has been a problem accessing the data for this Report.'],style=TACC_IFRAME_SIZE)
 
     s_layout = html.Div([
-        dcc.Store(id='store_meta', data = page_meta_dict),
-        dcc.Store(id='store_tables', data = tables_dict),
-        dcc.Store(id='store_sections', data = sections_dict),
-        dcc.Store(id='store_enrollment', data = enrollment_dict),
+        dcc.Store(id='store_report', data = report_handle),
         Download(id="download-dataframe-xlxs"),
         Download(id="download-dataframe-html"),
 
@@ -557,54 +974,98 @@ def serve_layout():
 
 app.layout = serve_layout
 
+# Stage timings, payload sizes and row counts of all workers of this host, for Prometheus to scrape
+@app.server.route('/metrics')
+def metrics():
+    return flask.Response(report_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Share the values observed while handling a request with the other workers once, after the request
+@app.server.after_request
+def flush_metrics(response):
+    report_metrics.flush()
+    return response
+
 # ----------------------------------------------------------------------------
 # DATA CALLBACKS
 # ----------------------------------------------------------------------------
 
 # Use toggle to display either tabs or single page LAYOUT
-@app.callback(Output("page_layout","children"), Input('toggle-view',"value"),State('store_sections', 'data'))
-def set_page_layout(value, sections):
-    return build_page_layout(value, sections)
+@app.callback(Output("page_layout","children"), Input('toggle-view',"value"),State('store_report', 'data'))
+def set_page_layout(value, report_handle):
+    if value:
+        sections_dict = {section: get_section_content(section, report_handle) for section in page_sections}
+    else:
+        sections_dict = {section: None for section in page_sections}
+    return build_page_layout(value, sections_dict)
+
+# Build each tab's section the first time the tab is opened
+@app.callback(
+        Output('section_1', 'children'),
+        Output('section_2', 'children'),
+        Output('section_3', 'children'),
+        Output('section_4', 'children'),
+        Output('section_5', 'children'),
+        Output('store_loaded_sections', 'data'),
+        Input('tabs_tables', 'value'),
+        State('store_loaded_sections', 'data'),
+        State('store_report', 'data'),
+        )
+def load_tab_section(tab, loaded_sections, report_handle):
+    if not tab or tab in loaded_sections:
+        raise PreventUpdate
+    sections = [no_update for section in page_sections]
+    sections[page_sections.index(tab)] = get_section_content(tab, report_handle)
+    return sections + [loaded_sections + [tab]]
+
+# Expand the compact column oriented table data into the records a DataTable expects, then clear the store
+# so the browser does not keep both copies
+app.clientside_callback(
+    '''
+    function(table_data) {
+        if (!table_data) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        const columns = table_data.columns, values = table_data.values;
+        const n_rows = columns.length ? values[0].length : 0;
+        const records = new Array(n_rows);
+        for (let i = 0; i < n_rows; i++) {
+            const record = {};
+            for (let j = 0; j < columns.length; j++) {
+                record[columns[j]] = values[j][i];
+            }
+            records[i] = record;
+        }
+        return [records, null];
+    }
+    ''',
+    Output({'type': 'report_table', 'index': MATCH}, 'data'),
+    Output({'type': 'report_table_data', 'index': MATCH}, 'data'),
+    Input({'type': 'report_table_data', 'index': MATCH}, 'data'),
+)
 
 # Create excel spreadsheel
 @app.callback(
         Output("download-dataframe-xlxs", "data"),
         Input("btn_xlxs", "n_clicks"),
-        State("store_tables","data"),
+        State("store_report","data"),
         )
-def click_excel(n_clicks,store):
+def click_excel(n_clicks, report_handle):
     if n_clicks == 0:
         raise PreventUpdate
-    if store:
+    if report_handle:
         try:
-            # msg =  html.Div(json.dumps(store))
-            today = datetime.now().strftime('%Y_%m_%d')
-            download_filename = datetime.now().strftime('%Y_%m_%d') + '_a2cps_weekly_report_data.xlsx'
-            table_keys = store.keys()
-
-            writer = pd.ExcelWriter(download_filename, engine='xlsxwriter')
-
-            tables_names = ["table1a","table1b", "table2a", "table2b", "table3a", "table3b", "table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age"]
-            for table in tables_names:
-                excel_sheet_name = store[table]['excel_sheet_name']
-                df = pd.DataFrame(store[table]['data'])
-
-                # convert multiindex columns and remove the '_'
-                new_cols = []
-                for i in list(df.columns):
-                    if i[0] == '_':
-                        new_cols.append(i[1:])
-                    else:
-                        new_cols.append(i.replace('_',': '))
-                df.columns = new_cols
-
-                if len(df) == 0 :
-                    df = pd.DataFrame(columns =['No data for this table'])
-                df.to_excel(writer, sheet_name=excel_sheet_name, index = False)
-
-            writer.save()
-            excel_file =  send_file(writer, download_filename)
-            return excel_file
+            report_date = datetime.fromisoformat(report_handle['report_date'])
+            data_version, report_data = get_report_data(report_date, report_handle.get('data_version'))
+            if report_data is None:
+                return None
+
+            # The workbook is built once per data version and then served from the report cache
+            if report_data['excel'] is None:
+                with report_metrics.timer('stage_seconds', stage='excel_export'):
+                    report_data['excel'] = base64.b64encode(build_excel_workbook(report_data)).decode()
+
+            download_filename = get_excel_filename(datetime.now())
+            return dict(content=report_data['excel'], filename=download_filename, mime_type=None, base64=True)
 
         except Exception as e:
             traceback.print_exc()
@@ -1,5 +1,6 @@
 import os # Operating system library
 import pathlib # file paths
+import tempfile # default directories
 
 # ----------------------------------------------------------------------------
 # SECURITY FUNCTION
@@ -41,3 +42,35 @@ DATA_PATH = pathlib.Path(__file__).parent.joinpath("data")
 ASSETS_PATH = pathlib.Path(__file__).parent.joinpath("assets")
 REQUESTS_PATHNAME_PREFIX = os.environ.get("REQUESTS_PATHNAME_PREFIX", "/")
 DATA_SOURCE = 'api' # switch to url for API
+
+# Report cache: how long (seconds) computed report data is reused, and how many data versions are kept per worker
+REPORT_CACHE_TTL = int(os.environ.get("REPORT_CACHE_TTL", 3600))
+REPORT_CACHE_MAX_ENTRIES = int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", 4))
+
+# Background report refresh: seconds between datastore polls (0 disables), and the service cookies
+# ("name=value; name2=value2") that authenticate them. Without service cookies the refresher is disabled.
+REPORT_REFRESH_INTERVAL = int(os.environ.get("REPORT_REFRESH_INTERVAL", 600))
+REPORT_REFRESH_COOKIES = os.environ.get("REPORT_REFRESH_COOKIES", "")
+
+# Directory shared by the workers of a host (e.g. a pod) so concurrent requests for the same report are built
+# once and loaded by the other workers (off unless set), and seconds a worker waits for another to finish a build.
+# Report data is stored there, so it must be private to the user running the app: it is created with mode 0700,
+# and not used if it belongs to another user
+REPORT_SHARED_DIR = os.environ.get("REPORT_SHARED_DIR", "")
+REPORT_BUILD_WAIT = int(os.environ.get("REPORT_BUILD_WAIT", 180))
+
+# Directory where the workers of a host share their report metrics, so /metrics adds up all of them. The metrics
+# hold timings and counts only, no subject data, so it is on by default in a temporary directory of the user
+# running the app; it is created with mode 0700 and not used if it belongs to another user. Set it to "" to have
+# each worker report only its own metrics
+REPORT_METRICS_DIR = os.environ.get("REPORT_METRICS_DIR",
+    os.path.join(tempfile.gettempdir(), 'weekly_report_metrics_{0}'.format(os.getuid() if hasattr(os, 'getuid') else 0)))
+
+# Directory where the frames of each datastore payload version are archived, partitioned by fetch date, so that
+# versions can be reloaded without parsing or the datastore (off unless set; needs pyarrow installed), and the
+# number of most recent versions kept there (0 keeps all). The archive holds subject data, so keep it private.
+PAYLOAD_ARCHIVE_DIR = os.environ.get("PAYLOAD_ARCHIVE_DIR", "")
+PAYLOAD_ARCHIVE_MAX_VERSIONS = int(os.environ.get("PAYLOAD_ARCHIVE_MAX_VERSIONS", 12))
+
+# Threads used to compute independent report tables concurrently; 1 runs them one after another for debugging
+TABLE_WORKERS = int(os.environ.get("TABLE_WORKERS", 4))
@@ -10,18 +10,34 @@ import requests
 import math
 import numpy as np
 import pandas as pd # Dataframe manipulations
-import sqlite3
 import datetime
+import functools
+import concurrent.futures
+import hashlib
+import logging
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 # import local modules
 from config_settings import *
+from datastore_loading import *
+from report_metrics import *
+
+logger = logging.getLogger("weekly_ui")
 
 # ----------------------------------------------------------------------------
 # HELPER FUNCTIONS
 # ----------------------------------------------------------------------------
 
+def table_inputs(**frame_columns):
+    ''' Declare the report input frames, and the columns of each, that a table function reads, e.g.
+    @table_inputs(consented=['mcc', 'obtain_date'], report=['today']). 'report' lists the report time parameters
+    used, which are compared by date. Tables are only recomputed when one of their declared inputs changes.'''
+    def declare(table_function):
+        table_function.table_inputs = frame_columns
+        return table_function
+    return declare
+
 def use_b_if_not_a(a, b):
     if not pd.isnull(a):
         x = a
@@ -46,13 +62,25 @@ def convert_to_multindex(df, delimiter = ': '):
     df_mi.columns = pd.MultiIndex.from_tuples(df_mi.columns)
     return df_mi
 
-def datatable_settings_multiindex(df, flatten_char = '_'):
+def count_dates_before(df, group_cols, date_col, cutoffs, inclusive=False):
+    ''' Number of rows of each group of df dated before (or with inclusive, on or before) each of cutoffs, as a
+    dataframe indexed by group with a column per cutoff. The dates of each group are sorted once and each cutoff
+    found with a binary search, so counting for many report dates costs little more than counting for one.'''
+    cutoffs = pd.DatetimeIndex(cutoffs).to_numpy()
+    side = 'right' if inclusive else 'left'
+    def count_group(dates):
+        sorted_dates = np.sort(dates.dropna().to_numpy(dtype='datetime64[ns]'))
+        return pd.Series(np.searchsorted(sorted_dates, cutoffs, side=side))
+    return df.groupby(group_cols)[date_col].apply(count_group).unstack()
+
+def datatable_settings_multiindex(df, flatten_char = '_', orient = 'records'):
     ''' Plotly dash datatables do not natively handle multiindex dataframes.
     This function generates a flattend column name list for the dataframe,
     while structuring the columns to maintain their original multi-level format.
 
     Function returns the variables datatable_col_list, datatable_data for the columns and data parameters of
-    the dash_table.DataTable'''
+    the dash_table.DataTable. With orient = 'columns' the data is returned in the compact form
+    {'columns': [column ids], 'values': [values of each column]} instead of as a list of records.'''
     datatable_col_list = []
 
     levels = df.columns.nlevels
@@ -67,7 +95,10 @@ def datatable_settings_multiindex(df, flatten_char = '_'):
             columns_list.append(col_id)
         df.columns = columns_list
 
-    datatable_data = df.to_dict('records')
+    if orient == 'columns':
+        datatable_data = {'columns': list(df.columns), 'values': [df.iloc[:, i].tolist() for i in range(len(df.columns))]}
+    else:
+        datatable_data = df.to_dict('records')
 
     return datatable_col_list, datatable_data
 
@@ -78,26 +109,31 @@ def datatable_settings_multiindex(df, flatten_char = '_'):
 
 def load_display_terms(ASSETS_PATH, display_terms_file):
     '''Load the data file that explains how to translate the data columns and controlled terms into the English language
-    terms to be displayed to the user'''
+    terms to be displayed to the user. The file is read and compiled once per process, so the returned
+    dataframes and dictionaries are shared and should not be modified.'''
     try:
-        if ASSETS_PATH:
-            display_terms = pd.read_csv(os.path.join(ASSETS_PATH, display_terms_file))
-        else:
-            display_terms = pd.read_csv(display_terms_file)
-
-        # Get display terms dictionary for one-to-one records
-        display_terms_uni = display_terms[display_terms.multi == 0]
-        display_terms_dict = get_display_dictionary(display_terms_uni, 'api_field', 'api_value', 'display_text')
-
-        # Get display terms dictionary for one-to-many records
-        display_terms_multi = display_terms[display_terms.multi == 1]
-        display_terms_dict_multi = get_display_dictionary(display_terms_multi, 'api_field', 'api_value', 'display_text')
-
-        return display_terms, display_terms_dict, display_terms_dict_multi
+        return compile_display_terms(ASSETS_PATH, display_terms_file)
     except Exception as e:
         traceback.print_exc()
         return None
 
+@functools.lru_cache(maxsize=None)
+def compile_display_terms(ASSETS_PATH, display_terms_file):
+    if ASSETS_PATH:
+        display_terms = pd.read_csv(os.path.join(ASSETS_PATH, display_terms_file))
+    else:
+        display_terms = pd.read_csv(display_terms_file)
+
+    # Get display terms dictionary for one-to-one records
+    display_terms_uni = display_terms[display_terms.multi == 0]
+    display_terms_dict = get_display_dictionary(display_terms_uni, 'api_field', 'api_value', 'display_text')
+
+    # Get display terms dictionary for one-to-many records
+    display_terms_multi = display_terms[display_terms.multi == 1]
+    display_terms_dict_multi = get_display_dictionary(display_terms_multi, 'api_field', 'api_value', 'display_text')
+
+    return display_terms, display_terms_dict, display_terms_dict_multi
+
 def get_display_dictionary(display_terms, api_field, api_value, display_col):
     '''from a dataframe with the table display information, create a dictionary by field to match the database
     value to a value for use in the UI '''
@@ -105,98 +141,143 @@ def get_display_dictionary(display_terms, api_field, api_value, display_col):
         display_terms_list = display_terms[api_field].unique() # List of fields with matching display terms
 
         # Create a dictionary using the field as the key, and the dataframe to map database values to display text as the value
-        display_terms_dict = {}
+        display_terms_dict = DisplayTermsDict()
         for i in display_terms_list:
             term_df = display_terms[display_terms.api_field == i]
             term_df = term_df[[api_value,display_col]]
             term_df = term_df.rename(columns={api_value: i, display_col: i + '_display'})
             term_df = term_df.apply(pd.to_numeric, errors='ignore')
             display_terms_dict[i] = term_df
+            display_terms_dict.maps[i] = compile_display_map(term_df, i)
         return display_terms_dict
 
     except Exception as e:
         traceback.print_exc()
         return None
 
-# ---------------------------------
-#   Get Data From datastore
-# ---------------------------------
+class DisplayTermsDict(dict):
+    '''Dictionary of display term dataframes by api field, which also holds the compiled value -> display text
+    map for each field in .maps'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maps = {}
+
+    def get_map(self, field):
+        if field not in self.maps:
+            self.maps[field] = compile_display_map(self[field], field)
+        return self.maps[field]
+
+def compile_display_map(term_df, field):
+    '''Compile a display terms dataframe into arrays of database values and matching display text'''
+    term_df = term_df.drop_duplicates(subset=[field])
+    return term_df[field].to_numpy(), term_df[field + '_display'].to_numpy()
+
+def map_display_terms(df, display_terms_dict, as_categorical=False):
+    '''Add a '<field>_display' column for each field of the display terms dictionary present in df, translating
+    database values to display text. All display columns are looked up as arrays and added to the frame in a single
+    step. Values without a display term are left missing. If as_categorical, display columns are pandas Categoricals.'''
+    display_cols = {}
+    for field in display_terms_dict.keys():
+        if field not in df.columns:
+            continue
+        if isinstance(display_terms_dict, DisplayTermsDict):
+            values, display_text = display_terms_dict.get_map(field)
+        else:
+            values, display_text = compile_display_map(display_terms_dict[field], field)
 
-def get_api_data(api_address):
-    api_json = {}
-    try:
-        try:
-            response = requests.get(api_address, cookies=flask.request.cookies)
-        except:
-            return('error: {}'.format(e))
-        request_status = response.status_code
-        if request_status == 200:
-            api_json = response.json()
-            return api_json
+        # for display columns where data is numeric, match as floats to handle nas
+        data = df[field]
+        if pd.api.types.is_numeric_dtype(data) and pd.api.types.is_numeric_dtype(values):
+            data, values = data.astype('float64'), values.astype('float64')
+        positions = pd.Index(values).get_indexer(data)
+
+        if as_categorical and pd.Index(display_text).is_unique:
+            display_cols[field + '_display'] = pd.Categorical.from_codes(positions, categories=display_text)
         else:
-            return request_status
-    except Exception as e:
-        traceback.print_exc()
-        api_json['json'] = 'error: {}'.format(e)
-        return api_json
+            display_cols[field + '_display'] = np.where(positions >= 0, display_text.take(positions.clip(0)), np.nan)
+
+    if not display_cols:
+        return df
+    return pd.concat([df, pd.DataFrame(display_cols, index=df.index)], axis=1)
 
 # ----------------------------------------------------------------------------
 # DATA LOADING
 # ----------------------------------------------------------------------------
-def get_subjects_json(report, report_suffix, file_url_root=None, source='local', mcc_list =[1,2], DATA_PATH = DATA_PATH):
-    print(source)
-    try:
-        subjects_json = {}
-        # Read files into json
-        if source == 'url':
-            for mcc in mcc_list:
-                print(mcc)
-                json_url = '/'.join([file_url_root, report,report_suffix.replace('[mcc]',str(mcc))])
-                print(json_url)
-                r = requests.get(json_url)
-                print(r.status_code)
-                if r.status_code == 200:
-                # TO DO: add an else statement to use local files if the request fails
-                    mcc_json = r.json()
-                    subjects_json[mcc] = mcc_json
-        else:
-            for mcc in mcc_list:
-                mcc_filename = ''.join(['subjects-',str(mcc),'-latest.json'])
-                print(mcc_filename)
-                print(DATA_PATH)
-                mcc_file = os.path.join(DATA_PATH, mcc_filename)
-                print(mcc_file)
-                with open(mcc_file, 'r') as f:
-                    subjects_json[mcc] = json.load(f)
-        return subjects_json
+def load_mcc_json(mcc, report, report_suffix, file_url_root=None, source='local', DATA_PATH = DATA_PATH):
+    '''Load the subjects json of one MCC from its file url or from the local data directory'''
+    if source == 'url':
+        json_url = '/'.join([file_url_root, report,report_suffix.replace('[mcc]',str(mcc))])
+        # Time out like datastore requests, so a hung file server can not hold up the report build
+        r = requests.get(json_url, timeout=(DATASTORE_CONNECT_TIMEOUT, DATASTORE_READ_TIMEOUT))
+        r.raise_for_status()
+        return r.json()
+    mcc_file = os.path.join(DATA_PATH, ''.join(['subjects-',str(mcc),'-latest.json']))
+    with open(mcc_file, 'r') as f:
+        return json.load(f)
 
-    except Exception as e:
-        traceback.print_exc()
+def get_subjects_json(report, report_suffix, file_url_root=None, source='local', mcc_list =[1,2], DATA_PATH = DATA_PATH):
+    '''Load the subjects json of every MCC concurrently, returning a dict of MCC to json. An MCC that fails to
+    load is reported and left out so that the others are still available; None is returned if none load.'''
+    subjects_json = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(mcc_list), 1)) as executor:
+        futures = {mcc: executor.submit(load_mcc_json, mcc, report, report_suffix, file_url_root, source, DATA_PATH)
+                   for mcc in mcc_list}
+    for mcc, future in futures.items():
+        try:
+            subjects_json[mcc] = future.result()
+        except Exception as e:
+            logger.warning('Could not load subjects for MCC {0} from {1}: {2}'.format(mcc, source, e))
+    if not subjects_json:
         return None
+    return subjects_json
 
 
 # ----------------------------------------------------------------------------
 # DATA CLEANING
 # ----------------------------------------------------------------------------
 
-def combine_mcc_json(mcc_json):
-    '''Convert MCC json subjects data into dataframe and combine'''
-    df = pd.DataFrame()
-    for mcc in mcc_json:
-        mcc_data = pd.DataFrame.from_dict(mcc_json[mcc], orient='index').reset_index()
-        mcc_data['mcc'] = mcc
-        if df.empty:
-            df = mcc_data
-        else:
-            df = pd.concat([df, mcc_data])
+# Datetime columns of each frame and the format their values are sent in: subjects dates are converted by
+# the datastore and sent as iso strings, adverse event dates as entered in redcap
+DATETIME_COLUMNS = {
+    'subjects': {col: '%Y-%m-%dT%H:%M:%S.%f' for col in ['date_of_contact', 'date_and_time', 'obtain_date', 'ewdateterm',
+                 'sp_surg_date', 'sp_v1_preop_date', 'sp_v2_6wk_date', 'sp_v3_3mo_date']},
+    'adverse_events': {'erep_local_dtime': '%Y-%m-%d %H:%M', 'erep_onset_date': '%Y-%m-%d'},
+}
+
+def convert_datetime_columns(df, frame_name):
+    '''Convert the datetime columns of a frame listed in DATETIME_COLUMNS in place, parsing each with its format
+    rather than inferring it. Values in any other format are parsed with an inferred format, and values
+    that are not dates are set missing. Columns that are missing or already datetimes are left as they are.'''
+    for col, date_format in DATETIME_COLUMNS[frame_name].items():
+        if col not in df.columns or pd.api.types.is_datetime64_any_dtype(df[col]):
+            continue
+        values = df[col]
+        parsed = pd.to_datetime(values, format=date_format, errors='coerce')
+        unmatched = parsed.isna() & values.notna()
+        if unmatched.any():
+            parsed[unmatched] = pd.to_datetime(values[unmatched], errors='coerce')
+        df[col] = parsed
+    return df
 
+def combine_mcc_json(mcc_json):
+    '''Convert MCC json subjects data into a single dataframe, with the subject id as 'index' and the MCC of each
+    subject as a categorical 'mcc' column. The records of all MCCs are built into one frame at once.'''
+    index, records, mcc_codes = [], [], []
+    for code, mcc in enumerate(mcc_json):
+        index.extend(mcc_json[mcc].keys())
+        records.extend(mcc_json[mcc].values())
+        mcc_codes.append(np.full(len(mcc_json[mcc]), code))
+    if not records:
+        return pd.DataFrame()
+
+    df = pd.DataFrame.from_records(records)
+    df.insert(0, 'index', index)
+    df['mcc'] = pd.Categorical.from_codes(np.concatenate(mcc_codes), categories=list(mcc_json))
     return df
 
 def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi, drop_cols_list =['adverse_effects']):
     '''Take the raw subjects data frame and clean it up. Note that apis don't pass datetime columns well, so
-    these should be converted to datetime by the receiver.
-    datetime columns = ['date_of_contact','date_and_time','obtain_date','ewdateterm','sp_surg_date','sp_v1_preop_date','sp_v2_6wk_date','sp_v3_3mo_date']
-    Can convert within a pd.DataFrame using .apply(pd.to_datetime, errors='coerce')'''
+    these should be converted to datetime by the receiver with convert_datetime_columns.'''
     try:
         # Combine jsons into single dataframe
         subjects_raw = combine_mcc_json(subjects_json)
@@ -220,14 +301,8 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
         # Coerce numeric values to enable merge
         subjects = subjects.apply(pd.to_numeric, errors='ignore')
 
-        # Merge columns on the display terms dictionary to convert from database terminology to user terminology
-        for i in display_terms_dict.keys():
-            if i in subjects.columns: # Merge columns if the column exists in the dataframe
-                display_terms = display_terms_dict[i]
-                if subjects[i].dtype == np.float64:
-                    # for display columns where data is numeric, merge on display dictionary, treating cols as floats to handle nas
-                    display_terms[i] = display_terms[i].astype('float64')
-                subjects = subjects.merge(display_terms, how='left', on=i)
+        # Add display columns from the display terms dictionary to convert from database terminology to user terminology
+        subjects = map_display_terms(subjects, display_terms_dict)
         #------
 
 
@@ -235,8 +310,7 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
         subjects = add_screening_site(screening_sites, subjects, 'record_id')
 
         # Convert datetime columns
-        datetime_cols_list = ['date_of_contact','date_and_time','obtain_date','ewdateterm','sp_surg_date','sp_v1_preop_date','sp_v2_6wk_date','sp_v3_3mo_date'] #erep_local_dtime also dates, but currently an array
-        subjects[datetime_cols_list] = subjects[datetime_cols_list].apply(pd.to_datetime, errors='coerce')
+        subjects = convert_datetime_columns(subjects, 'subjects')
 
         # Get subset of data for consented patients
         consented = get_consented_subjects(subjects)
@@ -250,23 +324,42 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
         traceback.print_exc()
         return None
 
+class ScreeningSiteLookup:
+    '''Record id ranges of the screening sites, sorted so that ids can be assigned to a site with a binary search'''
+    site_cols = ['screening_site', 'site', 'surgery_type', 'record_id_start', 'record_id_end']
+
+    def __init__(self, screening_sites):
+        self.sites = screening_sites.sort_values('record_id_start').reset_index(drop=True)
+        self.starts = self.sites['record_id_start'].to_numpy()
+        self.ends = self.sites['record_id_end'].to_numpy()
+        if (self.starts[1:] <= self.ends[:-1]).any():
+            raise ValueError('Screening site record id ranges overlap')
+
+    def locate(self, ids):
+        '''Return the position in self.sites of the range containing each id, or -1 if it is outside every range'''
+        ids = pd.to_numeric(pd.Series(ids), errors='coerce').to_numpy(dtype='float64')
+        positions = np.searchsorted(self.starts, ids, side='right') - 1
+        in_range = (positions >= 0) & (ids <= self.ends[positions.clip(0)])
+        return np.where(in_range, positions, -1)
+
 def add_screening_site(screening_sites, df, id_col):
-    # Get dataframes
-    ids = df.loc[:, [id_col]]
-
-    # open sql connection to create new datarframe with record_id paired to screening site
-    conn = sqlite3.connect(':memory:')
-    ids.to_sql('ids', conn, index=False)
-    screening_sites.to_sql('ss', conn, index=False)
-
-    sql_qry = f'''
-    select {id_col}, screening_site, site, surgery_type, record_id_start, record_id_end
-    from ids
-    join ss on
-    ids.{id_col} between ss.record_id_start and ss.record_id_end
-    '''
-    sites = pd.read_sql_query(sql_qry, conn)
-    conn.close()
+    '''Add the screening site columns to df by matching id_col against the record id range of each site.
+    screening_sites can be the screening sites dataframe or a ScreeningSiteLookup built from it, which callers
+    assigning sites more than once can build once and reuse.
+    Rows with ids outside every range are dropped and logged.'''
+    if not isinstance(screening_sites, ScreeningSiteLookup):
+        screening_sites = ScreeningSiteLookup(screening_sites)
+
+    # Pair each record id with its screening site
+    positions = screening_sites.locate(df[id_col])
+    matched = positions >= 0
+    if not matched.all():
+        unmatched_ids = df.loc[~matched, id_col]
+        logger.warning('{0} records outside every screening site range were dropped: {1}'.format(
+            len(unmatched_ids), list(unmatched_ids[:10])))
+
+    sites = screening_sites.sites.loc[positions[matched], screening_sites.site_cols].reset_index(drop=True)
+    sites.insert(0, id_col, df.loc[matched, id_col].to_numpy())
 
     df = sites.merge(df, how='left', on=id_col)
 
@@ -275,7 +368,8 @@ def add_screening_site(screening_sites, df, id_col):
 def get_consented_subjects(subjects_with_screening_site):
     '''Get the consented patients from subjects dataframe with screening sites added'''
     consented = subjects_with_screening_site[subjects_with_screening_site.obtain_date.notnull()].copy()
-    consented['treatment_site'] = consented.apply(lambda x: use_b_if_not_a(x['sp_data_site_display'],x['redcap_data_access_group_display']), axis=1)
+    # Use the sp_data_site where available, otherwise the redcap data access group
+    consented['treatment_site'] = consented['sp_data_site_display'].fillna(consented['redcap_data_access_group_display'])
     consented['treatment_site_type'] = consented['treatment_site'] + "/" + consented['surgery_type']
     return consented
 
@@ -283,47 +377,49 @@ def get_consented_subjects(subjects_with_screening_site):
 
 def extract_adverse_effects_data(subjects_data, adverse_effects_col = 'adverse_effects'):
     '''Extract data with multiple values (stored as 'adverse effects' column) from the subjects data.
-    Adverse effects data is stored in a nested dictionary format - this function unpacks that.'''
-
+    Adverse effects data is stored for each subject as a dict of instances, each a dict of fields. The instances
+    are walked once, building a column of values for each index column, the instance and each field, with
+    blank strings read as missing values.'''
     index_cols = ['index','main_record_id', 'mcc']
-    # reset index using index_cols
-    multi_data = subjects_data.set_index(index_cols).copy()
-    # Extract multi data values
-    multi_df = multi_data[[adverse_effects_col]].dropna()
-    # Convert from data frame back to dict
-    multi_dict = multi_df.to_dict('index')
-    # Turn dict into df with multi=index and reset_index
-    multi = pd.DataFrame.from_dict({(i,k): multi_dict[i][j][k]
-                               for i in multi_dict.keys()
-                               for j in multi_dict[i].keys()
-                               for k in multi_dict[i][j].keys()
-                           },
-                           orient='index')
-    # Replace empty strings with NaN
-    multi = multi.replace(r'^\s*$', np.nan, regex=True)
-    multi = multi.reset_index()
-    # Convert level 0 of index from nested index back into columns
-    multi[index_cols] = pd.DataFrame(multi['level_0'].tolist(), index=multi.index)
-    # Label level 1 of multiindex as the instance of adverse events for a given subject
-    multi['instance'] = multi['level_1']
-    # Drop the extraneous columns
-    multi.drop(['level_0', 'level_1'], axis=1, inplace=True)
-
-    # Move index columns to start of dataframe
-    index_cols.append('instance')
-    new_col_order = index_cols + list(multi.columns.drop(index_cols))
-    multi = multi[new_col_order]
-    return multi
+    index_values = [subjects_data[col].tolist() for col in index_cols]
+    columns = {col: [] for col in index_cols + ['instance']}
+    # Values of each field with the row each belongs to, as instances need not have every field
+    fields = {}
+    n_rows = 0
+    for position, adverse_effects in enumerate(subjects_data[adverse_effects_col].tolist()):
+        if not isinstance(adverse_effects, dict):
+            continue
+        for instance, record in adverse_effects.items():
+            for col, values in zip(index_cols, index_values):
+                columns[col].append(values[position])
+            columns['instance'].append(instance)
+            for field, value in record.items():
+                if isinstance(value, str) and not value.strip():
+                    value = np.nan
+                rows, field_values = fields.setdefault(field, ([], []))
+                rows.append(n_rows)
+                field_values.append(value)
+            n_rows += 1
+
+    for field, (rows, field_values) in fields.items():
+        if len(rows) < n_rows:
+            column = [np.nan] * n_rows
+            for row, value in zip(rows, field_values):
+                column[row] = value
+            field_values = column
+        columns[field] = field_values
+    return pd.DataFrame(columns)
 
 def clean_adverse_events(adverse_events, consented, display_terms_dict_multi):
     try:
         # Coerce to numeric
         multi_data = adverse_events.apply(pd.to_numeric, errors='ignore')
 
+        # Convert datetime columns
+        multi_data = convert_datetime_columns(multi_data, 'adverse_events')
+
         # Convert numeric values to display values using dictionary
-        for i in display_terms_dict_multi.keys():
-            if i in multi_data.columns:
-                multi_data = multi_data.merge(display_terms_dict_multi[i], how='left', on=i)
+        multi_data = map_display_terms(multi_data, display_terms_dict_multi)
 
         # Rename 'index' to 'record_id'
         multi_data.rename(columns={"index": "record_id"}, inplace = True)
@@ -350,6 +446,75 @@ def get_centers(subjects, consented, display_terms):
     centers_df = pd.DataFrame(centers_list, columns = ['treatment_site'])
     return screening_centers_df, centers_df
 
+# ----------------------------------------------------------------------------
+# DTYPE NORMALIZATION
+# ----------------------------------------------------------------------------
+# Low cardinality text columns stored as categoricals, in addition to every '<field>_display' column
+CATEGORY_COLUMNS = ['screening_site', 'site', 'surgery_type', 'redcap_data_access_group', 'treatment_site',
+                    'treatment_site_type', 'dem_race_original']
+# 0/1 flags with missing values, stored as nullable booleans
+FLAG_COLUMNS = ['start_v1_preop', 'start_v2_6wk', 'start_v3_3mo', 'start_6mo', 'start_12mo']
+
+def get_frame_memory(df):
+    '''Memory used by a dataframe in MB, including the contents of object columns'''
+    return df.memory_usage(deep=True).sum() / 1e6
+
+def normalize_dtypes(df, frame_name=None):
+    '''Convert a frame to compact dtypes: low cardinality text columns to categoricals, 0/1 flags to nullable
+    booleans, whole number floats to nullable integers and integers to the smallest integer type that holds them.
+    Datetime columns should be converted before, as they are left as they are. The original dtypes of the converted
+    columns are kept in df.attrs for restore_dtypes, and the memory saved is logged.'''
+    before = get_frame_memory(df)
+    converted = {}
+    for col in df.columns:
+        data = df[col]
+        if pd.api.types.is_categorical_dtype(data) or pd.api.types.is_datetime64_any_dtype(data):
+            continue
+        if col in CATEGORY_COLUMNS or col.endswith('_display'):
+            if data.dtype == object:
+                converted[col] = data.astype('category')
+        elif col in FLAG_COLUMNS:
+            if data.dropna().isin([0, 1]).all():
+                converted[col] = data.astype('boolean')
+        elif pd.api.types.is_integer_dtype(data):
+            converted[col] = pd.to_numeric(data, downcast='integer')
+        elif pd.api.types.is_float_dtype(data):
+            values = data.dropna()
+            if (values == values.round()).all() and (values.abs() < 2**31).all():
+                converted[col] = data.astype(get_small_int_dtype(values))
+
+    original_dtypes = {col: df[col].dtype for col, data in converted.items() if data.dtype != df[col].dtype}
+    if converted:
+        df = df.assign(**converted)
+    df.attrs['original_dtypes'] = original_dtypes
+    logger.info('{0}: {1} rows, {2:.1f} MB -> {3:.1f} MB'.format(frame_name or 'frame', len(df), before, get_frame_memory(df)))
+    return df
+
+def restore_dtypes(df, columns=None):
+    '''Convert columns of a frame from normalize_dtypes (all of them by default) back to their original dtypes.
+    The table functions are written against the datastore dtypes, e.g. they add new values to text columns and
+    group by them without expecting unobserved categories, so they are given restored columns.'''
+    original_dtypes = df.attrs.get('original_dtypes')
+    if not original_dtypes:
+        return df
+    if columns is None:
+        columns = original_dtypes.keys()
+    restore = [col for col in columns if col in original_dtypes and col in df.columns]
+    if not restore:
+        return df
+    df = df.copy(deep=False)
+    for col in restore:
+        df[col] = df[col].astype(original_dtypes[col])
+    df.attrs = {}
+    return df
+
+def get_small_int_dtype(values):
+    '''Smallest nullable integer dtype that holds the values'''
+    for dtype, info in (('Int8', np.iinfo(np.int8)), ('Int16', np.iinfo(np.int16)), ('Int32', np.iinfo(np.int32))):
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return dtype
+    return 'Int64'
+
 # ----------------------------------------------------------------------------
 # Get dataframes and parameters
 # ----------------------------------------------------------------------------
@@ -373,6 +538,8 @@ def get_time_parameters(end_report, report_days_range = 7):
 # ----------------------------------------------------------------------------
 # Screening Tables
 # ----------------------------------------------------------------------------
+@table_inputs(subjects=['screening_site','mcc','surgery_type','participation_interest_display','record_id'],
+              consented=['screening_site','mcc','surgery_type','record_id'])
 def get_table_1_screening(subjects, consented, roll_up_columns):
     try:
         # Get Screening information on ALL subjects
@@ -436,6 +603,7 @@ def get_table_1_screening(subjects, consented, roll_up_columns):
 
         return None
 
+@table_inputs(subjects=['participation_interest','record_id','screening_site','surgery_type','reason_not_interested','ptinterest_comment'])
 def get_table_2a_screening(df, display_terms_t2a):
     # Get decline columns from dataframe where participant was not interested (participation_interest == 0)
     t2_cols = ['record_id','screening_site','surgery_type','reason_not_interested', 'ptinterest_comment'] # cols to select
@@ -484,21 +652,43 @@ def get_table_2a_screening(df, display_terms_t2a):
 
     return t2_site_count_detailed
 
+@table_inputs(subjects=['participation_interest','screening_site','surgery_type','date_of_contact','ptinterest_comment'],
+              report=['start_report','end_report'])
 def get_table_2b_screening(df, start_report, end_report):
+    return get_table_2b_editions(df, [(start_report, end_report)])[0]
+
+def get_table_2b_editions(df, report_periods):
+    ''' Table 2b for each (start_report, end_report) of report_periods. The decline comments are selected and
+    sorted by date once, and the comments of each period found with a binary search.'''
     # Each decline includes a comment field - show these for the period of the report (previous 7 days)
     decline_comments = df[df.participation_interest == 0][['screening_site','surgery_type','date_of_contact','ptinterest_comment']].dropna()
-
-    # Show Comments during reporting period
-    decline_comments = decline_comments[(decline_comments.date_of_contact > start_report) & (decline_comments.date_of_contact <= end_report)]
+    contact_dates = decline_comments['date_of_contact'].to_numpy(dtype='datetime64[ns]')
+    date_order = np.argsort(contact_dates, kind='stable')
+    sorted_dates = contact_dates[date_order]
 
     # Rename and reorder columns for display
     decline_comments = decline_comments.rename(columns = {'screening_site':'Screening Site', 'surgery_type':'Surgery','ptinterest_comment':'Reason' })
     cols_display_order = ['Screening Site', 'Surgery','Reason']
     decline_comments = decline_comments[cols_display_order]
 
-    return decline_comments
-
+    # Show Comments during each reporting period, in their original order
+    editions = []
+    for start_report, end_report in report_periods:
+        first = np.searchsorted(sorted_dates, pd.Timestamp(start_report).to_datetime64(), side='right')
+        last = np.searchsorted(sorted_dates, pd.Timestamp(end_report).to_datetime64(), side='right')
+        editions.append(decline_comments.iloc[np.sort(date_order[first:last])])
+    return editions
+
+@table_inputs(consented=['screening_site','mcc','surgery_type','main_record_id','obtain_date','ewdateterm','sp_inclcomply','sp_inclage1884',
+                         'sp_inclsurg','sp_exclnoreadspkenglish','sp_mricompatscr','sp_exclarthkneerep','sp_exclinfdxjoint',
+                         'sp_exclbilkneerep','sp_exclothmajorsurg','sp_exclprevbilthorpro'],
+              report=['today'])
 def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(), days_range = 30):
+    return get_table_3_editions(df, cols_for_groupby, [end_report_date], days_range)[0]
+
+def get_table_3_editions(df, cols_for_groupby, end_report_dates, days_range = 30):
+    ''' Table 3 as of each of end_report_dates. The consents of each group are rolled up once, and the consents
+    within days_range days of each date counted from the sorted consent dates of each group.'''
     t3 = df.copy()
     #treat mcc column as string if present
     t3['mcc'] = t3['mcc'].astype(str)
@@ -511,10 +701,6 @@ def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(),
     eligible_back = (t3.surgery_type == 'Thoracic') & (t3.sp_exclothmajorsurg ==0) & (t3.sp_exclprevbilthorpro ==0)
     t3['eligible'] = (eligible_short & eligible_knee) | (eligible_short & eligible_back)
 
-    # Get consent within last days range days
-    within_days_range = ((end_report_date - t3.obtain_date).dt.days) <= days_range
-    t3['within_range'] = within_days_range
-
     # Aggregate data for table 3
     # Set the columns to groupby, and the the columns to role up with desired aggregating functions
     # Note: can supply a list of aggregate functions to one columnm i.e. 'col_name': ['min','max']
@@ -522,10 +708,23 @@ def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(),
     aggregate_columns_dict={'main_record_id':'count',
                             'obtain_date':'max',
                              'eligible':'sum',
-                             'ewdateterm':'count',
-                           'within_range':'sum'}
+                             'ewdateterm':'count'}
     cols = cols_for_groupby + list(aggregate_columns_dict.keys())
-    t3_aggregate = t3[cols].groupby(by=cols_for_groupby).agg(aggregate_columns_dict)
+    t3_rollup = t3[cols].groupby(by=cols_for_groupby).agg(aggregate_columns_dict)
+
+    # Get consent within last days range days of each date, i.e. after the date less days range + 1 days.
+    # Consents after the date are counted as within range
+    consent_cutoffs = [end_report_date - timedelta(days=days_range + 1) for end_report_date in end_report_dates]
+    consents_to_cutoff = count_dates_before(t3, cols_for_groupby, 'obtain_date', consent_cutoffs, inclusive=True)
+    consents_within_range = consents_to_cutoff.rsub(t3.groupby(cols_for_groupby)['obtain_date'].count(), axis=0)
+
+    return [finish_table_3(t3_rollup, consents_within_range[i], cols_for_groupby, end_report_date, days_range)
+            for i, end_report_date in enumerate(end_report_dates)]
+
+def finish_table_3(t3_rollup, within_range, cols_for_groupby, end_report_date, days_range):
+    ''' Add the consents within range of one date to the table 3 rollup and format it for display'''
+    t3_aggregate = t3_rollup.copy()
+    t3_aggregate['within_range'] = within_range
 
     # Reset Index
     t3_aggregate = t3_aggregate.reset_index()
@@ -568,7 +767,15 @@ def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(),
 # ----------------------------------------------------------------------------
 # Study Status Tables
 # ----------------------------------------------------------------------------
+@table_inputs(consented=['treatment_site','surgery_type','main_record_id','start_v1_preop','sp_surg_date','start_v2_6wk',
+                         'start_v3_3mo','start_6mo','start_12mo','ewdateterm','ewprimaryreason'],
+              report=['today'])
 def get_table_4(consented_patients, compare_date = datetime.now()):
+    return get_table_4_editions(consented_patients, [compare_date])[0]
+
+def get_table_4_editions(consented_patients, compare_dates):
+    ''' Table 4 as of each of compare_dates. Patients are rolled up once, and the surgeries and completions
+    before each date counted from the sorted dates of each group.'''
     # select table4 columns for patients with a main record id
     category_cols = ["treatment_site", "surgery_type"]
 
@@ -580,26 +787,16 @@ def get_table_4(consented_patients, compare_date = datetime.now()):
     # Sort by record ID
     table4 = table4.sort_values(by=['main_record_id'])
 
-    # Flag patients with complete surgeries
-    table4['sp_surg_date'] = table4['sp_surg_date'].apply(pd.to_datetime)
-    table4['surg_complete'] = table4['sp_surg_date'] < compare_date
-
     # Convert Rescinded to boolean
     table4['ewdateterm'] = table4['ewdateterm'].notnull()
     
     # Flag dead patients
     table4['death'] = table4['ewprimaryreason'] == 4    
     
-    # Determine if patients have 'completed', i.e. reached 7 months
-    def complete_conditions(compare_date, sp_surg_date, ewdateterm):
-        if sp_surg_date is pd.NaT:
-            return False
-        elif ewdateterm:
-            return False
-        else:
-            return compare_date.date() > sp_surg_date.date() + relativedelta(months=7)
-
-    table4['complete'] =  table4.apply(lambda x: complete_conditions(compare_date, x['sp_surg_date'], x['ewdateterm']), axis =1)
+    # Patients 'complete' when they reach 7 months after surgery without rescinding.
+    # Missing surgery dates never complete
+    seven_months_post_surgery = table4['sp_surg_date'].dt.normalize() + pd.DateOffset(months=7)
+    table4['completion_date'] = seven_months_post_surgery.where(~table4['ewdateterm'])
     
     # Aggregate table 4
     agg_dict = {'main_record_id':'size',
@@ -607,8 +804,21 @@ def get_table_4(consented_patients, compare_date = datetime.now()):
                 'start_v3_3mo': 'sum', 'start_6mo': 'sum', 'start_12mo': 'sum','ewdateterm': 'sum',
                 'death': 'sum', 'complete':'sum' 
                }
-    table4_agg = table4.groupby(category_cols).agg(agg_dict).reset_index()
+    dated_cols = ['surg_complete', 'complete']
+    table4_rollup = table4.groupby(category_cols).agg({col: agg for col, agg in agg_dict.items() if col not in dated_cols})
+
+    # Count patients with complete surgeries, and who have completed, before each date
+    surgeries_complete = count_dates_before(table4, category_cols, 'sp_surg_date', compare_dates)
+    completed = count_dates_before(table4, category_cols, 'completion_date', [pd.Timestamp(compare_date.date()) for compare_date in compare_dates])
 
+    editions = []
+    for i, compare_date in enumerate(compare_dates):
+        table4_agg = table4_rollup.assign(surg_complete=surgeries_complete[i], complete=completed[i])
+        editions.append(finish_table_4(table4_agg[list(agg_dict)].reset_index(), category_cols))
+    return editions
+
+def finish_table_4(table4_agg, category_cols):
+    ''' Format the table 4 rollup of one date for display'''
     # fill na with 0
     table4_agg.fillna(0, inplace=True)
 
@@ -638,6 +848,8 @@ def get_table_4(consented_patients, compare_date = datetime.now()):
 
     return table4_agg
 
+@table_inputs(consented=['treatment_site','surgery_type','main_record_id','obtain_date','sp_surg_date','ewdateterm',
+                         'ewprimaryreason_display','ewcomments'])
 def get_tables_5_6(df):
     # Get patients who rescinded consent, i.e. have a value in the 'ewdateterm' column
     rescinded = df.dropna(subset=['ewdateterm'])
@@ -673,6 +885,9 @@ def get_tables_5_6(df):
 # ----------------------------------------------------------------------------
 # Deviation & Adverse Event Tables
 # ----------------------------------------------------------------------------
+@table_inputs(adverse_events=['record_id','main_record_id','mcc','instance','erep_local_dtime','erep_protdev_type',
+                              'erep_protdev_type_display','erep_protdev_desc','erep_protdev_caplan'],
+              consented=['treatment_site','main_record_id','mcc','start_v1_preop'])
 def get_deviation_records(consented, adverse_events):
     # Set which columns to select
     deviations_cols = ['record_id','main_record_id', 'mcc', 'instance','erep_local_dtime',
@@ -685,12 +900,10 @@ def get_deviation_records(consented, adverse_events):
     # Merge deviations with center info
     deviations = deviations.merge(consented[['treatment_site','main_record_id','mcc','start_v1_preop']], how='left', on = ['main_record_id','mcc'])
 
-    # convert datetime column to datetime
-    deviations['erep_local_dtime'] = deviations['erep_local_dtime'].apply(pd.to_datetime, errors='coerce')
-
     return deviations
 
 
+@table_inputs(centers_df=['treatment_site'], consented=['main_record_id','treatment_site','start_v1_preop'])
 def get_deviations_by_center(centers, df, deviations, display_terms_dict):
     dev_cols = ['main_record_id','treatment_site','start_v1_preop']
     baseline = df[df['start_v1_preop']==1][dev_cols]
@@ -765,30 +978,44 @@ def get_deviations_by_center(centers, df, deviations, display_terms_dict):
 
     return centers_all
 
+@table_inputs(report=['end_report'])
 def get_table7b_timelimited(deviations,end_report_date = datetime.now(), days_range = 7):
-    # Get deviations within last days range days
-    within_days_range = ((end_report_date - deviations.erep_local_dtime).dt.days) <= days_range
-    deviations['within_range'] = within_days_range
-    table7b = deviations[deviations['within_range']]
+    return get_table7b_editions(deviations, [end_report_date], days_range)[0]
 
+def get_table7b_editions(deviations, end_report_dates, days_range = 7):
+    ''' Table 7b as of each of end_report_dates. The deviations are sorted by date once, so the deviations of each
+    date are the most recent ones, found with a binary search.'''
     # Sort by most recent, then record_id, then instance
-    table7b = table7b.sort_values(['erep_local_dtime', 'main_record_id', 'erep_protdev_type'], ascending=[False, True, True])
+    deviations = deviations.sort_values(['erep_local_dtime', 'main_record_id', 'erep_protdev_type'], ascending=[False, True, True])
+    sorted_dates = np.sort(deviations['erep_local_dtime'].dropna().to_numpy(dtype='datetime64[ns]'))
 
     #select columns for display and rename
     table7b_cols = ['treatment_site','main_record_id', 'erep_local_dtime', 'erep_protdev_type_display',
        'erep_protdev_desc', 'erep_protdev_caplan']
     table7b_cols_new_names = ['Center Name','PID', 'Deviation Date', 'Deviation',
        'Description', 'Corrective Action']
-    table7b = table7b[table7b_cols]
-    table7b.columns = table7b_cols_new_names
+    deviations = deviations[table7b_cols]
+    deviations.columns = table7b_cols_new_names
+
+    # Datetime in DD/MM/YY format
+    deviations['Deviation Date'] = deviations['Deviation Date'].dt.strftime('%m/%d/%Y')
 
-    # Adjust cols: Record ID as int, Datetime in DD/MM/YY format
-    table7b['PID'] = table7b['PID'].astype(int)
-    table7b['Deviation Date'] = table7b['Deviation Date'].dt.strftime('%m/%d/%Y')
+    editions = []
+    for end_report_date in end_report_dates:
+        # Get deviations within last days range days, i.e. after the date less days range + 1 days
+        cutoff = pd.Timestamp(end_report_date - timedelta(days=days_range + 1)).to_datetime64()
+        table7b = deviations.iloc[:len(sorted_dates) - np.searchsorted(sorted_dates, cutoff, side='right')].copy()
 
-    return table7b
+        # Record ID as int
+        table7b['PID'] = table7b['PID'].astype(int)
+        editions.append(table7b)
+    return editions
 
 
+@table_inputs(adverse_events=['main_record_id','mcc','instance','erep_ae_yn','erep_ae_relation','erep_ae_severity',
+                              'erep_ae_serious','erep_onset_date','erep_ae_desc','erep_action_taken','erep_outcome',
+                              'erep_ae_yn_display','erep_ae_severity_display','erep_ae_relation_display','erep_ae_serious_display'],
+              consented=['treatment_site','surgery_type','main_record_id','mcc','sp_surg_date'])
 def get_adverse_event_records(consented, adverse_events):
     # Set which columns to select
     adverse_event_flag_cols = ['erep_ae_yn'] # must = 1
@@ -805,6 +1032,7 @@ def get_adverse_event_records(consented, adverse_events):
 
     return ae
 
+@table_inputs(centers_df=['treatment_site'], consented=['main_record_id','treatment_site','start_v1_preop'])
 def get_adverse_events_by_center(centers, df, adverse_events, display_terms_mapping):
     # Select subset of patients who have had baseline visits (start_v1_preop not null), using record_id as unique identifier
     baseline_cols = ['main_record_id','treatment_site','start_v1_preop']
@@ -881,6 +1109,7 @@ def get_adverse_events_by_center(centers, df, adverse_events, display_terms_mapp
 
     return centers_ae
 
+@table_inputs()
 def get_table_8b(event_records, end_report, report_days = 30):
     table8b_cols_dict = {'treatment_site':'Center',
                          'surgery_type':'Surgery',
@@ -905,7 +1134,7 @@ def get_table_8b(event_records, end_report, report_days = 30):
         table8b = table8b[(table8b.erep_onset_date > start_report) &  (table8b.erep_onset_date <= end_report)]
 
     # convert datetime column to show date
-    table8b.erep_onset_date = table8b.erep_onset_date.apply(pd.to_datetime, errors='coerce').dt.strftime('%m/%d/%Y')
+    table8b.erep_onset_date = table8b.erep_onset_date.dt.strftime('%m/%d/%Y')
 
     # Use col dict to rename cols for display
     table8b = table8b.rename(columns=table8b_cols_dict)
@@ -922,6 +1151,9 @@ def get_table_8b(event_records, end_report, report_days = 30):
 # ----------------------------------------------------------------------------
 # Demographics Tables
 # ----------------------------------------------------------------------------
+@table_inputs(consented=['record_id','mcc','treatment_site','surgery_type','ewdateterm','age','dem_race_display',
+                         'ethnic_display','sex_display','screening_age','screening_race_display',
+                         'screening_ethnicity_display','screening_gender_display'])
 def get_demographic_data(df):
     id_cols = ['record_id','mcc','treatment_site', 'surgery_type','ewdateterm']
     demo_cols = ['age', 'dem_race_display', 'ethnic_display',  'sex_display']
@@ -1011,6 +1243,7 @@ def get_describe_col_subset(df, describe_col, subset_col, round_rows = {2:['mean
 
 def get_enrollment_data(consented):
     enroll_cols = ['record_id','main_record_id','obtain_date','mcc', 'screening_site', 'surgery_type',]
+    consented = restore_dtypes(consented, enroll_cols + ['ewdateterm'])
     enrolled = consented[consented['ewdateterm'].isna()][enroll_cols] # Do we want to do this?
     enrolled['obtain_month'] = enrolled['obtain_date'].dt.to_period('M')
     enrolled['Site'] = enrolled['screening_site'] + ' (' + enrolled['surgery_type'] + ')'
@@ -1032,41 +1265,90 @@ def get_site_enrollments(enrollment_count, mcc):
     site_enrollments = site_enrollments.set_index(['Month','Year']).drop(columns='obtain_month')
     return site_enrollments
 
-def get_enrollment_expectations():
-    enrollment_expectations_dict = {'mcc': ['1','1','2','2'],
-                                'surgery_type':['TKA','Thoracic','Thoracic','TKA'],
-                                'start_month': ['02/22','06/22','02/22','06/22'],
-                                'expected_cumulative_start':[280,10,70,10], 'expected_monthly':[30,10,30,10]}
-
-    enrollment_expectations_df = pd.DataFrame.from_dict(enrollment_expectations_dict)
-    enrollment_expectations_df['start_month'] =  pd.to_datetime(enrollment_expectations_df['start_month'], format='%m/%y').dt.to_period('M')
-
-    enrollment_expectations_df['mcc'] = enrollment_expectations_df['mcc'].astype(int)
-
-    return enrollment_expectations_df
-
-def get_enrollment_expectations_monthly(enrollment_expectations_df):
-    mcc_type_expectations = pd.DataFrame()
-    for i in range(len(enrollment_expectations_df)):
-        mcc = enrollment_expectations_df.iloc[i]['mcc']
-        surgery_type = enrollment_expectations_df.iloc[i]['surgery_type']
-        start_month = enrollment_expectations_df.iloc[i]['start_month']
-        expected_start_count = enrollment_expectations_df.iloc[i]['expected_cumulative_start']
-        expected_monthly = enrollment_expectations_df.iloc[i]['expected_monthly']
-
-        months = pd.period_range(start_month,datetime.now(),freq='M').tolist()
-        expected_monthly_series = [expected_start_count] + (len(months)-1) * [expected_monthly]
-
-        for index, month in enumerate(months):
-            new_row = {'mcc':mcc,
-                       'surgery_type': surgery_type,
-                       'Month': month,
-                       'Expected: Monthly': expected_monthly_series[index],
-                       'Expected: Cumulative': expected_start_count+index*expected_monthly}
-            mcc_type_expectations = mcc_type_expectations.append(new_row, ignore_index=True)
-
+def get_site_enrollment_expectations(ASSETS_PATH, screening_sites_file='screening_sites.csv', through=None):
+    '''Expected monthly and cumulative enrollment of each screening site by study month, from the
+    expected_enrollment and study_month lists of the screening sites file, continued at the last expected monthly
+    enrollment through the month of through (default now). Sites without expectations are left out.
+    The series are built once per version of the file and month.'''
+    sites_file = os.path.join(ASSETS_PATH, screening_sites_file)
+    through_month = pd.Period(through or datetime.now(), freq='M')
+    return read_site_enrollment_expectations(sites_file, os.path.getmtime(sites_file), through_month).copy()
+
+@functools.lru_cache(maxsize=4)
+def read_site_enrollment_expectations(sites_file, modified_time, through_month):
+    sites = pd.read_csv(sites_file, encoding='utf-8-sig')
+    sites = sites.dropna(subset=['expected_enrollment', 'study_month', 'start_year', 'start_month'])
+    site_cols = ['screening_site', 'mcc', 'surgery_type']
+
+    # One row per site and study month
+    expectations = sites[site_cols].assign(
+        start_month=pd.to_datetime(pd.DataFrame({'year': sites['start_year'], 'month': sites['start_month'], 'day': 1})).dt.to_period('M'),
+        study_month=sites['study_month'].str.split(','),
+        expected_monthly=sites['expected_enrollment'].str.split(','),
+    ).explode(['study_month', 'expected_monthly'], ignore_index=True)
+    expectations['study_month'] = expectations['study_month'].astype(int)
+    expectations['Expected: Monthly'] = expectations['expected_monthly'].astype(int)
+    expectations['Month'] = expectations['start_month'] + (expectations['study_month'] - 1).to_numpy()
+    expectations = expectations[site_cols + ['study_month', 'Month', 'Expected: Monthly']]
+
+    # Continue each site at its last expected monthly enrollment
+    last = expectations.sort_values('study_month', kind='stable').groupby(site_cols, sort=False).tail(1)
+    n_months = np.clip(through_month.ordinal - last['Month'].array.asi8, 0, None)
+    continued = last.loc[last.index.repeat(n_months)].copy()
+    offsets = continued.groupby(level=0).cumcount().to_numpy() + 1
+    continued['study_month'] += offsets
+    continued['Month'] = continued['Month'] + offsets
+
+    expectations = pd.concat([expectations, continued]).sort_values(site_cols + ['study_month'], kind='stable', ignore_index=True)
+    expectations['Expected: Cumulative'] = expectations.groupby(site_cols, sort=False)['Expected: Monthly'].cumsum()
+    return expectations
+
+def get_enrollment_expectations(site_expectations):
+    '''First month of the expectations of each MCC and surgery type'''
+    enrollment_expectations_df = site_expectations.groupby(['mcc','surgery_type'], as_index=False)['Month'].min()
+    return enrollment_expectations_df.rename(columns={'Month': 'start_month'})
+
+def get_enrollment_expectations_monthly(site_expectations):
+    '''Expected monthly and cumulative enrollment of each MCC and surgery type, adding up its sites by month'''
+    mcc_type_expectations = site_expectations.groupby(['mcc','surgery_type','Month'], as_index=False)['Expected: Monthly'].sum()
+    mcc_type_expectations['Expected: Cumulative'] = mcc_type_expectations.groupby(['mcc','surgery_type'])['Expected: Monthly'].cumsum()
     return mcc_type_expectations
 
+def get_site_enrollment_tables(consented, report_date=None):
+    '''Actual and expected monthly and cumulative enrollment of each screening site by study month through the
+    month of report_date (default now), as a dict of site name to dataframe. Study month 1 is the first month of
+    the site's expectations, or of its enrollment if it has none, and enrollments from before it are counted there.'''
+    site_cols = ['screening_site','mcc','surgery_type']
+    through_month = pd.Period(report_date or datetime.now(), freq='M')
+    enrollment_df = get_enrollment_data(consented)
+    expectations = get_site_enrollment_expectations(ASSETS_PATH, through=report_date)
+
+    actual = enrollment_df.groupby(site_cols + ['obtain_month']).size().rename('Actual: Monthly').reset_index()
+    start = expectations.groupby(site_cols)['Month'].min().combine_first(actual.groupby(site_cols)['obtain_month'].min())
+    start = start.rename('start_month').reset_index()
+
+    # One row per site and month from its start through the report month
+    start_ordinals = start['start_month'].array.asi8
+    n_months = np.clip(through_month.ordinal - start_ordinals + 1, 0, None)
+    sites = start.loc[start.index.repeat(n_months)].reset_index(drop=True)
+    sites['study_month'] = sites.groupby(site_cols, sort=False).cumcount() + 1
+    sites['Month'] = sites['start_month'] + (sites['study_month'] - 1).to_numpy()
+
+    actual = actual.merge(start, on=site_cols)
+    actual['study_month'] = np.clip(actual['obtain_month'].array.asi8 - actual['start_month'].array.asi8, 0, None) + 1
+    actual = actual.groupby(site_cols + ['study_month'], as_index=False)['Actual: Monthly'].sum()
+
+    sites = sites.merge(actual, how='left', on=site_cols + ['study_month'])
+    sites = sites.merge(expectations.drop(columns='Month'), how='left', on=site_cols + ['study_month'])
+    sites['Actual: Monthly'] = sites['Actual: Monthly'].fillna(0).astype(int)
+    sites['Actual: Cumulative'] = sites.groupby(site_cols, sort=False)['Actual: Monthly'].cumsum()
+    sites['Month: Study'] = sites['study_month']
+    sites['Month: Calendar'] = sites['Month'].dt.strftime('%b %Y')
+    sites['Site'] = sites['screening_site'] + ' (' + sites['surgery_type'] + ')'
+
+    site_cols_display = ['Month: Study', 'Month: Calendar', 'Actual: Monthly', 'Expected: Monthly', 'Actual: Cumulative', 'Expected: Cumulative']
+    return {site: site_df[site_cols_display].reset_index(drop=True) for site, site_df in sites.groupby('Site', sort=True)}
+
 def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations):
     enrollment_df = enrollment_df.merge(enrollment_expectations_df[['mcc','surgery_type','start_month']], how='left', on=['mcc','surgery_type'])
 
@@ -1091,7 +1373,7 @@ def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, mo
     ee_rollup.loc[ee_rollup['Actual: Monthly'] == 0, 'Percent: Monthly'] = ''
 
     # Add Site name column
-    ee_rollup['Site'] = ee_rollup.apply(lambda x: 'MCC' + str(x['mcc']) + ' (' + x['surgery_type'] + ')',axis=1)
+    ee_rollup['Site'] = 'MCC' + ee_rollup['mcc'].astype(str) + ' (' + ee_rollup['surgery_type'] + ')'
     ee_rollup_cols = ['Site','Month', 'Actual: Monthly', 'Actual: Cumulative',
        'Expected: Monthly', 'Expected: Cumulative', 'Percent: Monthly','Percent: Cumulative']
 
@@ -1106,65 +1388,280 @@ def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, mo
 # ----------------------------------------------------------------------------
 # GET DATA FOR PAGE
 # ----------------------------------------------------------------------------
-def get_tables(today, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df):
-    ''' Load all the data for the page'''
-    ## SCREENING TABLES
-    table1a = get_table_1_screening(subjects, consented, ['screening_site','surgery_type'])
-    table1b = get_table_1_screening(subjects, consented, ['mcc','surgery_type'])
+# Tables shown in each section (tab) of the report, in display order
+SECTION_TABLES = {
+    'section1': ("table1a", "table1b", "table2a", "table2b", "table3a", "table3b"),
+    'section2': ("table4", "table5", "table6"),
+    'section3': ("table7a", "table7b", "table8a", "table8b"),
+    'section4': ("sex", "race", "ethnicity", "age"),
+}
+
+# Each table task computes one or more tables from the report inputs (a dict of the time parameters, display
+# terms dictionaries and the subjects, consented, adverse_events and centers_df frames). 'reads' lists the
+# table functions the task calls, whose declared inputs decide when the task's tables need recomputing.
+# Intermediate tasks produce no tables but a frame shared by the tasks that list them in 'depends', which
+# receive it as an extra argument. Tasks that read the report dates can have an 'editions' function, which
+# computes the task's tables for a list of report dates at once (see get_report_editions).
+def run_table1a(inputs):
+    return get_table_1_screening(inputs['subjects'], inputs['consented'], ['screening_site','surgery_type']),
+
+def run_table1b(inputs):
+    return get_table_1_screening(inputs['subjects'], inputs['consented'], ['mcc','surgery_type']),
+
+def run_table2a(inputs):
+    display_terms_t2a = inputs['display_terms_dict_multi']['reason_not_interested']
+    return get_table_2a_screening(inputs['subjects'], display_terms_t2a),
+
+def run_table2b(inputs):
+    return get_table_2b_screening(inputs['subjects'], inputs['start_report'], inputs['end_report']),
+
+def run_table2b_editions(inputs, editions):
+    report_periods = [(edition['start_report'], edition['end_report']) for edition in editions]
+    return [(table2b,) for table2b in get_table_2b_editions(inputs['subjects'], report_periods)]
+
+def run_table3a(inputs):
+    return get_table_3_screening(inputs['consented'], ["screening_site","surgery_type"], inputs['today'], 30),
+
+def run_table3b(inputs):
+    return get_table_3_screening(inputs['consented'], ["mcc","surgery_type"], inputs['today'], 30),
+
+def run_table3a_editions(inputs, editions):
+    today_dates = [edition['today'] for edition in editions]
+    return [(table3a,) for table3a in get_table_3_editions(inputs['consented'], ["screening_site","surgery_type"], today_dates, 30)]
+
+def run_table3b_editions(inputs, editions):
+    today_dates = [edition['today'] for edition in editions]
+    return [(table3b,) for table3b in get_table_3_editions(inputs['consented'], ["mcc","surgery_type"], today_dates, 30)]
 
-    display_terms_t2a = display_terms_dict_multi['reason_not_interested']
-    table2a = get_table_2a_screening(subjects, display_terms_t2a)
+def run_table4(inputs):
+    return get_table_4(inputs['consented'], inputs['today']),
 
-    table2b = get_table_2b_screening(subjects, start_report, end_report)
+def run_table4_editions(inputs, editions):
+    return [(table4,) for table4 in get_table_4_editions(inputs['consented'], [edition['today'] for edition in editions])]
 
-    table3a = get_table_3_screening(consented, ["screening_site","surgery_type"], today, 30)
-    table3b = get_table_3_screening(consented, ["mcc","surgery_type"], today, 30)
+def run_tables_5_6(inputs):
+    return get_tables_5_6(inputs['consented'])
 
-    ## STUDY Status
-    table4 = get_table_4(consented, today)
+def run_deviation_records(inputs):
+    return get_deviation_records(inputs['consented'], inputs['adverse_events'])
 
-    table5, table6 = get_tables_5_6(consented)
+def run_table7a(inputs, deviations):
+    return get_deviations_by_center(inputs['centers_df'], inputs['consented'], deviations, inputs['display_terms_dict_multi']),
 
-    ## Deviations & Adverse Events
-    ### Deviations
-    deviations = get_deviation_records(consented, adverse_events)
-    table7a = get_deviations_by_center(centers_df, consented, deviations, display_terms_dict_multi)
-    table7b = get_table7b_timelimited(deviations)
+def run_table7b(inputs, deviations):
+    return get_table7b_timelimited(deviations, inputs['end_report']),
 
-    ### Adverse Events
-    ae = get_adverse_event_records(consented, adverse_events)
-    table8a = get_adverse_events_by_center(centers_df, consented, ae, display_terms_dict_multi)
-    table8b = get_table_8b(ae, today, None)
+def run_table7b_editions(inputs, editions, deviations):
+    return [(table7b,) for table7b in get_table7b_editions(deviations, [edition['end_report'] for edition in editions])]
 
-    ## Demographics
-    demographics = get_demographic_data(consented)
+def run_adverse_event_records(inputs):
+    return get_adverse_event_records(inputs['consented'], inputs['adverse_events'])
+
+def run_table8a(inputs, ae):
+    return get_adverse_events_by_center(inputs['centers_df'], inputs['consented'], ae, inputs['display_terms_dict_multi']),
+
+def run_table8b(inputs, ae):
+    return get_table_8b(ae, inputs['today'], None),
+
+def run_demographics(inputs):
+    demographics = get_demographic_data(inputs['consented'])
     # get subset of active patients
     demo_active = demographics[demographics['Status']=='Active'].copy()
-    demo_active['category'] = demo_active.apply(lambda x: 'MCC ' + str(x['MCC'])  + ' / ' +x['Surgery'], axis=1)
+    demo_active['category'] = 'MCC ' + demo_active['MCC'].astype(str) + ' / ' + demo_active['Surgery']
+    return demo_active
 
-    # Currently splitting on MCC values
-    split_col = 'category'
+# Demographics rollups are currently split on MCC / surgery category
+def run_sex(inputs, demo_active):
+    return rollup_with_split_col(demo_active, 'Sex', inputs['display_terms_dict'], 'sex', 'category'),
 
-    # SEX
-    demo_df, demo_col, display_terms_dict, display_term_key = demo_active, 'Sex', display_terms_dict, 'sex'
-    sex = rollup_with_split_col(demo_df, demo_col, display_terms_dict, display_term_key, split_col)
+def run_race(inputs, demo_active):
+    return rollup_with_split_col(demo_active, 'Race', inputs['display_terms_dict'], 'dem_race', 'category'),
 
-    # RACE
-    demo_df, demo_col, display_terms_dict, display_term_key = demo_active, 'Race', display_terms_dict, 'dem_race'
-    race = rollup_with_split_col(demo_df, demo_col, display_terms_dict, display_term_key, split_col)
+def run_ethnicity(inputs, demo_active):
+    return rollup_with_split_col(demo_active, 'Ethnicity', inputs['display_terms_dict'], 'ethnic', 'category'),
 
-    # ETHNICITY
-    demo_df, demo_col, display_terms_dict, display_term_key = demo_active, 'Ethnicity', display_terms_dict, 'ethnic'
-    ethnicity = rollup_with_split_col(demo_df, demo_col, display_terms_dict, display_term_key, split_col)
-
-    # AGE
-    # Drop na
+def run_age(inputs, demo_active):
     age_df = demo_active.copy()
     age_df["Age"] = pd.to_numeric(age_df["Age"], errors='coerce') # handle records that have no age value anywhere
-    age = get_describe_col_subset(age_df, 'Age', 'category')
-
-
-    return table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age
+    return get_describe_col_subset(age_df, 'Age', 'category'),
+
+# Tasks are listed so that intermediate tasks come before the tasks that depend on them
+TABLE_TASKS = {
+    'table1a': {'tables': ('table1a',), 'run': run_table1a, 'reads': (get_table_1_screening,)},
+    'table1b': {'tables': ('table1b',), 'run': run_table1b, 'reads': (get_table_1_screening,)},
+    'table2a': {'tables': ('table2a',), 'run': run_table2a, 'reads': (get_table_2a_screening,)},
+    'table2b': {'tables': ('table2b',), 'run': run_table2b, 'reads': (get_table_2b_screening,), 'editions': run_table2b_editions},
+    'table3a': {'tables': ('table3a',), 'run': run_table3a, 'reads': (get_table_3_screening,), 'editions': run_table3a_editions},
+    'table3b': {'tables': ('table3b',), 'run': run_table3b, 'reads': (get_table_3_screening,), 'editions': run_table3b_editions},
+    'table4': {'tables': ('table4',), 'run': run_table4, 'reads': (get_table_4,), 'editions': run_table4_editions},
+    'tables_5_6': {'tables': ('table5', 'table6'), 'run': run_tables_5_6, 'reads': (get_tables_5_6,)},
+    'deviations': {'tables': (), 'run': run_deviation_records, 'reads': (get_deviation_records,)},
+    'table7a': {'tables': ('table7a',), 'run': run_table7a, 'reads': (get_deviations_by_center,), 'depends': ('deviations',)},
+    'table7b': {'tables': ('table7b',), 'run': run_table7b, 'reads': (get_table7b_timelimited,), 'depends': ('deviations',),
+                'editions': run_table7b_editions},
+    'ae': {'tables': (), 'run': run_adverse_event_records, 'reads': (get_adverse_event_records,)},
+    'table8a': {'tables': ('table8a',), 'run': run_table8a, 'reads': (get_adverse_events_by_center,), 'depends': ('ae',)},
+    'table8b': {'tables': ('table8b',), 'run': run_table8b, 'reads': (get_table_8b,), 'depends': ('ae',)},
+    'demographics': {'tables': (), 'run': run_demographics, 'reads': (get_demographic_data,)},
+    'sex': {'tables': ('sex',), 'run': run_sex, 'reads': (), 'depends': ('demographics',)},
+    'race': {'tables': ('race',), 'run': run_race, 'reads': (), 'depends': ('demographics',)},
+    'ethnicity': {'tables': ('ethnicity',), 'run': run_ethnicity, 'reads': (), 'depends': ('demographics',)},
+    'age': {'tables': ('age',), 'run': run_age, 'reads': (), 'depends': ('demographics',)},
+}
+
+def get_task_dependencies(task_name):
+    ''' The task and all the intermediate tasks it depends on'''
+    task_names = {task_name}
+    for dependency in TABLE_TASKS[task_name].get('depends', ()):
+        task_names |= get_task_dependencies(dependency)
+    return task_names
+
+def get_column_hash(inputs, frame_name, column):
+    ''' Hash of one column of an input frame, memoized in the inputs dict'''
+    column_hashes = inputs.setdefault('column_hashes', {})
+    key = (frame_name, column)
+    if key not in column_hashes:
+        df = inputs[frame_name]
+        if column in df.columns:
+            values = pd.util.hash_pandas_object(df[column], index=False).values
+            column_hashes[key] = str(df[column].dtype) + ':' + hashlib.sha1(values.tobytes()).hexdigest()
+        else:
+            column_hashes[key] = 'missing'
+    return column_hashes[key]
+
+def get_task_columns(task_names):
+    ''' The declared input columns of the table functions of the tasks, as a dict of frame name to columns'''
+    declared = {}
+    for task_name in task_names:
+        for table_function in TABLE_TASKS[task_name]['reads']:
+            for frame_name, columns in table_function.table_inputs.items():
+                declared.setdefault(frame_name, set()).update(columns)
+    return declared
+
+# Columns read outside the table functions: to select consented and its treatment site, for the centers and for
+# the enrollment charts. The treatment site columns are added to consented by get_consented_subjects.
+REPORT_COLUMNS = {'subjects': ['obtain_date', 'surgery_type', 'sp_data_site_display', 'redcap_data_access_group_display'],
+                  'consented': ['record_id', 'main_record_id', 'obtain_date', 'mcc', 'screening_site', 'surgery_type', 'ewdateterm']}
+DERIVED_COLUMNS = ['treatment_site', 'treatment_site_type']
+
+def get_report_columns():
+    ''' Manifest of the columns of the subjects and adverse events frames that the report reads, generated from
+    the table_inputs declarations of every table task plus REPORT_COLUMNS. Consented is selected from subjects,
+    so the columns read from consented are listed under subjects.'''
+    declared = get_task_columns(TABLE_TASKS)
+    for frame_name, columns in REPORT_COLUMNS.items():
+        declared.setdefault(frame_name, set()).update(columns)
+    subjects_columns = declared.get('subjects', set()) | declared.get('consented', set())
+    return {'subjects': sorted(subjects_columns - set(DERIVED_COLUMNS)),
+            'adverse_events': sorted(declared.get('adverse_events', set()))}
+
+def get_task_signature(task_name, inputs):
+    ''' Hash of everything a table task reads, including through the intermediate tasks it depends on: the
+    declared columns of each input frame and the dates of the report time parameters used.
+    Tasks with an unchanged signature produce the same tables.'''
+    declared = get_task_columns(get_task_dependencies(task_name))
+
+    signature = hashlib.sha1(task_name.encode())
+    for frame_name in sorted(declared):
+        for column in sorted(declared[frame_name]):
+            if frame_name == 'report':
+                value = str(inputs[column].date())
+            else:
+                value = get_column_hash(inputs, frame_name, column)
+            signature.update('{0}.{1}={2};'.format(frame_name, column, value).encode())
+    return signature.hexdigest()
+
+def get_task_inputs(task_name, inputs):
+    ''' The inputs with the columns the task reads restored to their original dtypes'''
+    task_inputs = dict(inputs)
+    for frame_name, columns in get_task_columns([task_name]).items():
+        if frame_name != 'report':
+            task_inputs[frame_name] = restore_dtypes(inputs[frame_name], columns)
+    return task_inputs
+
+def run_task(task_name, inputs, results):
+    task = TABLE_TASKS[task_name]
+    with report_metrics.timer('table_seconds', task=task_name):
+        task_inputs = get_task_inputs(task_name, inputs)
+        return task['run'](task_inputs, *[results[dependency] for dependency in task.get('depends', ())])
+
+def run_task_graph(task_names, inputs, workers=TABLE_WORKERS):
+    ''' Run the named tasks, which must include the tasks they depend on, returning the result of each.
+    Each task is started as soon as the tasks it depends on are done, on a pool of workers threads.
+    With workers of 1 or less the tasks run one after another in TABLE_TASKS order, which is easier to debug.'''
+    results = {}
+    ordered = [task_name for task_name in TABLE_TASKS if task_name in task_names]
+    if workers <= 1:
+        for task_name in ordered:
+            results[task_name] = run_task(task_name, inputs, results)
+        return results
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='table_task') as executor:
+        running = {}
+        while ordered or running:
+            ready = [task_name for task_name in ordered if all(d in results for d in TABLE_TASKS[task_name].get('depends', ()))]
+            for task_name in ready:
+                ordered.remove(task_name)
+                running[executor.submit(run_task, task_name, inputs, results)] = task_name
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+def run_table_tasks(task_names, inputs, table_memo=None, workers=TABLE_WORKERS):
+    ''' Run table tasks, and the intermediate tasks they depend on, returning a dict of all their tables.
+    If a table_memo (any cache with get and set) is given, tables computed earlier from identical inputs are
+    reused instead of recomputed.'''
+    tables, signatures, pending = {}, {}, []
+    for task_name in task_names:
+        task = TABLE_TASKS[task_name]
+        if table_memo is not None:
+            signatures[task_name] = get_task_signature(task_name, inputs)
+            memo_tables = table_memo.get(signatures[task_name])
+            if memo_tables is not None:
+                logger.info('Reusing tables {0}, inputs unchanged'.format(', '.join(task['tables'])))
+                tables.update(zip(task['tables'], (table.copy() for table in memo_tables)))
+                continue
+        pending.append(task_name)
+
+    graph_tasks = set()
+    for task_name in pending:
+        graph_tasks |= get_task_dependencies(task_name)
+    results = run_task_graph(graph_tasks, inputs, workers)
+
+    for task_name in pending:
+        task_tables = results[task_name]
+        if table_memo is not None:
+            # Keep copies, as callers may modify the tables they are given
+            table_memo.set(signatures[task_name], tuple(table.copy() for table in task_tables))
+        tables.update(zip(TABLE_TASKS[task_name]['tables'], task_tables))
+    return tables
+
+def get_table_inputs(today, start_report, end_report, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df):
+    return {'today': today, 'start_report': start_report, 'end_report': end_report,
+            'display_terms_dict': display_terms_dict, 'display_terms_dict_multi': display_terms_dict_multi,
+            'subjects': subjects, 'consented': consented, 'adverse_events': adverse_events, 'centers_df': centers_df}
+
+def get_sections_tables(sections, inputs, table_memo=None, workers=TABLE_WORKERS):
+    ''' Get the tables for several sections of the page at once, as a dict of section to the section's tables
+    in the order of SECTION_TABLES[section]'''
+    for section in sections:
+        if section not in SECTION_TABLES:
+            raise ValueError('Unknown report section {0}'.format(section))
+    table_names = set(table_name for section in sections for table_name in SECTION_TABLES[section])
+    task_names = [task_name for task_name, task in TABLE_TASKS.items() if table_names & set(task['tables'])]
+    tables = run_table_tasks(task_names, inputs, table_memo, workers)
+    return {section: tuple(tables[table_name] for table_name in SECTION_TABLES[section]) for section in sections}
+
+def get_section_tables(section, inputs, table_memo=None, workers=TABLE_WORKERS):
+    ''' Get the tables for one section of the page, in the order of SECTION_TABLES[section]'''
+    return get_sections_tables([section], inputs, table_memo, workers)[section]
+
+def get_tables(today, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df, workers=TABLE_WORKERS):
+    ''' Load all the data for the page'''
+    inputs = get_table_inputs(today, start_report, end_report, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df)
+    sections_tables = get_sections_tables(SECTION_TABLES, inputs, workers=workers)
+    return sum(sections_tables.values(), ())
 
 def get_enrollment_tables(consented):
     enrollment_df = get_enrollment_data(consented)
@@ -1175,8 +1672,47 @@ def get_enrollment_tables(consented):
     mcc1_enrollments = get_site_enrollments(enrollment_count, 1)
     mcc2_enrollments = get_site_enrollments(enrollment_count, 2)
 
-    enrollment_expectations_df = get_enrollment_expectations()
-    monthly_expectations = get_enrollment_expectations_monthly(enrollment_expectations_df)
+    site_expectations = get_site_enrollment_expectations(ASSETS_PATH)
+    enrollment_expectations_df = get_enrollment_expectations(site_expectations)
+    monthly_expectations = get_enrollment_expectations_monthly(site_expectations)
     summary_rollup = rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations)
 
-    return mcc1_enrollments, mcc2_enrollments, summary_rollup
\ No newline at end of file
+    return mcc1_enrollments, mcc2_enrollments, summary_rollup
+
+# ----------------------------------------------------------------------------
+# REPORT EDITIONS
+# ----------------------------------------------------------------------------
+def get_edition_time_parameters(end_report):
+    ''' Report time parameters of the edition of the report for end_report, as if it was generated on that date'''
+    today, start_report, end_report, report_date_msg, report_range_msg = get_time_parameters(end_report)
+    return {'today': end_report, 'start_report': start_report, 'end_report': end_report}
+
+def get_report_editions(end_reports, inputs, workers=TABLE_WORKERS):
+    ''' The tables of the report for each of end_reports from the same data, as a list of dicts of table name to
+    table. Tables that do not read the report dates are computed once and shared by all editions; tables that do
+    are computed for all editions at once by their task's 'editions' function, or else once per edition.
+    Intermediate tasks are computed once, so they must not read the report dates.'''
+    editions = [get_edition_time_parameters(end_report) for end_report in end_reports]
+    dated_tasks = [task_name for task_name, task in TABLE_TASKS.items()
+                   if task['tables'] and 'report' in get_task_columns(get_task_dependencies(task_name))]
+
+    graph_tasks = set()
+    for task_name in TABLE_TASKS:
+        graph_tasks |= get_task_dependencies(task_name) - (set(dated_tasks) & {task_name})
+    results = run_task_graph(graph_tasks, inputs, workers)
+    shared_tables = {}
+    for task_name in graph_tasks:
+        shared_tables.update(zip(TABLE_TASKS[task_name]['tables'], results[task_name]))
+
+    editions_tables = [dict(shared_tables) for edition in editions]
+    for task_name in dated_tasks:
+        task = TABLE_TASKS[task_name]
+        dependencies = [results[dependency] for dependency in task.get('depends', ())]
+        with report_metrics.timer('table_seconds', task=task_name + '_editions'):
+            if 'editions' in task:
+                task_editions = task['editions'](get_task_inputs(task_name, inputs), editions, *dependencies)
+            else:
+                task_editions = [task['run'](get_task_inputs(task_name, dict(inputs, **edition)), *dependencies) for edition in editions]
+        for tables, task_tables in zip(editions_tables, task_editions):
+            tables.update(zip(task['tables'], task_tables))
+    return editions_tables
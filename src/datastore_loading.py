@@ -1,7 +1,14 @@
 import os
+import json
+import hashlib
+import re
+import operator
+import threading
 import flask
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import pandas as pd
 
 
 # ---------------------------------
@@ -9,6 +16,13 @@ import logging
 # ---------------------------------
 DATASTORE_URL = os.environ.get("DATASTORE_URL","url not found")
 DATASTORE_URL = os.path.join(DATASTORE_URL, "api/")
+DATASTORE_CONNECT_TIMEOUT = float(os.environ.get("DATASTORE_CONNECT_TIMEOUT", 5))
+DATASTORE_READ_TIMEOUT = float(os.environ.get("DATASTORE_READ_TIMEOUT", 150))
+DATASTORE_POOL_SIZE = int(os.environ.get("DATASTORE_POOL_SIZE", 4))
+# Query parameter of the datastore api that selects the fields returned, if supported ("" to always request all fields)
+DATASTORE_FIELDS_PARAM = os.environ.get("DATASTORE_FIELDS_PARAM", "")
+# consented is also sent, but is derived from subjects_cleaned by the report rather than parsed
+PAYLOAD_FRAMES = ('subjects_cleaned', 'adverse_events')
 logger  = logging.getLogger("imaging_app")
 
 # ---------------------------------
@@ -18,16 +32,329 @@ logger  = logging.getLogger("imaging_app")
 class PortalAuthException(Exception):
     '''Custom Exception for issues with Authentication'''
 
-def get_api_data(api_address, ignore_cache=False):
-    api_json = {}
-    try:
-        params = {}
+class DatastoreClient:
+    '''Client for the datastore api. Each worker process gets its own pooled keep-alive session. The validators
+    and fingerprint of the last payload for each address and field selection are kept, so that unchanged data can
+    be revalidated with ETag / Last-Modified headers rather than downloaded again. The payload itself is not kept:
+    an unchanged payload is identified by its fingerprint, for which the report data is cached.'''
+
+    def __init__(self, timeout=(DATASTORE_CONNECT_TIMEOUT, DATASTORE_READ_TIMEOUT), pool_size=DATASTORE_POOL_SIZE):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._session_pid = None
+        self._validators = {}
+        self._fields_unsupported = set()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Sessions are not shared across forked gunicorn workers, so create one per process
+        if self._session is None or self._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session, self._session_pid = session, os.getpid()
+            self._validators = {}
+        return self._session
+
+    def get(self, api_address, ignore_cache=False, cookies=None, fields=None, revalidate=True):
+        '''Request data from the datastore, returning the top level status fields of the response, the raw json
+        payload and a fingerprint of it identifying the data version. If the payload is unchanged since the last
+        request it is not downloaded again, and None is returned for it with the fingerprint of the last payload.
+        Cookies default to those of the current flask request.
+        ignore_cache asks the datastore to bypass its cache, and revalidate=False requests the payload in full.
+        fields lists the fields needed, sent as the DATASTORE_FIELDS_PARAM query parameter if one is configured.
+        If the datastore rejects the parameter, all fields are requested from that address from then on.'''
+        if cookies is None and flask.has_request_context():
+            cookies = flask.request.cookies
+
+        params, headers = {}, {}
+        if fields and DATASTORE_FIELDS_PARAM and api_address not in self._fields_unsupported:
+            params[DATASTORE_FIELDS_PARAM] = ','.join(fields)
+        cache_key = (api_address, params.get(DATASTORE_FIELDS_PARAM))
         if ignore_cache:
-            params = {'ignore_cache':True}
-        response = requests.get(api_address, params=params, cookies=flask.request.cookies)
+            params['ignore_cache'] = True
+        elif revalidate:
+            with self._lock:
+                validators = self._validators.get(cache_key)
+            if validators:
+                if validators['etag']:
+                    headers['If-None-Match'] = validators['etag']
+                if validators['last_modified']:
+                    headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.session.get(api_address, params=params, headers=headers, cookies=cookies, timeout=self.timeout)
+        if response.status_code == 400 and DATASTORE_FIELDS_PARAM in params:
+            # The datastore does not support selecting fields, so ask for the full payload instead
+            result = self.get(api_address, ignore_cache, cookies, revalidate=revalidate)
+            logger.warning('Datastore rejected the {0} parameter, requesting all fields from {1}'.format(DATASTORE_FIELDS_PARAM, api_address))
+            with self._lock:
+                self._fields_unsupported.add(api_address)
+            return result
+
+        if response.status_code == 304 and headers:
+            with self._lock:
+                validators = self._validators.get(cache_key)
+            if validators is not None:
+                return validators['status'], None, validators['fingerprint']
+            # The validators were dropped by another thread since the request was sent, so fetch the data in full
+            response = self.session.get(api_address, params=params, cookies=cookies, timeout=self.timeout)
+
         response.raise_for_status()
-        return response.json()
+        content = response.content
+        fingerprint = payload_fingerprint(content)
+        api_status = get_payload_status(content)
+
+        # Only keep the validators of successful data responses
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        with self._lock:
+            if (etag or last_modified) and 'data' in api_status:
+                self._validators[cache_key] = {'etag': etag, 'last_modified': last_modified,
+                                               'status': api_status, 'fingerprint': fingerprint}
+            else:
+                self._validators.pop(cache_key, None)
+
+        return api_status, content, fingerprint
+
+datastore_client = DatastoreClient()
+
+def get_api_payload(api_address, ignore_cache=False, cookies=None, fields=None, revalidate=True):
+    '''Request data from the datastore without parsing the data section. Returns the top level status fields
+    of the response (with a 'data' key if the payload has data), the raw payload, and a fingerprint of the payload
+    which identifies the data version. Payload and fingerprint are None if the request failed. The payload is
+    also None if it is unchanged since the last request, unless revalidate is False.
+    Cookies default to those of the current flask request.'''
+    api_status = {}
+    try:
+        return datastore_client.get(api_address, ignore_cache, cookies, fields, revalidate)
     except Exception as e:
         logger.warn(e)
-        api_json['json'] = 'error: {}'.format(e)
-        return api_json
+        api_status['json'] = 'error: {}'.format(e)
+        return api_status, None, None
+
+def payload_fingerprint(content):
+    '''Hash of the raw datastore payload, used as the data version key for caching'''
+    return hashlib.sha256(content).hexdigest()
+
+# ---------------------------------
+#   Parse datastore payload
+# ---------------------------------
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+JSON_TEXT_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Text up to the next bracket outside of a string, taking strings whole so that brackets inside them are not counted
+JSON_SKIP = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+# A string, number or literal
+JSON_SCALAR = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[^ \t\n\r,:\[\]{}"]+')
+# The end of a record followed by the start of another, as records of a list are separated
+JSON_RECORD_SEPARATOR = re.compile(r'\}[ \t\n\r]*,[ \t\n\r]*\{')
+# Bytes of the payload decoded at a time when reading the records of a frame
+PARSE_WINDOW_BYTES = 1 << 20
+
+class PayloadScanner:
+    '''Walks the members of a json payload in its raw bytes. Values that are read are decoded on their own with
+    the C json decoder and values that are not are skipped by matching brackets and strings, so that parts of a
+    response can be read without decoding the rest of it. The values of a list can be read a window of the
+    payload at a time.'''
+
+    def __init__(self, content):
+        self.content = content
+        self.pos = 0
+
+    def peek(self):
+        self.pos = JSON_WHITESPACE.match(self.content, self.pos).end()
+        return self.content[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {0} at position {1} of payload'.format(char.decode(), self.pos))
+        self.pos += 1
+
+    def value(self):
+        '''Decode and return the next complete json value'''
+        self.peek()
+        start = self.pos
+        self.skip()
+        return json.loads(self.content[start:self.pos])
+
+    def skip(self):
+        '''Move past the next complete json value without decoding it'''
+        if self.peek() not in (b'[', b'{'):
+            match = JSON_SCALAR.match(self.content, self.pos)
+            if match is None:
+                raise ValueError('Expected a json value at position {0} of payload'.format(self.pos))
+            self.pos = match.end()
+            return
+        depth = 0
+        while True:
+            self.pos = JSON_SKIP.match(self.content, self.pos).end()
+            char = self.content[self.pos:self.pos + 1]
+            if char in (b'[', b'{'):
+                depth += 1
+            elif char in (b']', b'}'):
+                depth -= 1
+            else:
+                raise ValueError('Unterminated json value at position {0} of payload'.format(self.pos))
+            self.pos += 1
+            if depth == 0:
+                return
+
+    def members(self):
+        '''Iterate over the keys of the object at the current position. The value for each key is skipped
+        if the caller does not consume it.'''
+        self.expect(b'{')
+        if self.peek() == b'}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(b':')
+            self.peek()
+            start = self.pos
+            yield key
+            if self.pos == start:
+                self.skip()
+            separator = self.peek()
+            self.pos += 1
+            if separator == b'}':
+                return
+            if separator != b',':
+                raise ValueError('Expected , or }} at position {0} of payload'.format(self.pos - 1))
+
+    def windows(self, window_bytes=PARSE_WINDOW_BYTES):
+        '''Iterate over the values of the list at the current position, as lists of the values that are
+        complete within each window of window_bytes of the payload. The window grows for a value that is larger.'''
+        self.expect(b'[')
+        if self.peek() == b']':
+            self.pos += 1
+            return
+        while True:
+            self.peek()
+            end = min(self.pos + window_bytes, len(self.content))
+            # Do not cut a multibyte utf-8 character in two
+            while end < len(self.content) and 0x80 <= self.content[end] < 0xC0:
+                end -= 1
+            text = self.content[self.pos:end].decode('utf-8')
+            values, offset, last = [], 0, False
+
+            # Decode the records up to the last separator between records in one go. The slice up to it is only
+            # a valid list if the separator is not inside a string and the list does not end before it.
+            separator = find_last_record_separator(text)
+            if separator is not None:
+                try:
+                    values = json.loads('[' + text[:separator.start() + 1] + ']')
+                    offset = separator.end() - 1
+                except json.JSONDecodeError:
+                    separator = None
+
+            # Otherwise decode one value at a time, up to the end of the list or the last value in the window
+            while not separator and not last:
+                try:
+                    value, value_end = JSON_DECODER.raw_decode(text, offset)
+                except json.JSONDecodeError:
+                    break
+                # A value is only complete if what follows it is in the window (a number may be cut short)
+                next_pos = JSON_TEXT_WHITESPACE.match(text, value_end).end()
+                next_char = text[next_pos:next_pos + 1]
+                if next_char not in (',', ']'):
+                    break
+                values.append(value)
+                last = next_char == ']'
+                offset = JSON_TEXT_WHITESPACE.match(text, next_pos + 1).end()
+
+            if not values:
+                if end == len(self.content):
+                    raise ValueError('Invalid json list value at position {0} of payload'.format(self.pos))
+                window_bytes *= 2
+                continue
+            self.pos += offset if text.isascii() else len(text[:offset].encode('utf-8'))
+            yield values
+            if last:
+                return
+
+def find_last_record_separator(text):
+    '''The match of the last separator between two records in text, or None'''
+    pos = len(text)
+    while True:
+        pos = text.rfind('}', 0, pos)
+        if pos < 0:
+            return None
+        match = JSON_RECORD_SEPARATOR.match(text, pos)
+        if match is not None:
+            return match
+
+def payload_scanner(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return PayloadScanner(content)
+
+def get_payload_status(content):
+    '''Get the top level fields of a datastore response (e.g. error and error_code) without decoding the
+    data section, which is only flagged as present with a 'data' key'''
+    api_status = {}
+    scanner = payload_scanner(content)
+    if scanner.peek() != b'{':
+        return api_status
+    for key in scanner.members():
+        if key == 'data':
+            api_status['data'] = True
+            break
+        api_status[key] = scanner.value()
+    return api_status
+
+def parse_payload_frames(content, frame_names=PAYLOAD_FRAMES, frame_columns=None):
+    '''Build a dataframe for each named frame in the data section of the payload. Frames missing from the
+    payload are returned as empty dataframes. Other frames are skipped without being decoded, and the rest of
+    the payload is not read once all named frames have been built.
+    frame_columns optionally maps frame names to the columns to keep, other columns are not built.'''
+    frames = {}
+    frame_columns = frame_columns or {}
+    scanner = payload_scanner(content)
+    for key in scanner.members():
+        if key != 'data' or scanner.peek() != b'{':
+            continue
+        for name in scanner.members():
+            if name in frame_names:
+                frames[name] = read_payload_frame(scanner, frame_columns.get(name))
+                if len(frames) == len(frame_names):
+                    break
+        break
+    return {name: frames.get(name, pd.DataFrame()) for name in frame_names}
+
+def read_payload_frame(scanner, columns=None):
+    '''Build a dataframe from the frame of the payload at the scanner's position, sent as a list of records or
+    as a dict of columns. If columns is given only those columns are built, in the order they are sent.'''
+    keep = set(columns) if columns is not None else None
+
+    # Records orient: [{col: value, ...}, ...], decoded a window at a time into a list of values per column
+    if scanner.peek() == b'[':
+        column_values, n_rows = None, 0
+        for records in scanner.windows():
+            if column_values is None:
+                # Records of a frame share their fields (DataFrame.to_json writes every column of every record)
+                column_values = {col: [] for col in records[0] if keep is None or col in keep}
+            rows = get_record_rows(records, list(column_values))
+            for values, column in zip(column_values.values(), zip(*rows)):
+                values.extend(column)
+            n_rows += len(records)
+            del records, rows
+        return pd.DataFrame(column_values or {}, index=pd.RangeIndex(n_rows))
+
+    # Columns orient: {col: {index: value, ...}, ...}
+    if scanner.peek() == b'{':
+        return pd.DataFrame.from_dict({col: scanner.value() for col in scanner.members() if keep is None or col in keep})
+
+    scanner.skip()
+    return pd.DataFrame()
+
+def get_record_rows(records, columns):
+    '''The values of columns in each record, as tuples'''
+    if len(columns) > 1:
+        try:
+            return list(map(operator.itemgetter(*columns), records))
+        except KeyError:
+            pass
+    return [tuple(record.get(col) for col in columns) for record in records]
@@ -0,0 +1,151 @@
+import re
+import json
+import html as html_text
+import textwrap
+import logging
+
+from plotly.offline import get_plotlyjs_version
+
+logger = logging.getLogger("weekly_ui")
+
+# ----------------------------------------------------------------------------
+# STATIC HTML EXPORT
+# ----------------------------------------------------------------------------
+# Static html of the report, rendered from the same dash components as the page so that it can be written without
+# a browser or the dash server. Tables are rendered as html tables and graphs with plotly.js; interactive controls
+# are left out.
+
+HTML_PAGE_STYLE = '''
+    body { margin: 20px; }
+    table.report-table { border-collapse: collapse; margin-bottom: 1rem; font-family: sans-serif; }
+    table.report-table th { background-color: grey; color: white; font-weight: bold; text-align: center; }
+    table.report-table th, table.report-table td { padding: 5px; border-bottom: 1px solid #d9d9d9; text-align: left; vertical-align: top; }
+    .card { margin-bottom: 1rem; }
+    @media print { .plotly-graph-div { page-break-inside: avoid; } }
+'''
+
+def get_style_attribute(style):
+    ''' CSS text of a dash style dict, whose keys may be camel case (e.g. whiteSpace)'''
+    return '; '.join('{0}: {1}'.format(re.sub('([A-Z])', lambda m: '-' + m.group(1).lower(), key), value)
+                     for key, value in style.items())
+
+def get_tag_attributes(component):
+    ''' Attributes of the html tag of a component: its class name, style and (string) id'''
+    attributes = []
+    if getattr(component, 'id', None) and isinstance(component.id, str):
+        attributes.append(('id', component.id))
+    if getattr(component, 'className', None):
+        attributes.append(('class', component.className))
+    if getattr(component, 'style', None):
+        attributes.append(('style', get_style_attribute(component.style)))
+    return ''.join(' {0}="{1}"'.format(name, html_text.escape(str(value))) for name, value in attributes)
+
+def format_cell(value):
+    ''' Text of a table cell, showing whole floats as integers as the datatable does'''
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return html_text.escape(str(value))
+
+def get_script_json(value):
+    ''' json of a value for use inside a script tag'''
+    return json.dumps(value, default=str).replace('</', '<\\/')
+
+def render_markdown(text, dedent=True):
+    ''' Render the markdown of the report's notes: paragraphs of text with **bold** and *italic* spans'''
+    if dedent:
+        text = textwrap.dedent(text)
+    text = html_text.escape(text.strip('\n'))
+    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
+    return re.sub(r'\*(.+?)\*', r'<em>\1</em>', text)
+
+def render_datatable(columns, data):
+    ''' An html table of a DataTable's columns and records. Columns with multilevel names get one header row
+    per level, merging neighbouring headers that are the same on that level and all levels above it.'''
+    names = [column['name'] if isinstance(column['name'], (list, tuple)) else [column['name']] for column in columns]
+    levels = max([len(name) for name in names] or [1])
+    names = [list(name) + [''] * (levels - len(name)) for name in names]
+
+    header_rows = []
+    for level in range(levels):
+        cells = []
+        for name in names:
+            if cells and cells[-1][0] == name[:level + 1]:
+                cells[-1][1] += 1
+            else:
+                cells.append([name[:level + 1], 1])
+        header_rows.append(''.join('<th colspan="{0}">{1}</th>'.format(span, format_cell(name[-1])) if span > 1
+                                   else '<th>{0}</th>'.format(format_cell(name[-1])) for name, span in cells))
+
+    column_ids = [column['id'] for column in columns]
+    body_rows = [''.join('<td>{0}</td>'.format(format_cell(record.get(column_id))) for column_id in column_ids)
+                 for record in data]
+    return '<table class="report-table"><thead>{0}</thead><tbody>{1}</tbody></table>'.format(
+        ''.join('<tr>{0}</tr>'.format(row) for row in header_rows),
+        ''.join('<tr>{0}</tr>'.format(row) for row in body_rows))
+
+def render_component(component, table_data):
+    ''' Static html of a dash component tree. table_data collects the data of report table stores by their index,
+    for the report tables that follow them and are filled from the store in the browser.'''
+    if component is None:
+        return ''
+    if isinstance(component, (list, tuple)):
+        return ''.join(render_component(child, table_data) for child in component)
+    if not hasattr(component, '_type'):
+        return html_text.escape(str(component))
+
+    namespace, component_type = component._namespace, component._type
+    children = getattr(component, 'children', None)
+    if namespace == 'dash_html_components':
+        tag = component_type.lower()
+        return '<{0}{1}>{2}</{0}>'.format(tag, get_tag_attributes(component), render_component(children, table_data))
+
+    if namespace == 'dash_bootstrap_components':
+        if component_type == 'Col':
+            classes = ['col-{0}-{1}'.format(size, getattr(component, size)) for size in ('sm', 'md', 'lg', 'xl')
+                       if getattr(component, size, None)]
+            width = getattr(component, 'width', None)
+            classes = ['col-{0}'.format(width) if width else 'col'] + classes
+        else:
+            classes = [{'Row': 'row', 'Card': 'card', 'CardBody': 'card-body'}.get(component_type, '')]
+        content = render_component(children, table_data)
+        if component_type == 'Card' and getattr(component, 'body', False):
+            content = '<div class="card-body">{0}</div>'.format(content)
+        return '<div class="{0}"{1}>{2}</div>'.format(' '.join(classes).strip(), get_tag_attributes(component), content)
+
+    if namespace == 'dash_core_components':
+        if component_type == 'Markdown':
+            return '<div{0}>{1}</div>'.format(get_tag_attributes(component),
+                                              render_markdown(children or '', getattr(component, 'dedent', True)))
+        if component_type == 'Store':
+            store_id = getattr(component, 'id', None)
+            if isinstance(store_id, dict) and store_id.get('type') == 'report_table_data':
+                table_data[store_id['index']] = component.data
+            return ''
+        if component_type == 'Graph':
+            figure = getattr(component, 'figure', None) or {}
+            graph_id = component.id if isinstance(getattr(component, 'id', None), str) else 'graph_{0}'.format(id(component))
+            return '<div id="{0}" class="plotly-graph-div"></div><script>Plotly.newPlot("{0}", {1}, {2}, {{"displayModeBar": false}});</script>'.format(
+                graph_id, get_script_json(figure.get('data', [])), get_script_json(figure.get('layout', {})))
+
+    if namespace == 'dash_table' and component_type == 'DataTable':
+        data = getattr(component, 'data', None) or []
+        table_id = getattr(component, 'id', None)
+        if not data and isinstance(table_id, dict) and table_id.get('index') in table_data:
+            stored = table_data[table_id['index']]
+            data = [dict(zip(stored['columns'], values)) for values in zip(*stored['values'])]
+        return render_datatable(getattr(component, 'columns', None) or [], data)
+
+    # Controls such as toggles and buttons have no static form
+    logger.debug('Not rendering {0}.{1} as static html'.format(namespace, component_type))
+    return render_component(children, table_data)
+
+def render_html_page(title, body, stylesheets=()):
+    ''' A complete html document with the static html of the dash components of body'''
+    head = ['<meta charset="utf-8">', '<title>{0}</title>'.format(html_text.escape(title))]
+    head += ['<link rel="stylesheet" href="{0}">'.format(stylesheet) for stylesheet in stylesheets]
+    head.append('<style>{0}</style>'.format(HTML_PAGE_STYLE))
+    head.append('<script src="https://cdn.plot.ly/plotly-{0}.min.js"></script>'.format(get_plotlyjs_version()))
+    return '<!DOCTYPE html>\n<html>\n<head>\n{0}\n</head>\n<body>\n{1}\n</body>\n</html>\n'.format(
+        '\n'.join(head), render_component(body, {}))
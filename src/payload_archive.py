@@ -0,0 +1,175 @@
+import os
+import glob
+import json
+import hashlib
+import shutil
+import tempfile
+import logging
+from datetime import datetime
+
+import pandas as pd
+
+from single_flight import make_private_directory
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    # Without pyarrow payloads are not archived
+    pa = None
+
+logger = logging.getLogger("weekly_ui")
+
+# ----------------------------------------------------------------------------
+# PAYLOAD ARCHIVE
+# ----------------------------------------------------------------------------
+
+class PayloadArchive:
+    '''Archive of the frames of each datastore payload version, so that any version can be reloaded without the
+    datastore: for fast cold starts, to reproduce the report of a past week or to compare versions offline.
+    Each version is stored under directory/<fetch date>/<data version>/ as one uncompressed Arrow IPC file per
+    frame, which is read through a memory map, and a manifest.json with the fetch time, the columns and rows of
+    each frame and a sha256 of each file, checked before the file is loaded. Only the last max_versions versions
+    fetched are kept (0 keeps every version).
+    Without a directory, or where pyarrow (an optional dependency) is not installed, nothing is archived and
+    nothing is found.'''
+
+    def __init__(self, directory, max_versions=0):
+        self.directory = directory
+        self.max_versions = max_versions
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and pa is not None
+
+    def find(self, data_version):
+        '''The directory of an archived data version, or None'''
+        if not self.enabled or not data_version:
+            return None
+        paths = glob.glob(os.path.join(self.directory, '*', data_version, 'manifest.json'))
+        return os.path.dirname(paths[0]) if paths else None
+
+    def manifests(self):
+        '''The manifests of all archived versions, oldest first'''
+        if not self.enabled:
+            return []
+        manifests = []
+        for path in glob.glob(os.path.join(self.directory, '*', '*', 'manifest.json')):
+            try:
+                with open(path) as f:
+                    manifests.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(manifests, key=lambda manifest: manifest['fetched'])
+
+    def latest(self, on_or_before=None):
+        '''The manifest of the last version fetched on or before a date (default any date), or None'''
+        manifests = [manifest for manifest in self.manifests()
+                     if on_or_before is None or datetime.fromisoformat(manifest['fetched']).date() <= on_or_before]
+        return manifests[-1] if manifests else None
+
+    def save(self, data_version, frames, fetched=None):
+        '''Archive the frames (a dict of frame name to dataframe) of a data version, unless it is already archived'''
+        if not self.enabled or not data_version or self.find(data_version):
+            return
+        fetched = fetched or datetime.now()
+        # The archive holds subject data, so it is kept private to the user running the app
+        if not make_private_directory(self.directory):
+            return
+        partition = os.path.join(self.directory, fetched.strftime('%Y-%m-%d'))
+        try:
+            os.makedirs(partition, exist_ok=True)
+            # Write to a temporary directory first so that other processes never load a partly written version
+            temp_dir = tempfile.mkdtemp(dir=partition, prefix='.tmp')
+            manifest = {'data_version': data_version, 'fetched': fetched.isoformat(), 'frames': {}}
+            for frame_name, df in frames.items():
+                path = os.path.join(temp_dir, frame_name + '.arrow')
+                table, json_columns = get_arrow_table(df)
+                with pa.OSFile(path, 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+                manifest['frames'][frame_name] = {'columns': list(df.columns), 'rows': len(df),
+                                                  'json_columns': json_columns, 'sha256': get_file_hash(path)}
+            with open(os.path.join(temp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            try:
+                os.rename(temp_dir, os.path.join(partition, data_version))
+            except OSError:
+                # Another process archived the version meanwhile
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            self.prune()
+        except Exception:
+            logger.exception('Could not archive data version {0} in {1}'.format(data_version, self.directory))
+
+    def prune(self):
+        '''Delete the versions fetched before the last max_versions, and date partitions left empty'''
+        if not self.enabled or not self.max_versions:
+            return
+        for manifest in self.manifests()[:-self.max_versions]:
+            version_dir = self.find(manifest['data_version'])
+            if version_dir is None:
+                continue
+            logger.info('Removing archived data version {0}'.format(manifest['data_version']))
+            shutil.rmtree(version_dir, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(version_dir))
+            except OSError:
+                # The partition still has other versions
+                pass
+
+    def load(self, data_version, frame_columns=None):
+        '''The frames of an archived data version, or None if it is not archived. frame_columns optionally maps
+        frame names to the columns needed, and None is returned if the archived frames lack any of them.'''
+        version_dir = self.find(data_version)
+        if version_dir is None:
+            return None
+        try:
+            with open(os.path.join(version_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+            for frame_name, columns in (frame_columns or {}).items():
+                archived = manifest['frames'].get(frame_name)
+                if archived is None or not set(columns) <= set(archived['columns']):
+                    logger.info('Archived data version {0} lacks columns of {1}'.format(data_version, frame_name))
+                    return None
+            frames = {}
+            for frame_name, archived in manifest['frames'].items():
+                columns = None
+                if frame_columns and frame_name in frame_columns:
+                    columns = [col for col in archived['columns'] if col in set(frame_columns[frame_name])]
+                path = os.path.join(version_dir, frame_name + '.arrow')
+                if get_file_hash(path) != archived['sha256']:
+                    logger.warning('Archived {0} of data version {1} does not match its checksum'.format(frame_name, data_version))
+                    return None
+                with pa.memory_map(path, 'r') as source:
+                    table = pa.ipc.open_file(source).read_all()
+                if columns is not None:
+                    table = table.select(columns)
+                df = table.to_pandas()
+                for col in archived['json_columns']:
+                    if col in df.columns:
+                        df[col] = df[col].map(json.loads, na_action='ignore')
+                frames[frame_name] = df
+            return frames
+        except Exception:
+            logger.exception('Could not load archived data version {0}'.format(data_version))
+            return None
+
+def get_arrow_table(df):
+    '''Convert a frame to an Arrow table. Columns of mixed python types, which Arrow can not store, are stored
+    as json strings and returned as the list of json columns.'''
+    json_columns = []
+    columns = {}
+    for col in df.columns:
+        try:
+            columns[col] = pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            json_columns.append(col)
+            columns[col] = pa.array(df[col].map(json.dumps, na_action='ignore'), type=pa.string(), from_pandas=True)
+    return pa.table(columns), json_columns
+
+def get_file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
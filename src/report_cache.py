@@ -0,0 +1,47 @@
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------
+# REPORT CACHE
+# ----------------------------------------------------------------------------
+
+class ReportCache:
+    '''In-memory cache of computed report data keyed by data version.
+    Entries expire after ttl seconds, and the least recently used entry is evicted once max_entries is reached.'''
+
+    def __init__(self, ttl=3600, max_entries=4):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Return the cached value for key, or None if it is missing or expired'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl and time.monotonic() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
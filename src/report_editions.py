@@ -0,0 +1,65 @@
+'''Write the weekly report without the dash app, e.g. from cron, and backfill past editions of it: an excel
+workbook and/or a static html page per report date.
+
+Each edition is the report as it would have been generated on its date from the same data. The data is
+requested from the datastore (authenticated with REPORT_REFRESH_COOKIES), read from a saved datastore response,
+or loaded from the payload archive without the datastore, and parsed once for all editions. The files of
+many editions can be written by a pool of processes.
+
+    python report_editions.py --weeks 1 --format xlsx html --output reports
+    python report_editions.py --end 2026-10-18 --weeks 13 --output editions
+    python report_editions.py --payload subjects.json --dates 2026-09-01 2026-10-01 --output editions
+    python report_editions.py --end 2026-10-18 --weeks 52 --format xlsx html --processes 4 --output editions
+    python report_editions.py --archived 2026-10-11 --weeks 1 --end 2026-10-11 --output editions
+'''
+import argparse
+import warnings
+from datetime import datetime, timedelta
+
+from app import *
+
+def get_end_reports(end, weeks):
+    ''' Weekly report dates ending at end, oldest first'''
+    return [end - timedelta(weeks=week) for week in reversed(range(weeks))]
+
+def get_payload(payload_path=None, archived=None):
+    ''' The payload and data version to build the editions from: the archived version last fetched on or before
+    archived, a saved datastore response, or the current data from the datastore'''
+    if archived:
+        if not payload_archive.enabled:
+            raise Exception('The payload archive is off: set PAYLOAD_ARCHIVE_DIR and install pyarrow')
+        manifest = payload_archive.latest(archived.date())
+        if manifest is None:
+            raise Exception('No data version archived on or before {0} in {1}'.format(archived.date(), PAYLOAD_ARCHIVE_DIR))
+        return None, manifest['data_version']
+    if payload_path:
+        with open(payload_path, 'rb') as f:
+            payload = f.read()
+        return payload, payload_fingerprint(payload)
+    api_address = DATASTORE_URL + 'subjects'
+    api_status, payload, data_version = get_api_payload(api_address, cookies=get_refresh_cookies(), fields=PAYLOAD_FIELDS, revalidate=False)
+    check_api_status(api_status)
+    if not payload or 'data' not in api_status:
+        raise Exception('No data from api {0}: {1}'.format(api_address, api_status))
+    return payload, data_version
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--end', type=datetime.fromisoformat, default=datetime.now(), help='date of the latest edition (default now)')
+    parser.add_argument('--weeks', type=int, default=13, help='number of weekly editions ending at --end')
+    parser.add_argument('--dates', type=datetime.fromisoformat, nargs='+', help='report dates to write instead of weekly editions')
+    parser.add_argument('--payload', help='saved datastore response to read instead of requesting the datastore')
+    parser.add_argument('--archived', type=datetime.fromisoformat, help='use the data version archived last on or before this date')
+    parser.add_argument('--format', nargs='+', choices=['xlsx', 'html'], default=['xlsx'], help='files to write for each edition')
+    parser.add_argument('--processes', type=int, default=1, help='processes writing the editions (default 1, one after another)')
+    parser.add_argument('--output', default='report_editions', help='directory to write the reports to')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    end_reports = args.dates or get_end_reports(args.end, args.weeks)
+    payload, data_version = get_payload(args.payload, args.archived)
+    paths = build_report_editions(payload, end_reports, args.output, data_version, args.format, args.processes)
+    print('{0} editions written to {1}: {2} files'.format(len(end_reports), args.output, len(paths)))
+
+if __name__ == '__main__':
+    main()
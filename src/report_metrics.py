@@ -0,0 +1,260 @@
+import os
+import glob
+import json
+import tempfile
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks (e.g. Windows), so files of exited workers are kept rather than merged
+    fcntl = None
+
+from config_settings import *
+from single_flight import make_private_directory
+
+logger = logging.getLogger("weekly_ui")
+
+# ----------------------------------------------------------------------------
+# METRIC DEFINITIONS
+# ----------------------------------------------------------------------------
+METRICS_PREFIX = 'weekly_report_'
+METRIC_DEFINITIONS = {
+    'stage_seconds': ('histogram', 'Time spent in each stage of loading and building the report'),
+    'table_seconds': ('histogram', 'Time spent computing each table task'),
+    'payload_bytes': ('gauge', 'Size of the last datastore payload parsed into report data'),
+    'rows': ('gauge', 'Rows of each frame in the last report data built'),
+}
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# ----------------------------------------------------------------------------
+# REPORT METRICS
+# ----------------------------------------------------------------------------
+
+class ReportMetrics:
+    '''Histograms and gauges of report stages, rendered in the Prometheus text format.
+    Each worker process writes its own values to a json file in directory when flush() is called (after each
+    request) and at most every flush_interval seconds while values are observed, and render() adds up the files
+    of all workers so that any worker can serve the metrics of the host. The files of workers that have exited
+    are merged into one aggregate file, so counts keep increasing across worker restarts without the files
+    piling up.
+    Histograms are summed across workers, and gauges report the most recently set value.
+    The directory is created private to the user running the app; without one (or if it can not be made
+    private) each worker renders only its own values.'''
+
+    def __init__(self, directory=None, buckets=SECONDS_BUCKETS, flush_interval=10):
+        self.directory = directory
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self._private = None
+        self._values = None
+        self._values_pid = None
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        '''Whether the values are shared with the other workers through the directory'''
+        if not self.directory:
+            return False
+        if self._private is None:
+            self._private = make_private_directory(self.directory)
+        return self._private
+
+    @property
+    def values(self):
+        # Values are per worker process, so start afresh after the gunicorn fork
+        if self._values is None or self._values_pid != os.getpid():
+            self._values, self._values_pid = {'histogram': {}, 'gauge': {}}, os.getpid()
+        return self._values
+
+    def observe(self, name, value, **labels):
+        '''Add a value to a histogram'''
+        with self._lock:
+            series = self.values['histogram'].setdefault(name, {})
+            key = get_labels_key(labels)
+            if key not in series:
+                series[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            bucket_index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_index = i
+                    break
+            series[key]['buckets'][bucket_index] += 1
+            series[key]['sum'] += value
+            series[key]['count'] += 1
+            self._dirty = True
+        self._flush_if_due()
+
+    def set(self, name, value, **labels):
+        '''Set a gauge'''
+        with self._lock:
+            self.values['gauge'].setdefault(name, {})[get_labels_key(labels)] = [time.time(), value]
+            self._dirty = True
+        self._flush_if_due()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Observe the seconds spent in the with block'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _flush_if_due(self):
+        if self.enabled and time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''Write this worker's values for the other workers if they changed since the last write, and merge the
+        files of workers that have exited'''
+        if not self.enabled:
+            return
+        # Only one thread writes at a time; others skip, as the writing thread's flush covers their values
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                self._last_flush = time.monotonic()
+                if not self._dirty:
+                    return
+                values_json = json.dumps(self.values)
+                self._dirty = False
+            write_json(os.path.join(self.directory, '{0}.json'.format(os.getpid())), values_json, self.directory)
+            self._merge_exited_workers()
+        except Exception:
+            logger.exception('Could not write report metrics to {0}'.format(self.directory))
+        finally:
+            self._write_lock.release()
+
+    def _merge_exited_workers(self):
+        if fcntl is None:
+            return
+        with open(os.path.join(self.directory, 'metrics.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            exited = [path for path in glob.glob(os.path.join(self.directory, '*.json'))
+                      if is_exited_worker_file(path)]
+            if not exited:
+                return
+            aggregate_path = os.path.join(self.directory, 'aggregate.json')
+            combined = read_json(aggregate_path) or {'histogram': {}, 'gauge': {}}
+            for path in exited:
+                values = read_json(path)
+                if values is not None:
+                    combine_values(combined, values)
+            write_json(aggregate_path, json.dumps(combined), self.directory)
+            for path in exited:
+                os.remove(path)
+
+    def collect(self):
+        '''The values of all workers, combined'''
+        with self._lock:
+            worker_values = [json.loads(json.dumps(self.values))]
+        if self.enabled:
+            own_path = os.path.join(self.directory, '{0}.json'.format(os.getpid()))
+            # Read under the lock so files of exited workers are never counted both before and after a merge
+            with open(os.path.join(self.directory, 'metrics.lock'), 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+                for path in glob.glob(os.path.join(self.directory, '*.json')):
+                    if path == own_path:
+                        continue
+                    values = read_json(path)
+                    if values is not None:
+                        worker_values.append(values)
+
+        combined = {'histogram': {}, 'gauge': {}}
+        for values in worker_values:
+            combine_values(combined, values)
+        return combined
+
+    def render(self):
+        '''All metrics in the Prometheus text exposition format'''
+        combined = self.collect()
+        lines = []
+        for name, (metric_type, description) in METRIC_DEFINITIONS.items():
+            series = combined[metric_type].get(name)
+            if not series:
+                continue
+            metric_name = METRICS_PREFIX + name
+            lines.append('# HELP {0} {1}'.format(metric_name, description))
+            lines.append('# TYPE {0} {1}'.format(metric_name, metric_type))
+            for key in sorted(series):
+                labels = json.loads(key)
+                if metric_type == 'gauge':
+                    lines.append('{0}{1} {2}'.format(metric_name, format_labels(labels), format_value(series[key][1])))
+                    continue
+                histogram = series[key]
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    bucket_labels = labels + [['le', bound if bound == '+Inf' else format_value(bound)]]
+                    lines.append('{0}_bucket{1} {2}'.format(metric_name, format_labels(bucket_labels), cumulative))
+                lines.append('{0}_sum{1} {2}'.format(metric_name, format_labels(labels), format_value(histogram['sum'])))
+                lines.append('{0}_count{1} {2}'.format(metric_name, format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+def combine_values(combined, values):
+    '''Add the histograms of values to combined, and take its gauges where they were set more recently'''
+    for name, series in values['histogram'].items():
+        for key, histogram in series.items():
+            total = combined['histogram'].setdefault(name, {}).get(key)
+            if total is None:
+                combined['histogram'][name][key] = histogram
+            else:
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+    for name, series in values['gauge'].items():
+        for key, gauge in series.items():
+            latest = combined['gauge'].setdefault(name, {}).get(key)
+            if latest is None or gauge[0] > latest[0]:
+                combined['gauge'][name][key] = gauge
+
+def is_exited_worker_file(path):
+    ''' Whether path is the values file of a worker process (named by its pid) that is no longer running'''
+    name = os.path.splitext(os.path.basename(path))[0]
+    if not name.isdigit() or int(name) == os.getpid():
+        return False
+    try:
+        os.kill(int(name), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # e.g. running as another user
+        return False
+    return False
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, text, directory):
+    # Write to a temporary file first so that other workers never read a partly written file
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def get_labels_key(labels):
+    return json.dumps(sorted([str(name), str(value)] for name, value in labels.items()))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in escaped) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+report_metrics = ReportMetrics(REPORT_METRICS_DIR)
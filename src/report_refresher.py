@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger("weekly_ui")
+
+# ----------------------------------------------------------------------------
+# REPORT REFRESHER
+# ----------------------------------------------------------------------------
+
+class ReportRefresher:
+    '''Runs refresh() on a background thread every interval seconds, or sooner when woken, so report data can be
+    rebuilt outside of user requests. Threads do not survive the gunicorn fork, so the thread is started lazily
+    in each worker process by start(). A failed refresh is logged and the next one runs at the following interval.
+    An interval of 0 disables the refresher.'''
+
+    def __init__(self, refresh, interval=600):
+        self.refresh = refresh
+        self.interval = interval
+        self.last_refresh = None
+        self.last_error = None
+        self._thread = None
+        self._thread_pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        '''Start the refresh thread for this process if it is not already running'''
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._wake = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='report_refresher', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def wake(self):
+        '''Run a refresh now rather than waiting for the interval'''
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.run_once()
+
+    def run_once(self):
+        start = time.monotonic()
+        try:
+            refreshed = self.refresh()
+            self.last_refresh, self.last_error = time.time(), None
+            if refreshed:
+                logger.info('Report refresh completed in {0:.1f}s'.format(time.monotonic() - start))
+        except Exception as e:
+            self.last_error = e
+            logger.exception('Report refresh failed after {0:.1f}s, keeping the last good version'.format(time.monotonic() - start))
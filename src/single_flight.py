@@ -0,0 +1,135 @@
+import os
+import stat
+import glob
+import pickle
+import tempfile
+import time
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks (e.g. Windows), so every process builds its own results
+    fcntl = None
+
+logger = logging.getLogger("weekly_ui")
+
+# ----------------------------------------------------------------------------
+# SINGLE FLIGHT
+# ----------------------------------------------------------------------------
+
+class SingleFlight:
+    '''Coalesces builds of the same result across the worker processes of a host. The first process to ask for
+    a key takes a lock file for it in directory and builds the result, which is written next to the lock file.
+    Processes asking for the key meanwhile wait for the lock and load that result instead of building their own.
+    Keys must identify their result completely (e.g. include the data version), as stored results are reused
+    until they are ttl seconds old.
+    Locks are released by the operating system if the building process dies, in which case the next waiting
+    process builds the result. A process that has waited wait seconds builds the result itself.
+    Results are unpickled, so the directory must be private to the user running the app: it is created with
+    mode 0700, and not used if it belongs to another user.
+    Without a directory, or where file locks are not available, do simply calls build.'''
+
+    def __init__(self, directory, ttl=3600, wait=180):
+        self.directory = directory
+        self.ttl = ttl
+        self.wait = wait
+        self._private = None
+
+    @property
+    def enabled(self):
+        if not self.directory or fcntl is None:
+            return False
+        if self._private is None:
+            self._private = make_private_directory(self.directory)
+        return self._private
+
+    def do(self, key, build):
+        '''Return the result for key, building it with build() unless another process has or is'''
+        if not self.enabled:
+            return build()
+
+        result = self._load(key)
+        if result is not None:
+            return result
+
+        with open(self._path(key, '.lock'), 'a') as lock_file:
+            if not self._lock(lock_file, key):
+                logger.warning('Waited {0}s for another worker to build {1}, building it here'.format(self.wait, key))
+                return build()
+            try:
+                result = self._load(key)
+                if result is not None:
+                    logger.info('Using {0} built by another worker'.format(key))
+                    return result
+                result = build()
+                self._store(key, result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lock(self, lock_file, key):
+        deadline = time.monotonic() + self.wait
+        logged = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    return False
+                if not logged:
+                    logger.info('Waiting for another worker to build {0}'.format(key))
+                    logged = True
+                time.sleep(0.1)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _load(self, key):
+        path = self._path(key, '.pkl')
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception('Could not load {0}, building it again'.format(path))
+            return None
+
+    def _store(self, key, result):
+        # Write to a temporary file first so that other processes never load a partly written result
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(key, '.pkl'))
+        except Exception:
+            logger.exception('Could not store {0} for other workers'.format(key))
+        self._remove_expired()
+
+    def _remove_expired(self):
+        for path in glob.glob(os.path.join(self.directory, '*')):
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def make_private_directory(directory):
+    '''Create directory with mode 0700, or restrict it to 0700 if it exists. Returns False, logging why, if
+    it is not a directory owned by the user running the app, so other users can not read or plant files there.'''
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.lstat(directory)
+        if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid():
+            logger.warning('Not using {0} for report data: it is not a directory owned by this user'.format(directory))
+            return False
+        if stat.S_IMODE(status.st_mode) != 0o700:
+            os.chmod(directory, 0o700)
+        return True
+    except OSError:
+        logger.exception('Not using {0} for report data'.format(directory))
+        return False
@@ -0,0 +1,110 @@
+'''Revalidation of the datastore payload with ETag / Last-Modified headers, against the benchmark's local stand-in
+for the datastore api with its validators on.'''
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+BENCHMARKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks')
+if BENCHMARKS_PATH not in sys.path:
+    sys.path.insert(0, BENCHMARKS_PATH)
+
+from bench_data_processing import StandInDatastore
+from synthetic_data import generate_subjects_json, get_api_payload_json
+import app
+import datastore_loading
+from data_processing import *
+from datastore_loading import DatastoreClient, payload_fingerprint
+from payload_archive import PayloadArchive
+
+PAYLOAD = b'{"status": "ok", "data": {"subjects_cleaned": [{"record_id": 1}], "adverse_events": []}}'
+
+@pytest.fixture(scope='module')
+def standin():
+    standin = StandInDatastore(port=0)
+    yield standin
+    standin.shutdown()
+
+@pytest.fixture
+def datastore(standin):
+    standin.payload = PAYLOAD
+    standin.requests, standin.statuses = [], []
+    standin.validators = True
+    yield standin
+    standin.validators = False
+
+@pytest.fixture
+def api_address(datastore):
+    return datastore.url + '/api/subjects'
+
+def test_full_response_keeps_validators(datastore, api_address):
+    client = DatastoreClient()
+    api_status, payload, data_version = client.get(api_address, cookies={})
+
+    assert datastore.statuses == [200]
+    assert payload == PAYLOAD
+    assert data_version == payload_fingerprint(PAYLOAD)
+    assert api_status == {'status': 'ok', 'data': True}
+    validators = list(client._validators.values())
+    assert len(validators) == 1
+    assert validators[0]['etag'] and validators[0]['last_modified']
+    assert validators[0]['fingerprint'] == data_version
+    # Only the validators are kept, not the payload
+    assert 'content' not in validators[0]
+
+def test_not_modified_returns_the_last_fingerprint(datastore, api_address):
+    client = DatastoreClient()
+    client.get(api_address, cookies={})
+    api_status, payload, data_version = client.get(api_address, cookies={})
+
+    assert datastore.statuses == [200, 304]
+    assert payload is None
+    assert data_version == payload_fingerprint(PAYLOAD)
+    assert api_status == {'status': 'ok', 'data': True}
+
+    # A changed payload is downloaded again
+    datastore.payload = PAYLOAD.replace(b'"ok"', b'"changed"')
+    api_status, payload, data_version = client.get(api_address, cookies={})
+    assert datastore.statuses[-1] == 200
+    assert payload == datastore.payload
+    assert data_version == payload_fingerprint(datastore.payload)
+
+def test_not_modified_without_validators_refetches(datastore, api_address, monkeypatch):
+    client = DatastoreClient()
+    client.get(api_address, cookies={})
+
+    # Another thread drops the validators while the conditional request is in flight
+    session_get = client.session.get
+    def get_and_drop_validators(*args, **kwargs):
+        response = session_get(*args, **kwargs)
+        client._validators.clear()
+        return response
+    monkeypatch.setattr(client.session, 'get', get_and_drop_validators)
+
+    api_status, payload, data_version = client.get(api_address, cookies={})
+    assert datastore.statuses == [200, 304, 200]
+    assert payload == PAYLOAD
+    assert data_version == payload_fingerprint(PAYLOAD)
+
+def test_report_of_unchanged_data_for_a_new_date_is_fetched_in_full(datastore, monkeypatch):
+    subjects_json, screening_sites = generate_subjects_json(300, seed=0)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    datastore.payload = get_api_payload_json(subjects, consented, adverse_events)
+    monkeypatch.setattr(app, 'DATASTORE_URL', datastore.url + '/api/')
+    monkeypatch.setattr(datastore_loading, 'datastore_client', DatastoreClient())
+    monkeypatch.setattr(app, 'payload_archive', PayloadArchive(''))
+    app.tables_cache.clear()
+
+    data_version, report_data = app.get_report_data(datetime(2026, 10, 18))
+    assert report_data is not None
+    cached_version, cached_report_data = app.get_report_data(datetime(2026, 10, 18))
+    assert cached_version == data_version and cached_report_data is report_data
+    assert datastore.statuses == [200, 304]
+
+    # The payload is unchanged but no report is cached for the new date, so it is requested again in full
+    next_version, next_report_data = app.get_report_data(datetime(2026, 10, 19))
+    assert next_version == data_version
+    assert next_report_data is not None and next_report_data is not report_data
+    assert datastore.statuses == [200, 304, 304, 200]
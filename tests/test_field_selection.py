@@ -0,0 +1,66 @@
+'''The report asks the datastore for only the fields it reads, and still gets its data from a datastore that does
+not support selecting fields. Requests go to the benchmark's local stand-in for the datastore api, which ignores
+the field selection parameter unless told to reject it, as an api that does not know it might.'''
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+BENCHMARKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks')
+if BENCHMARKS_PATH not in sys.path:
+    sys.path.insert(0, BENCHMARKS_PATH)
+
+from bench_data_processing import StandInDatastore
+from synthetic_data import generate_subjects_json, get_api_payload_json
+import app
+import datastore_loading
+from data_processing import *
+from payload_archive import PayloadArchive
+
+N_SUBJECTS = 300
+REPORT_DATE = datetime(2026, 10, 18)
+
+@pytest.fixture(scope='module')
+def standin():
+    subjects_json, screening_sites = generate_subjects_json(N_SUBJECTS, seed=0)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    standin = StandInDatastore(port=0)
+    standin.payload = get_api_payload_json(subjects, consented, adverse_events)
+    yield standin
+    standin.shutdown()
+
+@pytest.fixture
+def datastore(standin, monkeypatch):
+    ''' The stand-in, with the app pointed at it through a new client and the field selection parameter set'''
+    standin.requests = []
+    standin.unsupported_params = ()
+    monkeypatch.setattr(app, 'DATASTORE_URL', standin.url + '/api/')
+    monkeypatch.setattr(datastore_loading, 'DATASTORE_FIELDS_PARAM', 'fields')
+    monkeypatch.setattr(datastore_loading, 'datastore_client', datastore_loading.DatastoreClient())
+    monkeypatch.setattr(app, 'payload_archive', PayloadArchive(''))
+    return standin
+
+def test_report_fields_are_requested(datastore):
+    data_version, report_data = app.get_report_data(REPORT_DATE)
+
+    assert report_data is not None
+    assert datastore.requests[0]['fields'] == ','.join(app.PAYLOAD_FIELDS)
+    # The stand-in sent every field, and only the report's columns were built
+    subjects = report_data['table_inputs']['subjects']
+    assert set(subjects.columns) <= set(app.PAYLOAD_COLUMNS['subjects_cleaned'])
+
+def test_unsupported_fields_parameter_falls_back_to_full_payload(datastore):
+    datastore.unsupported_params = ('fields',)
+    data_version, report_data = app.get_report_data(REPORT_DATE)
+
+    assert report_data is not None
+    assert data_version == datastore_loading.payload_fingerprint(datastore.payload)
+    assert 'fields' in datastore.requests[0]
+    assert 'fields' not in datastore.requests[1]
+
+    # The parameter is not sent again once the datastore has rejected it
+    app.get_report_data(REPORT_DATE)
+    assert 'fields' not in datastore.requests[-1]
+    assert len(datastore.requests) == 3
@@ -0,0 +1,73 @@
+'''Parsing of the datastore payload: the frames built a window of the payload at a time must match those of the
+original response.json() + DataFrame.from_dict path, at a lower peak memory.'''
+import json
+import os
+import sys
+import tracemalloc
+
+import pandas as pd
+import pytest
+
+BENCHMARKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks')
+if BENCHMARKS_PATH not in sys.path:
+    sys.path.insert(0, BENCHMARKS_PATH)
+
+from synthetic_data import generate_subjects_json, get_api_payload_json
+from data_processing import *
+from datastore_loading import PAYLOAD_FRAMES, PayloadScanner, get_payload_status, parse_payload_frames
+
+N_SUBJECTS = 3000
+
+@pytest.fixture(scope='module')
+def payload():
+    subjects_json, screening_sites = generate_subjects_json(N_SUBJECTS, seed=0)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    return get_api_payload_json(subjects, consented, adverse_events)
+
+def baseline_parse_payload_frames(payload):
+    ''' The frames as the app originally built them, from the whole decoded response'''
+    api_json = json.loads(payload)
+    return {name: pd.DataFrame.from_dict(api_json['data'][name]) for name in PAYLOAD_FRAMES}
+
+def get_peak_memory(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def test_frames_match_baseline(payload):
+    baseline_frames = baseline_parse_payload_frames(payload)
+    frames = parse_payload_frames(payload)
+    report_columns = get_report_columns()
+    frame_columns = {'subjects_cleaned': report_columns['subjects'], 'adverse_events': report_columns['adverse_events']}
+    selected_frames = parse_payload_frames(payload, frame_columns=frame_columns)
+
+    for name in PAYLOAD_FRAMES:
+        pd.testing.assert_frame_equal(frames[name], baseline_frames[name], obj=name)
+        columns = [col for col in baseline_frames[name].columns if col in frame_columns[name]]
+        pd.testing.assert_frame_equal(selected_frames[name], baseline_frames[name][columns], obj=name)
+
+def test_peak_memory_below_baseline(payload):
+    baseline_frames, baseline_peak = get_peak_memory(baseline_parse_payload_frames, payload)
+    del baseline_frames
+    frames, peak = get_peak_memory(parse_payload_frames, payload)
+    assert peak < baseline_peak
+
+def test_status_read_without_data():
+    payload = b'{"error": "Not authorized", "error_code": "MISSING_SESSION_ID", "data": {"subjects_cleaned": [{'
+    assert get_payload_status(payload) == {'error': 'Not authorized', 'error_code': 'MISSING_SESSION_ID', 'data': True}
+
+@pytest.mark.parametrize('window_bytes', [1, 7, 64, 1 << 20])
+def test_windows_across_multibyte_characters_and_strings(window_bytes):
+    records = [{'id': i * 1001, 'name': 'ü€}, {' * (i % 4), 'nested': [{'x': ']'}] if i % 3 else None} for i in range(200)]
+    content = json.dumps({'records': records, 'after': 1}, ensure_ascii=False).encode()
+    scanner = PayloadScanner(content)
+    for key in scanner.members():
+        if key == 'records':
+            values = [value for window in scanner.windows(window_bytes) for value in window]
+        else:
+            assert scanner.value() == 1
+    assert values == records
@@ -0,0 +1,42 @@
+'''The metrics of all workers of a host are added up in /metrics, through the files each worker writes to the
+metrics directory.'''
+import json
+import os
+import sys
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+import report_metrics
+from report_metrics import ReportMetrics
+
+def get_worker_values(seconds, rows):
+    ''' The values file of a worker that observed seconds in the parse stage and last set the rows gauge'''
+    metrics = ReportMetrics(None, buckets=(1, 10))
+    for value in seconds:
+        metrics.observe('stage_seconds', value, stage='parse')
+    metrics.set('rows', rows, frame='subjects')
+    return metrics.values
+
+def test_files_of_two_workers_are_summed(tmp_path):
+    directory = str(tmp_path / 'metrics')
+    metrics = ReportMetrics(directory, buckets=(1, 10))
+    assert metrics.enabled
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    for pid, values in [(101, get_worker_values([0.5, 5], 10)), (102, get_worker_values([0.5, 20], 20))]:
+        with open(os.path.join(directory, '{0}.json'.format(pid)), 'w') as f:
+            json.dump(values, f)
+
+    rendered = metrics.render().splitlines()
+    assert 'weekly_report_stage_seconds_bucket{stage="parse",le="1"} 2' in rendered
+    assert 'weekly_report_stage_seconds_bucket{stage="parse",le="10"} 3' in rendered
+    assert 'weekly_report_stage_seconds_bucket{stage="parse",le="+Inf"} 4' in rendered
+    assert 'weekly_report_stage_seconds_sum{stage="parse"} 26.0' in rendered
+    assert 'weekly_report_stage_seconds_count{stage="parse"} 4' in rendered
+    # Gauges report the most recently set value
+    assert 'weekly_report_rows{frame="subjects"} 20' in rendered
+
+def test_sharing_is_on_by_default():
+    assert report_metrics.report_metrics.directory
+    assert report_metrics.report_metrics.enabled
@@ -0,0 +1,55 @@
+'''Assignment of record ids to the screening site whose record id range contains them'''
+import logging
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+from data_processing import ScreeningSiteLookup, add_screening_site
+
+SCREENING_SITES = pd.DataFrame({
+    'screening_site': ['MCC2: Wayne State', 'MCC1: Rush', 'MCC1: NorthShore'],
+    'mcc': [2, 1, 1],
+    'site': ['Wayne State', 'Rush', 'NorthShore'],
+    'surgery_type': ['Thoracic', 'TKA', 'TKA'],
+    'record_id_start': [70000, 30000, 40000],
+    'record_id_end': [79999, 39999, 49999],
+})
+
+def test_range_boundaries_are_inclusive():
+    lookup = ScreeningSiteLookup(SCREENING_SITES)
+    ids = [30000, 39999, 40000, 49999, 70000, 79999, 35000]
+    sites = lookup.sites.loc[lookup.locate(ids), 'site'].tolist()
+    assert sites == ['Rush', 'Rush', 'NorthShore', 'NorthShore', 'Wayne State', 'Wayne State', 'Rush']
+
+def test_ids_outside_every_range_are_not_located():
+    lookup = ScreeningSiteLookup(SCREENING_SITES)
+    # Below the first range, between ranges, above the last range and not a number
+    assert lookup.locate([29999, 50000, 69999, 80000, None]).tolist() == [-1, -1, -1, -1, -1]
+
+def test_unmatched_ids_are_dropped_and_logged(caplog):
+    subjects = pd.DataFrame({'record_id': [39999, 50000, 40000, 80000], 'age': [40, 50, 60, 70]})
+    with caplog.at_level(logging.WARNING, logger='weekly_ui'):
+        df = add_screening_site(SCREENING_SITES, subjects, 'record_id')
+
+    assert df['record_id'].tolist() == [39999, 40000]
+    assert df['screening_site'].tolist() == ['MCC1: Rush', 'MCC1: NorthShore']
+    assert df['age'].tolist() == [40, 60]
+    assert '2 records outside every screening site range were dropped: [50000, 80000]' in caplog.text
+
+def test_lookup_can_be_reused():
+    lookup = ScreeningSiteLookup(SCREENING_SITES)
+    subjects = pd.DataFrame({'record_id': [79999, 30000]})
+    pd.testing.assert_frame_equal(add_screening_site(lookup, subjects, 'record_id'),
+                                  add_screening_site(SCREENING_SITES, subjects, 'record_id'))
+
+def test_overlapping_ranges_are_rejected():
+    overlapping = SCREENING_SITES.copy()
+    overlapping.loc[2, 'record_id_start'] = 39999
+    with pytest.raises(ValueError):
+        ScreeningSiteLookup(overlapping)
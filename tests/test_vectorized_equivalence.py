@@ -0,0 +1,148 @@
+'''The vectorized consented, table 4 and rollup code must build the same tables as the row-wise applies it
+replaced. Every table is built from the benchmark's synthetic datastore payload twice, once with the reference
+(original) implementations patched in and once with the code as it is, and the results compared.'''
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from dateutil.relativedelta import relativedelta
+
+BENCHMARKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks')
+if BENCHMARKS_PATH not in sys.path:
+    sys.path.insert(0, BENCHMARKS_PATH)
+
+from synthetic_data import generate_subjects_json, get_api_payload_json
+import data_processing
+from data_processing import *
+from datastore_loading import parse_payload_frames
+
+N_SUBJECTS = 3000
+REPORT_DATE = datetime(2026, 10, 18)
+
+# ----------------------------------------------------------------------------
+# REFERENCE IMPLEMENTATIONS
+# ----------------------------------------------------------------------------
+
+def reference_get_consented_subjects(subjects_with_screening_site):
+    consented = subjects_with_screening_site[subjects_with_screening_site.obtain_date.notnull()].copy()
+    consented['treatment_site'] = consented.apply(lambda x: use_b_if_not_a(x['sp_data_site_display'],x['redcap_data_access_group_display']), axis=1)
+    consented['treatment_site_type'] = consented['treatment_site'] + "/" + consented['surgery_type']
+    return consented
+
+def reference_get_table_4(consented_patients, compare_date = datetime.now()):
+    category_cols = ["treatment_site", "surgery_type"]
+    table4_cols = ["main_record_id",  "start_v1_preop","sp_surg_date",
+                   "start_v2_6wk","start_v3_3mo","start_6mo","start_12mo", 'ewdateterm','ewprimaryreason']
+    table4 = consented_patients[category_cols + table4_cols].copy()
+    table4 = table4.sort_values(by=['main_record_id'])
+
+    table4['sp_surg_date'] = table4['sp_surg_date'].apply(pd.to_datetime)
+    table4['surg_complete'] = table4['sp_surg_date'] < compare_date
+    table4['ewdateterm'] = table4['ewdateterm'].notnull()
+    table4['death'] = table4['ewprimaryreason'] == 4
+
+    def complete_conditions(compare_date, sp_surg_date, ewdateterm):
+        if sp_surg_date is pd.NaT:
+            return False
+        elif ewdateterm:
+            return False
+        else:
+            return compare_date.date() > sp_surg_date.date() + relativedelta(months=7)
+
+    table4['complete'] =  table4.apply(lambda x: complete_conditions(compare_date, x['sp_surg_date'], x['ewdateterm']), axis =1)
+
+    agg_dict = {'main_record_id':'size',
+                'start_v1_preop':'sum','surg_complete':'sum','start_v2_6wk': 'sum',
+                'start_v3_3mo': 'sum', 'start_6mo': 'sum', 'start_12mo': 'sum','ewdateterm': 'sum',
+                'death': 'sum', 'complete':'sum'
+               }
+    table4_agg = table4.groupby(category_cols).agg(agg_dict).reset_index()
+    table4_agg.fillna(0, inplace=True)
+    int_cols = table4_agg.columns.drop(category_cols)
+    table4_agg[int_cols] = table4_agg[int_cols].astype(int)
+
+    rename_cols_dict = {'treatment_site':'Center',
+                        'surgery_type':'Surgery',
+                        'main_record_id': 'Consented',
+                        'start_v1_preop': 'Baseline',
+                        'surg_complete': 'Surgery Complete',
+                        'start_v2_6wk':'6 week',
+                        'start_v3_3mo': '3 Month',
+                        'start_6mo':'6 Month',
+                        'start_12mo':'12 Month',
+                        'ewdateterm':'Resc./Early Term.',
+                        'complete':'Completed',
+                        'death':'Deaths'
+                       }
+    table4_agg.rename(columns=rename_cols_dict, inplace = True)
+
+    table4_agg.loc['All']= table4_agg.sum(numeric_only=True, axis=0)
+    table4_agg.loc['All','Center'] = 'All Sites'
+    table4_agg.fillna("", inplace=True)
+
+    return table4_agg
+
+def reference_run_demographics(inputs):
+    demographics = get_demographic_data(inputs['consented'])
+    demo_active = demographics[demographics['Status']=='Active'].copy()
+    demo_active['category'] = demo_active.apply(lambda x: 'MCC ' + str(x['MCC'])  + ' / ' +x['Surgery'], axis=1)
+    return demo_active
+
+def reference_rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations):
+    enrollment_df = enrollment_df.merge(enrollment_expectations_df[['mcc','surgery_type','start_month']], how='left', on=['mcc','surgery_type'])
+    enrollment_df['expected_month'] = np.where(enrollment_df['obtain_month'] <= enrollment_df['start_month'], enrollment_df['start_month'], enrollment_df['obtain_month'] )
+    ee_rollup = enrollment_rollup(enrollment_df, 'expected_month', ['mcc','surgery_type'], 'Monthly').sort_values(by='mcc')
+    ee_rollup.rename(columns={'expected_month':'Month', 'Monthly': 'Actual: Monthly', 'Cumulative': 'Actual: Cumulative'},inplace=True)
+    ee_rollup = ee_rollup.merge(monthly_expectations, how='left', on=['mcc','surgery_type','Month'])
+    ee_rollup['Percent: Monthly'] = (100 * ee_rollup['Actual: Monthly'] / ee_rollup['Expected: Monthly']).round(1).astype(str) + '%'
+    ee_rollup['Percent: Cumulative'] = (100 * ee_rollup['Actual: Cumulative'] / ee_rollup['Expected: Cumulative']).round(1).astype(str) + '%'
+    ee_rollup.loc[ee_rollup['Actual: Monthly'] == 0, 'Percent: Monthly'] = ''
+    ee_rollup['Site'] = ee_rollup.apply(lambda x: 'MCC' + str(x['mcc']) + ' (' + x['surgery_type'] + ')',axis=1)
+    ee_rollup_cols = ['Site','Month', 'Actual: Monthly', 'Actual: Cumulative',
+       'Expected: Monthly', 'Expected: Cumulative', 'Percent: Monthly','Percent: Cumulative']
+    return ee_rollup[ee_rollup_cols]
+
+# ----------------------------------------------------------------------------
+# TABLES FROM THE SYNTHETIC PAYLOAD
+# ----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def payload():
+    subjects_json, screening_sites = generate_subjects_json(N_SUBJECTS, seed=0)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    return get_api_payload_json(subjects, consented, adverse_events)
+
+def build_tables(payload):
+    ''' Every table of the report from the payload, built the way the app builds its report data'''
+    today, start_report, end_report, report_date_msg, report_range_msg = get_time_parameters(REPORT_DATE)
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    payload_frames = parse_payload_frames(payload)
+    subjects = convert_datetime_columns(payload_frames['subjects_cleaned'], 'subjects')
+    adverse_events = convert_datetime_columns(payload_frames['adverse_events'], 'adverse_events')
+    consented = data_processing.get_consented_subjects(subjects).reset_index(drop=True)
+    screening_centers_df, centers_df = get_centers(subjects, consented, display_terms)
+
+    inputs = get_table_inputs(REPORT_DATE, start_report, end_report, display_terms_dict, display_terms_dict_multi,
+                              normalize_dtypes(subjects, 'subjects'), normalize_dtypes(consented, 'consented'),
+                              normalize_dtypes(adverse_events, 'adverse_events'), centers_df)
+    sections_tables = get_sections_tables(SECTION_TABLES, inputs, workers=1)
+    tables = {table_name: table for section, section_tables in sections_tables.items()
+              for table_name, table in zip(SECTION_TABLES[section], section_tables)}
+    tables['enrollment'] = get_enrollment_tables(consented)[2]
+    return tables
+
+def test_tables_match_reference(payload, monkeypatch):
+    tables = build_tables(payload)
+
+    monkeypatch.setattr(data_processing, 'get_consented_subjects', reference_get_consented_subjects)
+    monkeypatch.setattr(data_processing, 'get_table_4', reference_get_table_4)
+    monkeypatch.setitem(TABLE_TASKS['demographics'], 'run', reference_run_demographics)
+    monkeypatch.setattr(data_processing, 'rollup_enrollment_expectations', reference_rollup_enrollment_expectations)
+    reference_tables = build_tables(payload)
+
+    assert tables.keys() == reference_tables.keys()
+    for table_name, reference_table in reference_tables.items():
+        pd.testing.assert_frame_equal(tables[table_name], reference_table, obj=table_name)